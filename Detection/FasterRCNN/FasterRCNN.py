@@ -6,6 +6,7 @@
 from __future__ import print_function
 import numpy as np
 import os, sys
+import time
 import argparse
 import yaml     # pip install pyyaml
 import easydict # pip install easydict
@@ -18,6 +19,7 @@ from cntk.io import MinibatchData
 from cntk.initializer import normal
 from cntk.layers import placeholder, Constant, Sequential
 from cntk.learners import momentum_sgd, learning_rate_schedule, momentum_schedule
+from cntk.train.distributed import data_parallel_distributed_learner
 from cntk.logging import log_number_of_parameters, ProgressPrinter
 from cntk.logging.graph import find_by_name, plot
 from cntk.losses import cross_entropy_with_softmax
@@ -28,11 +30,13 @@ abs_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(abs_path, ".."))
 from utils.rpn.rpn_helpers import create_rpn, create_proposal_target_layer
 from utils.rpn.cntk_smoothL1_loss import SmoothL1Loss
-from utils.map.map_helpers import evaluate_detections
+from utils.rpn.proposal_generator import ProposalGenerator
+from utils.map.detection_evaluator import DetectionEvaluator
 from utils.map.det_analyzer import confusions_map, log_fp_errors
 from utils.annotations.annotations_helper import parse_class_map_file
 from config import cfg
 from od_mb_source import ObjectDetectionMinibatchSource
+from od_proposal_cache import ProposalCacheWriter, load_proposals, proposal_cache_key
 from cntk_helpers import regress_rois
 
 ###############################################################
@@ -52,6 +56,9 @@ normalization_const = Constant([[[103]], [[116]], [[123]]]) if cfg["CNTK"].BASE_
 
 globalvars = {}
 globalvars['output_path'] = os.path.join(abs_path, "Output")
+globalvars['image_cache_dir'] = os.path.join(globalvars['output_path'], "image_cache") if cfg["CNTK"].USE_IMAGE_CACHE else None
+globalvars['proposal_cache_dir'] = os.path.join(globalvars['output_path'], "proposal_cache") if cfg["CNTK"].USE_PROPOSAL_CACHE else None
+image_cache_max_bytes = int(cfg["CNTK"].IMAGE_CACHE_MAX_GB * 1024 * 1024 * 1024)
 
 # dataset specific parameters
 map_file_path = os.path.join(abs_path, cfg["CNTK"].MAP_FILE_PATH)
@@ -87,6 +94,7 @@ def set_global_vars(use_arg_parser = True):
     globalvars['rpn_epochs'] = 1 if cfg["CNTK"].FAST_MODE else cfg["CNTK"].RPN_EPOCHS
     globalvars['frcn_epochs'] = 1 if cfg["CNTK"].FAST_MODE else cfg["CNTK"].FRCN_EPOCHS
     globalvars['rnd_seed'] = cfg.RNG_SEED
+    globalvars['quantized_bits'] = 32
     globalvars['train_conv'] = cfg["CNTK"].TRAIN_CONV_LAYERS
     globalvars['train_e2e'] = cfg["CNTK"].TRAIN_E2E
 
@@ -142,6 +150,8 @@ def set_global_vars(use_arg_parser = True):
             globalvars['frcn_epochs'] = args['frcnEpochs']
         if args['rndSeed'] is not None:
             globalvars['rnd_seed'] = args['rndSeed']
+        if args['quantized_bits'] is not None:
+            globalvars['quantized_bits'] = args['quantized_bits']
         if args['trainConv'] is not None:
             globalvars['train_conv'] = True if args['trainConv']==1 else False
         if args['trainE2E'] is not None:
@@ -149,6 +159,10 @@ def set_global_vars(use_arg_parser = True):
 
         if args['outputdir'] is not None:
             globalvars['output_path'] = args['outputdir']
+            if cfg["CNTK"].USE_IMAGE_CACHE:
+                globalvars['image_cache_dir'] = os.path.join(args['outputdir'], "image_cache")
+            if cfg["CNTK"].USE_PROPOSAL_CACHE:
+                globalvars['proposal_cache_dir'] = os.path.join(args['outputdir'], "proposal_cache")
         if args['logdir'] is not None:
             log_dir = args['logdir']
         if args['device'] is not None:
@@ -164,6 +178,10 @@ def set_global_vars(use_arg_parser = True):
     if not os.path.isdir(data_path):
         raise RuntimeError("Directory %s does not exist" % data_path)
 
+    # the image cache of a directory is owned by a single process, every data parallel worker uses its own one
+    if globalvars['image_cache_dir'] is not None and Communicator.num_workers() > 1:
+        globalvars['image_cache_dir'] = os.path.join(globalvars['image_cache_dir'], "worker_{}".format(Communicator.rank()))
+
     globalvars['class_map_file'] = os.path.join(data_path, globalvars['class_map_file'])
     globalvars['train_map_file'] = os.path.join(data_path, globalvars['train_map_file'])
     globalvars['test_map_file'] = os.path.join(data_path, globalvars['test_map_file'])
@@ -351,20 +369,34 @@ def train_model(image_input, roi_input, dims_input, loss, pred_error,
     bias_lr_schedule = learning_rate_schedule(bias_lr_per_sample, unit=UnitType.sample)
     bias_learner = momentum_sgd(biases, bias_lr_schedule, mm_schedule, l2_regularization_weight=l2_reg_weight,
                            unit_gain=False, use_mean_gradient=cfg["CNTK"].USE_MEAN_GRADIENT)
+
+    # data parallel training: every worker reads its own shard of the data and gradients are aggregated
+    num_workers = Communicator.num_workers()
+    worker_rank = Communicator.rank()
+    if num_workers > 1:
+        print("Training on worker {} of {} with {} bit gradient aggregation".format(worker_rank, num_workers, globalvars['quantized_bits']))
+        learner = data_parallel_distributed_learner(learner, num_quantization_bits=globalvars['quantized_bits'])
+        bias_learner = data_parallel_distributed_learner(bias_learner, num_quantization_bits=globalvars['quantized_bits'])
     trainer = Trainer(None, (loss, pred_error), [learner, bias_learner])
 
     # Get minibatches of images and perform model training
     print("Training model for %s epochs." % epochs_to_train)
     log_number_of_parameters(loss)
 
-    # Create the minibatch source
+    # Create the minibatch source. Data parallel workers shuffle with a shared seed so that they agree on the reading
+    # order, a single worker shuffles with the global numpy RNG
     od_minibatch_source = ObjectDetectionMinibatchSource(
         globalvars['train_map_file'], globalvars['train_roi_file'],
         max_annotations_per_image=cfg["CNTK"].INPUT_ROIS_PER_IMAGE,
         pad_width=image_width, pad_height=image_height, pad_value=img_pad_value,
         randomize=True, use_flipping=cfg["TRAIN"].USE_FLIPPED,
         max_images=cfg["CNTK"].NUM_TRAIN_IMAGES,
-        buffered_rpn_proposals=buffered_rpn_proposals)
+        buffered_rpn_proposals=buffered_rpn_proposals,
+        prefetch_queue_depth=cfg["CNTK"].PREFETCH_QUEUE_DEPTH,
+        prefetch_num_workers=cfg["CNTK"].PREFETCH_NUM_WORKERS,
+        prefetch_use_processes=cfg["CNTK"].PREFETCH_USE_PROCESSES,
+        image_cache_dir=globalvars['image_cache_dir'], image_cache_max_bytes=image_cache_max_bytes,
+        shuffle_seed=globalvars['rnd_seed'] if num_workers > 1 else None, probe_image_sizes=cfg["CNTK"].PROBE_IMAGE_SIZES)
 
     # define mapping from reader streams to network inputs
     input_map = {
@@ -375,32 +407,87 @@ def train_model(image_input, roi_input, dims_input, loss, pred_error,
 
     use_buffered_proposals = buffered_rpn_proposals is not None
     progress_printer = ProgressPrinter(tag='Training', num_epochs=epochs_to_train, gen_heartbeat=True)
+    # each worker processes its share of the epoch, all workers run the same number of minibatches
+    worker_epoch_size = (epoch_size + num_workers - 1) // num_workers
     for epoch in range(epochs_to_train):       # loop over epochs
         sample_count = 0
-        while sample_count < epoch_size:  # loop over minibatches in the epoch
-            data, proposals = od_minibatch_source.next_minibatch_with_proposals(min(mb_size, epoch_size-sample_count), input_map=input_map)
+        while sample_count < worker_epoch_size:  # loop over minibatches in the epoch
+            data, proposals = od_minibatch_source.next_minibatch_with_proposals(min(mb_size, worker_epoch_size-sample_count),
+                number_of_workers=num_workers, worker_rank=worker_rank, input_map=input_map)
             if use_buffered_proposals:
-                data[rpn_rois_input] = MinibatchData(Value(batch=np.asarray(proposals, dtype=np.float32)), 1, 1, False)
+                data[rpn_rois_input] = MinibatchData(Value(batch=proposals), len(proposals), len(proposals), False)
                 # remove dims input if no rpn is required to avoid warnings
                 del data[[k for k in data if '[6]' in str(k)][0]]
 
             trainer.train_minibatch(data)                                    # update model with it
-            sample_count += trainer.previous_minibatch_sample_count          # count samples processed so far
+            sample_count += data[image_input].number_of_samples              # count samples processed by this worker so far
             progress_printer.update_with_trainer(trainer, with_metric=True)  # log progress
             if sample_count % 100 == 0:
                 print("Processed {} samples".format(sample_count))
 
         progress_printer.epoch_summary(with_metric=True)
+        if cfg["CNTK"].DEBUG_OUTPUT and cfg["CNTK"].PREFETCH_QUEUE_DEPTH > 0:
+            stats = od_minibatch_source.od_reader.prefetch_stats()
+            print("Waited {:.2f}s for prefetched images ({} of {} images were not ready)"
+                  .format(stats['wait_time'], stats['num_stalls'], stats['num_samples']))
+            od_minibatch_source.od_reader.reset_prefetch_stats()
+
+    od_minibatch_source.close()
 
 def compute_rpn_proposals(rpn_model, image_input, roi_input, dims_input):
     num_images = cfg["CNTK"].NUM_TRAIN_IMAGES
+    cache_dir = globalvars['proposal_cache_dir']
+    if Communicator.num_workers() == 1:
+        return _buffer_rpn_proposals(rpn_model, image_input, roi_input, dims_input, num_images, cache_dir)
+
+    # data parallel training: the first worker computes the proposals and stores them on disk, the other workers
+    # wait for it and read them from disk. All workers have the same rpn model and hence the same cache key.
+    if cache_dir is None:
+        cache_dir = os.path.join(globalvars['output_path'], "proposal_cache")
+    if Communicator.rank() == 0:
+        buffered_proposals = _buffer_rpn_proposals(rpn_model, image_input, roi_input, dims_input, num_images, cache_dir)
+        Communicator.barrier()
+        return buffered_proposals
+
+    Communicator.barrier()
+    buffered_proposals = load_proposals(cache_dir, proposal_cache_key(rpn_model, _rpn_proposal_settings(num_images)), num_images)
+    assert buffered_proposals is not None, "The proposals of the first worker were not found in {}".format(cache_dir)
+    return buffered_proposals
+
+def _buffer_rpn_proposals(rpn_model, image_input, roi_input, dims_input, num_images, cache_dir):
+    # the proposals are stored on disk and reused as long as the rpn model and the proposal settings are unchanged
+    cache_writer = None
+    if cache_dir is not None:
+        cache_key = proposal_cache_key(rpn_model, _rpn_proposal_settings(num_images))
+        buffered_proposals = load_proposals(cache_dir, cache_key, num_images)
+        if buffered_proposals is not None:
+            print("Using cached proposals from {}".format(buffered_proposals.data_file))
+            return buffered_proposals
+        cache_writer = ProposalCacheWriter(cache_dir, cache_key)
+
+    # cntk only evaluates the conv layers and the rpn head, the post-processing of the proposal layer runs in a pool of
+    # workers and overlaps with the evaluation of the next minibatches. The proposals are computed with the training
+    # pre- and post-nms top N since the buffered proposals are used for further training.
+    rpn_head = combine([find_by_name(rpn_model, "rpn_cls_prob_reshape").outputs[0],
+                        find_by_name(rpn_model, "rpn_bbox_pred").outputs[0]])
+    proposal_generator = ProposalGenerator(cfg["TRAIN"].RPN_PRE_NMS_TOP_N, cfg["TRAIN"].RPN_POST_NMS_TOP_N,
+                                           cfg["TEST"].RPN_NMS_THRESH, cfg["TEST"].RPN_MIN_SIZE,
+                                           param_str=cfg["CNTK"].PROPOSAL_LAYER_PARAMS,
+                                           num_workers=cfg["CNTK"].PROPOSAL_NUM_WORKERS,
+                                           use_processes=cfg["CNTK"].PROPOSAL_USE_PROCESSES)
+
     # Create the minibatch source
     od_minibatch_source = ObjectDetectionMinibatchSource(
         globalvars['train_map_file'], globalvars['train_roi_file'],
         max_annotations_per_image=cfg["CNTK"].INPUT_ROIS_PER_IMAGE,
         pad_width=image_width, pad_height=image_height, pad_value=img_pad_value,
         max_images=num_images,
-        randomize=False, use_flipping=False)
+        randomize=False, use_flipping=False,
+        prefetch_queue_depth=cfg["CNTK"].PREFETCH_QUEUE_DEPTH,
+        prefetch_num_workers=cfg["CNTK"].PREFETCH_NUM_WORKERS,
+        prefetch_use_processes=cfg["CNTK"].PREFETCH_USE_PROCESSES,
+        image_cache_dir=globalvars['image_cache_dir'], image_cache_max_bytes=image_cache_max_bytes,
+        probe_image_sizes=cfg["CNTK"].PROBE_IMAGE_SIZES)
 
     # define mapping from reader streams to network inputs
     input_map = {
@@ -409,30 +496,50 @@ def compute_rpn_proposals(rpn_model, image_input, roi_input, dims_input):
         od_minibatch_source.dims_si: dims_input
     }
 
-    # setting pre- and post-nms top N to training values since buffered proposals are used for further training
-    test_pre = cfg["TEST"].RPN_PRE_NMS_TOP_N
-    test_post = cfg["TEST"].RPN_POST_NMS_TOP_N
-    cfg["TEST"].RPN_PRE_NMS_TOP_N = cfg["TRAIN"].RPN_PRE_NMS_TOP_N
-    cfg["TEST"].RPN_POST_NMS_TOP_N = cfg["TRAIN"].RPN_POST_NMS_TOP_N
+    def rpn_outputs():
+        sample_count = 0
+        while sample_count < num_images:
+            num_mb_images = min(cfg["CNTK"].PROPOSAL_MB_SIZE, num_images - sample_count)
+            data, img_dims = od_minibatch_source.next_minibatch_with_dims(num_mb_images, input_map=input_map)
+            output = rpn_head.eval({image_input: data[image_input]})
+            yield output[rpn_head.outputs[0]], output[rpn_head.outputs[1]], img_dims
+            sample_count += num_mb_images
 
     buffered_proposals = [None for _ in range(num_images)]
-    sample_count = 0
-    while sample_count < num_images:
-        data = od_minibatch_source.next_minibatch(1, input_map=input_map)
-        output = rpn_model.eval(data)
-        out_dict = dict([(k.name, k) for k in output])
-        out_rpn_rois = output[out_dict['rpn_rois']][0]
-        buffered_proposals[sample_count] = np.round(out_rpn_rois).astype(np.int16)
-        sample_count += 1
-        if sample_count % 500 == 0:
-            print("Buffered proposals for {} samples".format(sample_count))
-
-    # resetting config values to original test values
-    cfg["TEST"].RPN_PRE_NMS_TOP_N = test_pre
-    cfg["TEST"].RPN_POST_NMS_TOP_N = test_post
-
+    start_time = time.time()
+    try:
+        for sample_count, out_rpn_rois in enumerate(proposal_generator.generate(rpn_outputs()), 1):
+            proposals = np.round(out_rpn_rois).astype(np.int16)
+            if cache_writer is not None:
+                cache_writer.append(proposals)
+            else:
+                buffered_proposals[sample_count - 1] = proposals
+            if sample_count % 500 == 0:
+                print("Buffered proposals for {} samples".format(sample_count))
+    finally:
+        proposal_generator.close()
+        od_minibatch_source.close()
+
+    elapsed = time.time() - start_time
+    print("Computed proposals for {} images in {:.1f}s ({:.2f} images/s)".format(num_images, elapsed,
+                                                                                 num_images / max(elapsed, 1e-6)))
+
+    if cache_writer is not None:
+        buffered_proposals = cache_writer.close()
     return buffered_proposals
 
+def _rpn_proposal_settings(num_images):
+    # everything besides the rpn weights that changes the buffered proposals. The proposals are computed by the
+    # eval graph, i.e. with the training pre- and post-nms top N but the TEST nms threshold and min size.
+    files = [globalvars['train_map_file'], globalvars['train_roi_file']]
+    return {'pre_nms_top_n': cfg["TRAIN"].RPN_PRE_NMS_TOP_N, 'post_nms_top_n': cfg["TRAIN"].RPN_POST_NMS_TOP_N,
+            'nms_thresh': cfg["TEST"].RPN_NMS_THRESH, 'min_size': cfg["TEST"].RPN_MIN_SIZE,
+            'nms_soft': cfg["CNTK"].RESULTS_NMS_SOFT, 'nms_soft_method': cfg["CNTK"].RESULTS_NMS_SOFT_METHOD,
+            'nms_soft_sigma': cfg["CNTK"].RESULTS_NMS_SOFT_SIGMA, 'nms_backend': cfg["CNTK"].NMS_BACKEND,
+            'proposal_layer_params': cfg["CNTK"].PROPOSAL_LAYER_PARAMS,
+            'image_size': [image_width, image_height], 'pad_value': img_pad_value, 'num_images': num_images,
+            'files': [[os.path.abspath(f), os.path.getmtime(f) if os.path.exists(f) else None] for f in files]}
+
 # Trains a Faster R-CNN model end-to-end
 def train_faster_rcnn_e2e(base_model_file_name, debug_output=False):
     # Input variables denoting features and labeled ground truth rois (as 5-tuples per roi)
@@ -633,7 +740,12 @@ def eval_faster_rcnn_mAP(eval_model):
         max_annotations_per_image=cfg["CNTK"].INPUT_ROIS_PER_IMAGE,
         pad_width=image_width, pad_height=image_height, pad_value=img_pad_value,
         randomize=False, use_flipping=False,
-        max_images=cfg["CNTK"].NUM_TEST_IMAGES)
+        max_images=cfg["CNTK"].NUM_TEST_IMAGES,
+        prefetch_queue_depth=cfg["CNTK"].PREFETCH_QUEUE_DEPTH,
+        prefetch_num_workers=cfg["CNTK"].PREFETCH_NUM_WORKERS,
+        prefetch_use_processes=cfg["CNTK"].PREFETCH_USE_PROCESSES,
+        image_cache_dir=globalvars['image_cache_dir'], image_cache_max_bytes=image_cache_max_bytes,
+        probe_image_sizes=cfg["CNTK"].PROBE_IMAGE_SIZES)
 
     # define mapping from reader streams to network inputs
     input_map = {
@@ -642,64 +754,73 @@ def eval_faster_rcnn_mAP(eval_model):
         minibatch_source.dims_si: dims_input
     }
 
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(num_test_images)] for _ in range(globalvars['num_classes'])]
+    confusions = None
+    try:
+        conf_file = cfg["CNTK"].CONFUSION_FILE
+        conf_file = os.path.join(map_file_path, conf_file)
+        confusions = confusions_map(classes, conf_file)
+    except:
+        confusions = None
+
+    # nms and matching are done per image, only the per class scores and TP/FP flags are kept. For the COCO-style
+    # metrics the evaluator also keeps the detections after nms.
+    eval_coco_metrics = cfg["CNTK"].EVAL_COCO_METRICS
+    evaluator = DetectionEvaluator(classes,
+                                   nms_threshold=cfg["CNTK"].RESULTS_NMS_THRESHOLD,
+                                   conf_threshold=cfg["CNTK"].RESULTS_NMS_CONF_THRESHOLD,
+                                   soft=cfg["CNTK"].RESULTS_NMS_SOFT,
+                                   confusions=confusions,
+                                   keep_detections=eval_coco_metrics,
+                                   nms_num_workers=cfg["CNTK"].RESULTS_NMS_NUM_WORKERS,
+                                   nms_use_processes=cfg["CNTK"].RESULTS_NMS_USE_PROCESSES)
 
     # evaluate test images and write netwrok output to file
     print("Evaluating Faster R-CNN model for %s images." % num_test_images)
-    all_gt_infos = {key: [] for key in classes}
-    for img_i in range(0, num_test_images):
-        mb_data = minibatch_source.next_minibatch(1, input_map=input_map)
+    img_i = 0
+    while img_i < num_test_images:
+        num_mb_images = min(mb_size, num_test_images - img_i)
+        mb_data = minibatch_source.next_minibatch(num_mb_images, input_map=input_map)
 
-        gt_row = mb_data[roi_input].asarray()
-        gt_row = gt_row.reshape((cfg["CNTK"].INPUT_ROIS_PER_IMAGE, 5))
-        all_gt_boxes = gt_row[np.where(gt_row[:,-1] > 0)]
-
-        for cls_index, cls_name in enumerate(classes):
-            if cls_index == 0: continue
-            cls_gt_boxes = all_gt_boxes[np.where(all_gt_boxes[:,-1] == cls_index)]
-            all_gt_infos[cls_name].append({'bbox': np.array(cls_gt_boxes),
-                                           'difficult': [False] * len(cls_gt_boxes),
-                                           'det': [False] * len(cls_gt_boxes)})
+        gt_rows = mb_data[roi_input].asarray()
+        gt_rows = gt_rows.reshape((num_mb_images, cfg["CNTK"].INPUT_ROIS_PER_IMAGE, 5))
+        mb_dims = mb_data[dims_input].asarray().reshape((num_mb_images, 6))
 
         output = frcn_eval.eval({image_input: mb_data[image_input], dims_input: mb_data[dims_input]})
         out_dict = dict([(k.name, k) for k in output])
-        out_cls_pred = output[out_dict['cls_pred']][0]
-        out_rpn_rois = output[out_dict['rpn_rois']][0]
-        out_bbox_regr = output[out_dict['bbox_regr']][0]
 
-        labels = out_cls_pred.argmax(axis=1)
-        scores = out_cls_pred.max(axis=1)
-        regressed_rois = regress_rois(out_rpn_rois, out_bbox_regr, labels, mb_data[dims_input].asarray())
+        for mb_i in range(num_mb_images):
+            gt_row = gt_rows[mb_i]
+            all_gt_boxes = gt_row[np.where(gt_row[:,-1] > 0)]
 
-        labels.shape = labels.shape + (1,)
-        scores.shape = scores.shape + (1,)
-        coords_score_label = np.hstack((regressed_rois, scores, labels))
+            out_cls_pred = output[out_dict['cls_pred']][mb_i]
+            out_rpn_rois = output[out_dict['rpn_rois']][mb_i]
+            out_bbox_regr = output[out_dict['bbox_regr']][mb_i]
 
-        #   shape of all_boxes: e.g. 21 classes x 4952 images x 58 rois x 5 coords+score
-        for cls_j in range(1, globalvars['num_classes']):
-            coords_score_label_for_cls = coords_score_label[np.where(coords_score_label[:,-1] == cls_j)]
-            all_boxes[cls_j][img_i] = coords_score_label_for_cls[:,:-1].astype(np.float32, copy=False)
+            labels = out_cls_pred.argmax(axis=1)
+            scores = out_cls_pred.max(axis=1)
+            regressed_rois = regress_rois(out_rpn_rois, out_bbox_regr, labels, mb_dims[mb_i])
 
-        if (img_i+1) % 100 == 0:
-            print("Processed {} samples".format(img_i+1))
+            labels.shape = labels.shape + (1,)
+            scores.shape = scores.shape + (1,)
+            coords_score_label = np.hstack((regressed_rois, scores, labels))
 
-    confusions = None
-    try:
-        conf_file = cfg["CNTK"].CONFUSION_FILE
-        conf_file = os.path.join(map_file_path, conf_file)
-        confusions = confusions_map(classes, conf_file)
-    except:
-        confusions = None
+            #   detections[cls] = N x 5 array of (x1, y1, x2, y2, score)
+            detections = [[]]
+            for cls_j in range(1, globalvars['num_classes']):
+                coords_score_label_for_cls = coords_score_label[np.where(coords_score_label[:,-1] == cls_j)]
+                detections.append(coords_score_label_for_cls[:,:-1].astype(np.float32, copy=False))
+            evaluator.add(img_i, detections, all_gt_boxes)
+
+            img_i += 1
+            if img_i % 100 == 0:
+                print("Processed {} samples, {} rois after non-maximum suppression".format(img_i, evaluator.num_rois_after_nms))
+    minibatch_source.close()
+    evaluator.close()
 
     # calculate mAP
-    aps, fp_errors = evaluate_detections(all_boxes, all_gt_infos, classes,
-                                         nms_threshold=cfg["CNTK"].RESULTS_NMS_THRESHOLD,
-                                         conf_threshold = cfg["CNTK"].RESULTS_NMS_CONF_THRESHOLD,
-                                         soft=cfg["CNTK"].RESULTS_NMS_SOFT,
-                                         confusions=confusions)
+    print("Number of rois before non-maximum suppression: %d" % evaluator.num_rois_before_nms)
+    print("Number of rois  after non-maximum suppression: %d" % evaluator.num_rois_after_nms)
+    aps, fp_errors = evaluator.summarize()
     if fp_errors:
         output_file = os.path.join(globalvars['output_path'], "{}_{}_fps.txt"
                               .format(cfg["CNTK"].BASE_MODEL, "e2e" if globalvars['train_e2e'] else "4stage"))
@@ -711,6 +832,11 @@ def eval_faster_rcnn_mAP(eval_model):
         print('AP for {:>15} = {:.4f}'.format(class_name, aps[class_name]))
     meanAP = np.nanmean(ap_list)
     print('Mean AP = {:.4f}'.format(meanAP))
+
+    if eval_coco_metrics:
+        report = evaluator.evaluate_coco()
+        for metric, value in report['summary'].items():
+            print('{:>15} = {:.4f}'.format(metric, value))
     return meanAP
 
 # The main method trains and evaluates a Fast R-CNN model.
@@ -743,26 +869,33 @@ if __name__ == '__main__':
         else:
             eval_model = train_faster_rcnn_alternating(base_model_file, debug_output=cfg["CNTK"].DEBUG_OUTPUT)
 
-        eval_model.save(model_path)
-        if cfg["CNTK"].DEBUG_OUTPUT:
-            plot(eval_model, os.path.join(globalvars['output_path'], "graph_frcn_eval_{}_{}.{}"
-                                          .format(cfg["CNTK"].BASE_MODEL, "e2e" if globalvars['train_e2e'] else "4stage", cfg["CNTK"].GRAPH_TYPE)))
-
-        print("Stored eval model at %s" % model_path)
-
-    # Compute mean average precision on test set
-    eval_faster_rcnn_mAP(eval_model)
-
-    # Plot results on test set
-    if cfg["CNTK"].VISUALIZE_RESULTS:
-        from plot_helpers import eval_and_plot_faster_rcnn
-        num_eval = min(num_test_images, 100)
-        img_shape = (num_channels, image_height, image_width)
-        results_folder = os.path.join(globalvars['output_path'], cfg["CNTK"].DATASET)
-        eval_and_plot_faster_rcnn(eval_model, num_eval, globalvars['test_map_file'], img_shape,
-                                  results_folder, feature_node_name, globalvars['classes'],
-                                  drawUnregressedRois=cfg["CNTK"].DRAW_UNREGRESSED_ROIS,
-                                  drawNegativeRois=cfg["CNTK"].DRAW_NEGATIVE_ROIS,
-                                  nmsThreshold=cfg["CNTK"].RESULTS_NMS_THRESHOLD,
-                                  nmsConfThreshold=cfg["CNTK"].RESULTS_NMS_CONF_THRESHOLD,
-                                  bgrPlotThreshold=cfg["CNTK"].RESULTS_BGR_PLOT_THRESHOLD)
+        # with data parallel training all workers have the same model, only the first one stores it
+        if Communicator.rank() == 0:
+            eval_model.save(model_path)
+            if cfg["CNTK"].DEBUG_OUTPUT:
+                plot(eval_model, os.path.join(globalvars['output_path'], "graph_frcn_eval_{}_{}.{}"
+                                              .format(cfg["CNTK"].BASE_MODEL, "e2e" if globalvars['train_e2e'] else "4stage", cfg["CNTK"].GRAPH_TYPE)))
+
+            print("Stored eval model at %s" % model_path)
+
+    # the test set is evaluated and plotted by the first worker only
+    if Communicator.rank() == 0:
+        # Compute mean average precision on test set
+        eval_faster_rcnn_mAP(eval_model)
+
+        # Plot results on test set
+        if cfg["CNTK"].VISUALIZE_RESULTS:
+            from plot_helpers import eval_and_plot_faster_rcnn
+            num_eval = min(num_test_images, 100)
+            img_shape = (num_channels, image_height, image_width)
+            results_folder = os.path.join(globalvars['output_path'], cfg["CNTK"].DATASET)
+            eval_and_plot_faster_rcnn(eval_model, num_eval, globalvars['test_map_file'], img_shape,
+                                      results_folder, feature_node_name, globalvars['classes'],
+                                      drawUnregressedRois=cfg["CNTK"].DRAW_UNREGRESSED_ROIS,
+                                      drawNegativeRois=cfg["CNTK"].DRAW_NEGATIVE_ROIS,
+                                      nmsThreshold=cfg["CNTK"].RESULTS_NMS_THRESHOLD,
+                                      nmsConfThreshold=cfg["CNTK"].RESULTS_NMS_CONF_THRESHOLD,
+                                      bgrPlotThreshold=cfg["CNTK"].RESULTS_BGR_PLOT_THRESHOLD)
+
+    # all workers have to finalize the communicator
+    Communicator.finalize()
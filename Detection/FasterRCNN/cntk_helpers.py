@@ -5,16 +5,17 @@
 # ==============================================================================
 
 from __future__ import print_function
+import numpy as np
 from utils.rpn.bbox_transform import bbox_transform_inv
 
 def regress_rois(roi_proposals, roi_regression_factors, labels, dims_input):
-    for i in range(len(labels)):
-        label = labels[i]
-        if label > 0:
-            deltas = roi_regression_factors[i:i+1,label*4:(label+1)*4]
-            roi_coords = roi_proposals[i:i+1,:]
-            regressed_rois = bbox_transform_inv(roi_coords, deltas)
-            roi_proposals[i,:] = regressed_rois
+    # gather the regression factors of the predicted class for all foreground rois and regress them at once
+    labels = np.asarray(labels).ravel()
+    fg_inds = np.where(labels > 0)[0]
+    if len(fg_inds) > 0:
+        delta_cols = labels[fg_inds, np.newaxis] * 4 + np.arange(4)
+        deltas = roi_regression_factors[fg_inds[:, np.newaxis], delta_cols]
+        roi_proposals[fg_inds, :] = bbox_transform_inv(roi_proposals[fg_inds, :], deltas, out=deltas)
 
     if dims_input is not None:
         # dims_input -- (pad_width, pad_height, scaled_image_width, scaled_image_height, orig_img_width, orig_img_height)
@@ -48,7 +48,8 @@ __C.CNTK.RPN_LR_PER_SAMPLE = [0.001] * 12 + [0.0001] * 4
 __C.CNTK.FRCN_EPOCHS = 8
 __C.CNTK.FRCN_LR_PER_SAMPLE = [0.001] * 6 + [0.0001] * 2
 
-# number of maximum number of ROI per image
+# number of maximum number of ROI per image. The reader stores all ground truth boxes and pads them to this
+# number of rows only when they are read, so it can be changed without creating the map files again
 __C.CNTK.INPUT_ROIS_PER_IMAGE = 3000
 
 
@@ -56,13 +57,49 @@ __C.CNTK.INPUT_ROIS_PER_IMAGE = 3000
 __C.CNTK.IMAGE_WIDTH = 1000
 __C.CNTK.IMAGE_HEIGHT = 1000
 
+# Number of images per minibatch, the images are stacked along the batch axis
 __C.CNTK.MB_SIZE = 1
 __C.CNTK.NUM_CHANNELS = 3
 
+# Number of images that are decoded, resized and padded ahead of the trainer (0 disables prefetching)
+__C.CNTK.PREFETCH_QUEUE_DEPTH = 8
+# Number of workers decoding images for the prefetch queue
+__C.CNTK.PREFETCH_NUM_WORKERS = 4
+# Use worker processes instead of threads for prefetching
+__C.CNTK.PREFETCH_USE_PROCESSES = False
+# Cache resized and padded images on disk (in Output/image_cache) to skip decoding in later epochs and runs.
+# The cache is a memory-mapped file of up to IMAGE_CACHE_MAX_GB
+__C.CNTK.USE_IMAGE_CACHE = False
+# Maximum size of the image cache in GB, least recently used images are evicted when it is full
+__C.CNTK.IMAGE_CACHE_MAX_GB = 4.0
+# Read the image sizes from the image headers when the reader is created (stored next to the map files), so that
+# the annotations and image stats of all images are prepared before the first image is decoded
+__C.CNTK.PROBE_IMAGE_SIZES = True
+# Store the rpn proposals of the alternating training on disk (in Output/proposal_cache), they are reused
+# by later runs as long as the rpn model and the proposal settings are unchanged
+__C.CNTK.USE_PROPOSAL_CACHE = False
+# Number of images per minibatch when the rpn proposals are precomputed for the alternating training
+__C.CNTK.PROPOSAL_MB_SIZE = 8
+# Number of workers that decode the rpn outputs into proposals (anchors, clipping, sorting and nms), 0 uses the main thread
+__C.CNTK.PROPOSAL_NUM_WORKERS = 4
+# Use worker processes instead of threads for decoding the rpn proposals
+__C.CNTK.PROPOSAL_USE_PROCESSES = False
+
 __C.CNTK.RESULTS_NMS_THRESHOLD = 0.3 # see also: __C.TEST.NMS = 0.3
 __C.CNTK.RESULTS_NMS_CONF_THRESHOLD = 0.0
 __C.CNTK.RESULTS_BGR_PLOT_THRESHOLD = 0.1
 __C.CNTK.RESULTS_NMS_SOFT = False
+# 'numpy', 'blocked' or 'cython' (requires utils/cython_modules/cpu_nms), None uses 'blocked' with a block size chosen by the number of boxes
+__C.CNTK.NMS_BACKEND = None
+# score decay used by soft nms: 'linear' (score * (1 - IoU) above the nms threshold) or 'gaussian' (score * exp(-IoU^2 / sigma))
+__C.CNTK.RESULTS_NMS_SOFT_METHOD = 'linear'
+__C.CNTK.RESULTS_NMS_SOFT_SIGMA = 0.5
+# Number of workers that apply nms to the classes of a test image in parallel (1 runs it in the main process)
+__C.CNTK.RESULTS_NMS_NUM_WORKERS = 1
+# Use worker processes instead of threads for nms on the test set results
+__C.CNTK.RESULTS_NMS_USE_PROCESSES = False
+# Also report COCO-style metrics: mAP at IoU 0.50:0.05:0.95, mAP by object size and recall at 1, 10 and 100 detections
+__C.CNTK.EVAL_COCO_METRICS = False
 
 __C.CNTK.GRAPH_TYPE = "png" # "png" or "pdf"
 __C.CNTK.DEBUG_OUTPUT = True
@@ -13,13 +13,12 @@ from config import cfg
 
 def create_mappings(folder_path):
     sys.path.append(os.path.join(folder_path, "..", "..",  "Detection", "utils", "annotations"))
-    from annotations_helper import create_class_dict, create_map_files
+    from annotations_helper import index_data_set
     abs_path = os.path.dirname(os.path.abspath(__file__))
     data_set_path = os.path.join(abs_path, cfg["CNTK"].MAP_FILE_PATH)
 
-    class_dict = create_class_dict(data_set_path)
-    create_map_files(data_set_path, class_dict, training_set=True)
-    create_map_files(data_set_path, class_dict, training_set=False)
+    # writes the class map and the map files of the training and test set, only new or changed annotations are parsed
+    index_data_set(data_set_path)
 
 if __name__ == '__main__':
     base_folder = os.path.dirname(os.path.abspath(__file__))
@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from cntk import input_variable, Axis
+from utils.nms.nms_wrapper import apply_nms_to_single_image_results
+from cntk_helpers import regress_rois
+from od_reader import _read_image, _compute_image_stats, _get_scale_factor, _resize_and_pad_image
+
+class FasterRCNNDetector:
+    '''
+    Runs a Faster R-CNN eval model (see create_eval_model in FasterRCNN.py) on lists of images.
+
+    Images are read, resized and padded by a pool of threads and evaluated in minibatches of batch_size images.
+    The results are regressed, filtered by nms and returned per image in original image coordinates.
+    The thread pool is stopped by close(), or at the end of a with statement.
+    '''
+
+    def __init__(self, eval_model, image_width, image_height, pad_value, feature_node_name='features',
+                 batch_size=8, num_workers=4, nms_threshold=0.5, conf_threshold=0.0, nms_soft=False):
+        self._image_width = image_width
+        self._image_height = image_height
+        self._pad_value = pad_value
+        self._batch_size = max(1, batch_size)
+        self._nms_threshold = nms_threshold
+        self._conf_threshold = conf_threshold
+        self._nms_soft = nms_soft
+        self._pool = ThreadPool(max(1, num_workers))
+
+        self._image_input = input_variable((3, image_height, image_width), dynamic_axes=[Axis.default_batch_axis()],
+                                           name=feature_node_name)
+        self._dims_input = input_variable((6), dynamic_axes=[Axis.default_batch_axis()])
+        self._frcn_eval = eval_model(self._image_input, self._dims_input)
+
+    def detect(self, images):
+        '''
+        Detects objects in a list of images, each given as an image path or as a BGR image array (H x W x 3).
+
+        Returns a list with one dictionary per image:
+            boxes  - (x_min, y_min, x_max, y_max) in original image coordinates. shape = (n, 4)
+            scores - the score of each box. shape = (n,)
+            labels - the predicted class index of each box (> 0). shape = (n,)
+        '''
+        detections = []
+        if len(images) == 0:
+            return detections
+
+        # the next minibatch is read and preprocessed while the current one is evaluated
+        next_batch = self._preprocess_async(images[:self._batch_size])
+        for start in range(0, len(images), self._batch_size):
+            batch = [r.get() for r in next_batch]
+            next_start = start + self._batch_size
+            next_batch = self._preprocess_async(images[next_start:next_start + self._batch_size])
+            detections.extend(self._detect_batch(batch))
+
+        return detections
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _preprocess_async(self, images):
+        return [self._pool.apply_async(_preprocess_image, (image, self._image_width, self._image_height, self._pad_value))
+                for image in images]
+
+    def _detect_batch(self, batch):
+        model_inputs = np.asarray([b[0] for b in batch], dtype=np.float32)
+        dims = np.asarray([b[1] for b in batch], dtype=np.float32)
+
+        output = self._frcn_eval.eval({self._image_input: model_inputs, self._dims_input: dims})
+        out_dict = dict([(k.name, k) for k in output])
+
+        detections = []
+        for i, (_, _, img_stats) in enumerate(batch):
+            out_cls_pred = output[out_dict['cls_pred']][i]
+            out_rpn_rois = output[out_dict['rpn_rois']][i]
+            out_bbox_regr = output[out_dict['bbox_regr']][i]
+
+            labels = out_cls_pred.argmax(axis=1)
+            scores = out_cls_pred.max(axis=1)
+            regressed_rois = regress_rois(out_rpn_rois, out_bbox_regr, labels, dims[i])
+
+            nms_keep_indices = apply_nms_to_single_image_results(regressed_rois, labels, scores,
+                                                                 nms_threshold=self._nms_threshold,
+                                                                 conf_threshold=self._conf_threshold,
+                                                                 soft=self._nms_soft)
+            keep = np.array([k for k in nms_keep_indices if labels[k] > 0], dtype=np.int64)
+            boxes = _to_original_image_coords(regressed_rois[keep], img_stats, self._image_width, self._image_height)
+            detections.append({'boxes': boxes, 'scores': scores[keep], 'labels': labels[keep]})
+
+        return detections
+
+
+def _preprocess_image(image, pad_width, pad_height, pad_value):
+    img = _read_image(image) if isinstance(image, str) else image
+    img_height, img_width = img.shape[:2]
+    img_stats = _compute_image_stats(img_width, img_height, pad_width, pad_height)
+    model_arg_rep, _ = _resize_and_pad_image(img, img_stats, pad_value, False)
+
+    # dims -- (pad_width, pad_height, scaled_image_width, scaled_image_height, orig_img_width, orig_img_height)
+    dims = (pad_width, pad_height, img_stats[0], img_stats[1], img_width, img_height)
+    return model_arg_rep, dims, img_stats
+
+def _to_original_image_coords(boxes, img_stats, pad_width, pad_height):
+    target_w, target_h, img_width, img_height, top, bottom, left, right = img_stats
+    scale_factor = _get_scale_factor(img_width, img_height, pad_width, pad_height)
+
+    boxes = (np.asarray(boxes, dtype=np.float32).reshape((-1, 4)) - (left, top, left, top)) / scale_factor
+    boxes[:, 0::2] = boxes[:, 0::2].clip(0, img_width - 1)
+    boxes[:, 1::2] = boxes[:, 1::2].clip(0, img_height - 1)
+    return boxes.astype(np.float32)
@@ -0,0 +1,190 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import json
+import os
+import threading
+import zlib
+import numpy as np
+
+CACHE_VERSION = 1
+
+class PreprocessedImageCache:
+    '''
+    On-disk cache for resized and padded images in CNTK layout (uint8, CHW, not flipped).
+
+    All images are stored in fixed size slots of a single memory-mapped file per padded size. An index file maps
+    (image path, file mtime, pad value) to the slot, a crc32 checksum of the slot content and the image stats
+    that were computed while decoding the image. When the cache is full the least recently used slot is reused,
+    except for slots that are pinned by lookup() because a queued load job still has to read them.
+
+    The slot allocation is kept in memory, so a cache directory must not be used by several processes at the same
+    time. Data parallel workers use one directory per worker.
+    '''
+
+    def __init__(self, cache_dir, pad_width, pad_height, max_bytes, flush_interval=100):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.slot_shape = (3, pad_height, pad_width)
+        self.slot_bytes = 3 * pad_height * pad_width
+        self.num_slots = int(max_bytes // self.slot_bytes)
+        assert self.num_slots > 0, "The image cache size is smaller than a single padded image"
+
+        base_name = "padded_{}x{}".format(pad_width, pad_height)
+        self.slab_file = os.path.join(cache_dir, base_name + ".bin")
+        self._index_file = os.path.join(cache_dir, base_name + ".json")
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._dirty = 0
+        # number of pending reads per slot, pinned slots are not reused
+        self._pinned_slots = {}
+
+        self._entries = self._load_index()
+        if self._entries is None:
+            self._entries = {}
+            self._slab = np.memmap(self.slab_file, dtype=np.uint8, mode='w+',
+                                   shape=(self.num_slots,) + self.slot_shape)
+            self._write_index()
+        else:
+            self._slab = np.memmap(self.slab_file, dtype=np.uint8, mode='r+',
+                                   shape=(self.num_slots,) + self.slot_shape)
+
+        used_slots = set(entry[0] for entry in self._entries.values())
+        self._free_slots = [slot for slot in range(self.num_slots - 1, -1, -1) if slot not in used_slots]
+        self._clock = max([entry[2] for entry in self._entries.values()] + [0])
+
+    def lookup(self, image_path, pad_value, pin=False):
+        '''
+        Returns the cache entry (slot, crc32, last_used, img_stats) for the given image or None on a cache miss.
+        With pin=True the slot of the entry is not reused until unpin() is called with the entry.
+        '''
+        key = _cache_key(image_path, pad_value)
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._clock += 1
+                entry[2] = self._clock
+                if pin:
+                    self._pinned_slots[entry[0]] = self._pinned_slots.get(entry[0], 0) + 1
+            return None if entry is None else tuple(entry)
+
+    def unpin(self, cache_entry):
+        slot = cache_entry[0]
+        with self._lock:
+            self._pinned_slots[slot] -= 1
+            if self._pinned_slots[slot] == 0:
+                del self._pinned_slots[slot]
+
+    def put(self, image_path, pad_value, padded_image, img_stats):
+        '''
+        Stores a resized and padded uint8 CHW image (not flipped) together with its image stats.
+        '''
+        key = _cache_key(image_path, pad_value)
+        if key is None:
+            return
+
+        assert padded_image.shape == self.slot_shape and padded_image.dtype == np.uint8
+        padded_image = np.ascontiguousarray(padded_image)
+        with self._lock:
+            if key in self._entries:
+                return
+
+            # an invalidated slot can still be pinned by a queued job of the same image
+            slot = next((s for s in reversed(self._free_slots) if s not in self._pinned_slots), None)
+            if slot is not None:
+                self._free_slots.remove(slot)
+            else:
+                unpinned_keys = [k for k in self._entries if self._entries[k][0] not in self._pinned_slots]
+                if len(unpinned_keys) == 0:
+                    return
+                lru_key = min(unpinned_keys, key=lambda k: self._entries[k][2])
+                slot = self._entries.pop(lru_key)[0]
+
+            self._slab[slot] = padded_image
+            self._clock += 1
+            self._entries[key] = [slot, _checksum(padded_image), self._clock, [int(x) for x in img_stats]]
+
+            self._dirty += 1
+            if self._dirty >= self._flush_interval:
+                self._flush()
+
+    def invalidate(self, image_path, pad_value):
+        key = _cache_key(image_path, pad_value)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._free_slots.append(entry[0])
+                self._dirty += 1
+
+    def flush(self):
+        with self._lock:
+            if self._dirty > 0:
+                self._flush()
+
+    def _flush(self):
+        # the slot content has to be on disk before the index that references it
+        self._slab.flush()
+        self._write_index()
+        self._dirty = 0
+
+    def _write_index(self):
+        index = {'version': CACHE_VERSION,
+                 'num_slots': self.num_slots,
+                 'slot_shape': list(self.slot_shape),
+                 'entries': self._entries}
+        tmp_file = self._index_file + ".{}.tmp".format(os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self._index_file)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_file) or not os.path.exists(self.slab_file):
+            return None
+        try:
+            with open(self._index_file, 'r') as f:
+                index = json.load(f)
+        except ValueError:
+            print("Warning: image cache index {} is corrupt, resetting the cache".format(self._index_file))
+            return None
+
+        # the cache is rebuilt if the slab geometry changed, e.g. because of a different cache size
+        if index.get('version') != CACHE_VERSION or index.get('num_slots') != self.num_slots or \
+                tuple(index.get('slot_shape', ())) != self.slot_shape or \
+                os.path.getsize(self.slab_file) != self.num_slots * self.slot_bytes:
+            return None
+        return index['entries']
+
+
+def load_cached_image(slab_file, slot_shape, cache_entry, flip):
+    '''
+    Reads an image from the cache slab and converts it to the float32 CHW representation used as network input.
+    Returns None if the slot content does not match the checksum stored in the cache index.
+    '''
+    slot, crc, _, img_stats = cache_entry
+    slot_bytes = int(np.prod(slot_shape))
+    padded_image = np.array(np.memmap(slab_file, dtype=np.uint8, mode='r', offset=slot * slot_bytes, shape=slot_shape))
+    if _checksum(padded_image) != crc:
+        return None
+
+    if flip:
+        padded_image = padded_image[:, :, ::-1]
+    return np.ascontiguousarray(padded_image, dtype=np.float32)
+
+def _checksum(padded_image):
+    return zlib.crc32(memoryview(padded_image)) & 0xffffffff
+
+def _cache_key(image_path, pad_value):
+    # images inside zip archives are keyed by the mtime of the archive
+    file_path = image_path[:image_path.find('@')] if "@" in image_path else image_path
+    try:
+        mtime = os.path.getmtime(file_path)
+    except OSError:
+        return None
+    return "{}|{!r}|{}".format(os.path.abspath(image_path), mtime, np.atleast_1d(pad_value).tolist())
@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import io
+import os
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+try:
+    from PIL import Image # pip install Pillow
+except ImportError:
+    Image = None
+
+SIZES_VERSION = 1
+
+# EXIF orientations 5 to 8 rotate the image by 90 degrees, OpenCV applies them while decoding
+_EXIF_ORIENTATION_TAG = 0x0112
+_TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+
+def image_sizes_path(img_map_file):
+    # the probed sizes are kept next to the image map file, e.g. train_img_file.txt -> train_img_file_sizes.npz
+    return os.path.splitext(img_map_file)[0] + "_sizes.npz"
+
+def load_image_sizes(image_paths, sizes_file, zip_archives, num_workers=8):
+    '''
+    Returns the (width, height) of every image as int32 array of shape (len(image_paths), 2) or None if PIL is not
+    installed. The sizes are read from the image headers with PIL without decoding the pixels. Images that cannot be
+    probed have the size (0, 0).
+
+    The sizes are stored in sizes_file together with the modification times of the image files (of the archive for
+    images in zip archives), later calls only probe the images that were added or changed.
+    '''
+    if Image is None:
+        return None
+
+    stored = _load_sizes_file(sizes_file)
+    mtimes = np.array([_get_mtime(path) for path in image_paths], dtype=np.float64)
+    sizes = np.zeros((len(image_paths), 2), dtype=np.int32)
+    to_probe = []
+    for i, path in enumerate(image_paths):
+        entry = stored.get(path)
+        if entry is not None and entry[0] == mtimes[i]:
+            sizes[i] = entry[1]
+        else:
+            to_probe.append(i)
+    if len(to_probe) == 0:
+        return sizes
+
+    # probing reads only a few KB per image, the threads overlap the file accesses
+    pool = ThreadPool(max(1, num_workers))
+    try:
+        probed = pool.map(lambda i: probe_image_size(image_paths[i], zip_archives), to_probe)
+    finally:
+        pool.close()
+        pool.join()
+    sizes[to_probe] = probed
+
+    try:
+        _write_sizes_file(sizes_file, image_paths, mtimes, sizes)
+    except (IOError, OSError) as e:
+        print("Warning: could not store the image sizes in {}: {}".format(sizes_file, e))
+    return sizes
+
+def probe_image_size(image_path, zip_archives):
+    '''
+    Returns the (width, height) of an image as decoded by OpenCV, i.e. after applying the EXIF orientation,
+    or (0, 0) if the image header cannot be read.
+    '''
+    try:
+        if "@" in image_path:
+            at = str.find(image_path, '@')
+            data = zip_archives.read(image_path[:at], image_path[(at + 2):])
+            img = Image.open(io.BytesIO(data))
+        else:
+            img = Image.open(image_path)
+        with img:
+            width, height = img.size # this does not load the full image
+            if _exif_orientation(img) in _TRANSPOSING_ORIENTATIONS:
+                width, height = height, width
+    except Exception:
+        return 0, 0
+    return width, height
+
+def _exif_orientation(img):
+    try:
+        # older PIL versions only provide the EXIF data of JPEG images
+        exif = img.getexif() if hasattr(img, 'getexif') else getattr(img, '_getexif', lambda: None)()
+    except Exception:
+        return 1
+    return exif.get(_EXIF_ORIENTATION_TAG, 1) if exif else 1
+
+def _get_mtime(image_path):
+    file_path = image_path[:image_path.find('@')] if "@" in image_path else image_path
+    try:
+        return os.path.getmtime(file_path)
+    except OSError:
+        return np.nan
+
+def _load_sizes_file(sizes_file):
+    # returns a dictionary from image path to (mtime, (width, height))
+    if not os.path.exists(sizes_file):
+        return {}
+    try:
+        with np.load(sizes_file) as stored:
+            if int(stored['version']) != SIZES_VERSION:
+                return {}
+            return {path: (mtime, size) for path, mtime, size in
+                    zip(stored['paths'].tolist(), stored['mtimes'].tolist(), stored['sizes'])}
+    except (IOError, OSError, ValueError, KeyError):
+        print("Warning: image sizes file {} is corrupt, probing the images again".format(sizes_file))
+        return {}
+
+def _write_sizes_file(sizes_file, image_paths, mtimes, sizes):
+    tmp_file = sizes_file + ".{}.tmp".format(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, version=np.int64(SIZES_VERSION), paths=np.array(image_paths, dtype=np.str_),
+                 mtimes=mtimes, sizes=sizes)
+    os.replace(tmp_file, sizes_file)
@@ -12,14 +12,19 @@ import numpy as np
 class ObjectDetectionMinibatchSource(UserMinibatchSource):
     def __init__(self, img_map_file, roi_map_file, max_annotations_per_image,
                  pad_width, pad_height, pad_value, randomize, use_flipping,
-                 max_images=None, buffered_rpn_proposals=None):
+                 max_images=None, buffered_rpn_proposals=None,
+                 prefetch_queue_depth=0, prefetch_num_workers=1, prefetch_use_processes=False,
+                 image_cache_dir=None, image_cache_max_bytes=0, shuffle_seed=None, probe_image_sizes=False):
 
+        self._max_annotations_per_image = max_annotations_per_image
         self.image_si = StreamInformation("image", 0, 'dense', np.float32, (3, pad_height, pad_width,))
         self.roi_si = StreamInformation("annotation", 1, 'dense', np.float32, (max_annotations_per_image, 5,))
         self.dims_si = StreamInformation("dims", 1, 'dense', np.float32, (4,))
 
         self.od_reader = ObjectDetectionReader(img_map_file, roi_map_file, max_annotations_per_image,
-                 pad_width, pad_height, pad_value, randomize, use_flipping, max_images, buffered_rpn_proposals)
+                 pad_width, pad_height, pad_value, randomize, use_flipping, max_images, buffered_rpn_proposals,
+                 prefetch_queue_depth, prefetch_num_workers, prefetch_use_processes,
+                 image_cache_dir, image_cache_max_bytes, shuffle_seed, probe_image_sizes)
 
         super(ObjectDetectionMinibatchSource, self).__init__()
 
@@ -35,29 +40,52 @@ class ObjectDetectionMinibatchSource(UserMinibatchSource):
     def dims_si(self):
         return self.dims_si
 
-    def next_minibatch(self, num_samples, number_of_workers=1, worker_rank=1, device=None, input_map=None):
+    def close(self):
+        self.od_reader.close()
+
+    def next_minibatch(self, num_samples, number_of_workers=1, worker_rank=0, device=None, input_map=None):
         result, _ =  self.next_minibatch_with_proposals(num_samples, number_of_workers, worker_rank, device, input_map)
         return result
 
-    def next_minibatch_with_proposals(self, num_samples, number_of_workers=1, worker_rank=1, device=None, input_map=None):
-        if num_samples > 1:
-            print("Only single item mini batches are supported currently by od_mb_source.py")
-            exit(1)
+    def next_minibatch_with_proposals(self, num_samples, number_of_workers=1, worker_rank=0, device=None, input_map=None):
+        result, _, buffered_proposals = self._next_samples(num_samples, number_of_workers, worker_rank, input_map)
+        return result, buffered_proposals
+
+    def next_minibatch_with_dims(self, num_samples, number_of_workers=1, worker_rank=0, device=None, input_map=None):
+        # also returns the dims of the images as numpy array, e.g. for post-processing the network outputs
+        result, img_dims, _ = self._next_samples(num_samples, number_of_workers, worker_rank, input_map)
+        return result, img_dims
 
-        img_data, roi_data, img_dims, buffered_proposals = self.od_reader.get_next_input()
-        sweep_end = self.od_reader.sweep_end()
+    def _next_samples(self, num_samples, number_of_workers, worker_rank, input_map):
+        self.od_reader.set_worker_shard(number_of_workers, worker_rank)
+
+        # the reader writes the annotations of every image directly into the zero initialized minibatch array
+        roi_data = np.zeros((num_samples, self._max_annotations_per_image, 5), dtype=np.float32)
+        img_data, img_dims, buffered_proposals = [], [], []
+        sweep_end = False
+        for i in range(num_samples):
+            img, _, dims, proposals = self.od_reader.get_next_input(roi_out=roi_data[i])
+            img_data.append(img)
+            img_dims.append(dims)
+            buffered_proposals.append(proposals)
+            sweep_end = sweep_end or self.od_reader.sweep_end()
+
+        # stack the samples along the batch axis
+        img_data = np.asarray(img_data, dtype=np.float32)
+        img_dims = np.asarray(img_dims, dtype=np.float32)
+        buffered_proposals = None if buffered_proposals[0] is None else np.asarray(buffered_proposals, dtype=np.float32)
 
         if input_map is None:
             result = {
-                self.image_si: MinibatchData(Value(batch=img_data), 1, 1, sweep_end),
-                self.roi_si:   MinibatchData(Value(batch=roi_data), 1, 1, sweep_end),
-                self.dims_si:  MinibatchData(Value(batch=np.asarray(img_dims, dtype=np.float32)), 1, 1, sweep_end),
+                self.image_si: MinibatchData(Value(batch=img_data), num_samples, num_samples, sweep_end),
+                self.roi_si:   MinibatchData(Value(batch=roi_data), num_samples, num_samples, sweep_end),
+                self.dims_si:  MinibatchData(Value(batch=img_dims), num_samples, num_samples, sweep_end),
             }
         else:
             result = {
-                input_map[self.image_si]: MinibatchData(Value(batch=np.asarray(img_data, dtype=np.float32)), 1, 1, sweep_end),
-                input_map[self.roi_si]:   MinibatchData(Value(batch=np.asarray(roi_data, dtype=np.float32)), 1, 1, sweep_end),
-                input_map[self.dims_si]:  MinibatchData(Value(batch=np.asarray(img_dims, dtype=np.float32)), 1, 1, sweep_end),
+                input_map[self.image_si]: MinibatchData(Value(batch=img_data), num_samples, num_samples, sweep_end),
+                input_map[self.roi_si]:   MinibatchData(Value(batch=roi_data), num_samples, num_samples, sweep_end),
+                input_map[self.dims_si]:  MinibatchData(Value(batch=img_dims), num_samples, num_samples, sweep_end),
             }
 
-        return result, buffered_proposals
+        return result, img_dims, buffered_proposals
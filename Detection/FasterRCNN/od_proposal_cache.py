@@ -0,0 +1,118 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import hashlib
+import json
+import os
+import numpy as np
+
+CACHE_VERSION = 1
+
+class BufferedProposals:
+    '''
+    Read-only view on the rpn proposals of a training set that were stored by ProposalCacheWriter.
+
+    The proposals of all images are stored as int16 (x_min, y_min, x_max, y_max) rows in a single memory-mapped
+    file, an offset index maps image i to the rows offsets[i]:offsets[i+1]. Indexing returns the proposals of one
+    image, so only the images that are currently read have to be in memory.
+    '''
+
+    def __init__(self, data_file, offsets):
+        self.data_file = data_file
+        self._offsets = offsets
+        self._rows = None
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if self._rows is None:
+            num_rows = int(self._offsets[-1])
+            # np.memmap cannot map an empty file
+            self._rows = np.memmap(self.data_file, dtype=np.int16, mode='r', shape=(num_rows, 4)) \
+                if num_rows > 0 else np.zeros((0, 4), dtype=np.int16)
+        return np.array(self._rows[self._offsets[index]:self._offsets[index + 1]])
+
+    def __getstate__(self):
+        # the memory map is reopened after unpickling, e.g. in prefetch worker processes
+        state = self.__dict__.copy()
+        state['_rows'] = None
+        return state
+
+
+class ProposalCacheWriter:
+    '''
+    Appends the proposals of one image after the other to the data file of a proposal cache entry.
+    The entry becomes visible to load_proposals only when close() writes its index.
+    '''
+
+    def __init__(self, cache_dir, key):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._data_file, self._index_file = _cache_files(cache_dir, key)
+        # concurrent runs that compute the same proposals write their own temporary files
+        self._tmp_suffix = ".{}.tmp".format(os.getpid())
+        self._file = open(self._data_file + self._tmp_suffix, 'wb')
+        self._offsets = [0]
+
+    def append(self, proposals):
+        rows = np.ascontiguousarray(np.asarray(proposals).reshape((-1, 4)), dtype=np.int16)
+        self._file.write(rows.tobytes())
+        self._offsets.append(self._offsets[-1] + len(rows))
+
+    def close(self):
+        '''
+        Finishes the cache entry and returns the stored proposals as BufferedProposals.
+        '''
+        self._file.close()
+        os.replace(self._data_file + self._tmp_suffix, self._data_file)
+
+        index = {'version': CACHE_VERSION, 'offsets': self._offsets}
+        with open(self._index_file + self._tmp_suffix, 'w') as f:
+            json.dump(index, f)
+        os.replace(self._index_file + self._tmp_suffix, self._index_file)
+
+        return BufferedProposals(self._data_file, np.asarray(self._offsets, dtype=np.int64))
+
+
+def load_proposals(cache_dir, key, num_images):
+    '''
+    Returns the cached proposals for the given key as BufferedProposals or None if there is no complete cache entry
+    with proposals for num_images images.
+    '''
+    data_file, index_file = _cache_files(cache_dir, key)
+    if not os.path.exists(index_file) or not os.path.exists(data_file):
+        return None
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except ValueError:
+        print("Warning: proposal cache index {} is corrupt, computing the proposals again".format(index_file))
+        return None
+
+    offsets = np.asarray(index.get('offsets', []), dtype=np.int64)
+    if index.get('version') != CACHE_VERSION or len(offsets) != num_images + 1 or \
+            os.path.getsize(data_file) != offsets[-1] * 4 * np.dtype(np.int16).itemsize:
+        return None
+    return BufferedProposals(data_file, offsets)
+
+def proposal_cache_key(rpn_model, settings):
+    '''
+    Returns a hash of the parameter values of the rpn model and of a dictionary with the settings that influence
+    the proposals, e.g. the nms parameters of the proposal layer and the training data.
+    '''
+    h = hashlib.sha1()
+    h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    for p in rpn_model.parameters:
+        value = np.ascontiguousarray(p.value)
+        h.update("{}{}".format(p.name, value.shape).encode('utf-8'))
+        h.update(value.tobytes())
+    return h.hexdigest()
+
+def _cache_files(cache_dir, key):
+    base_name = os.path.join(cache_dir, "proposals_{}".format(key))
+    return base_name + ".bin", base_name + ".json"
@@ -4,11 +4,17 @@
 # for full license information.
 # ==============================================================================
 
-import zipfile
 import cv2 # pip install opencv-python
 import numpy as np
 import os
+import time
 import pdb
+from collections import deque
+from multiprocessing.pool import Pool, ThreadPool
+from od_image_cache import PreprocessedImageCache, load_cached_image
+from od_zip_archives import ZipArchivePool
+from od_image_sizes import image_sizes_path, load_image_sizes
+from utils.annotations.annotations_helper import load_annotations
 
 DEBUG = False
 if DEBUG:
@@ -18,7 +24,9 @@ if DEBUG:
 class ObjectDetectionReader:
     def __init__(self, img_map_file, roi_map_file, max_annotations_per_image,
                  pad_width, pad_height, pad_value, randomize, use_flipping,
-                 max_images=None, buffered_rpn_proposals=None):
+                 max_images=None, buffered_rpn_proposals=None,
+                 prefetch_queue_depth=0, prefetch_num_workers=1, prefetch_use_processes=False,
+                 image_cache_dir=None, image_cache_max_bytes=0, shuffle_seed=None, probe_image_sizes=False):
         self._pad_width = pad_width
         self._pad_height = pad_height
         self._pad_value = pad_value
@@ -26,37 +34,189 @@ class ObjectDetectionReader:
         self._use_flipping = use_flipping
         self._flip_image = True # will be set to False in the first call to _reset_reading_order
         self._buffered_rpn_proposals = buffered_rpn_proposals
+        self._max_annotations_per_image = max_annotations_per_image
+        # the annotations are padded into a buffer that is reused for every image, only the rows written for the
+        # previous image have to be cleared
+        self._roi_buffer = np.zeros((max_annotations_per_image, 5), dtype=np.float32)
+        self._roi_buffer_rows = 0
         self._img_file_paths = []
-        self._gt_annotations = []
+        # the ground truth rows of image i are self._gt_boxes[self._gt_offsets[i]:self._gt_offsets[i+1]]. They are
+        # scaled to the padded image once its stats are known, self._gt_raw_boxes keeps the original coordinates
+        self._gt_offsets = None
+        self._gt_raw_boxes = None
+        self._gt_boxes = None
 
         self._num_images = self._parse_map_files(img_map_file, roi_map_file, max_annotations_per_image, max_images)
         self._img_stats = [None for _ in range(self._num_images)]
+        if probe_image_sizes:
+            # the image sizes are read from the image headers, so the annotations and image stats of all images
+            # are prepared before the first image is decoded
+            sizes = load_image_sizes(self._img_file_paths, image_sizes_path(img_map_file), _zip_archives)
+            if sizes is not None:
+                self._prepare_all_annotations_and_image_stats(sizes)
 
         self._reading_order = None
         self._reading_index = -1
-        
-    def get_next_input(self):
+        self._sweep_end = False
+
+        # data parallel training: every worker reads a disjoint shard of the same shuffled reading order.
+        # The shuffle of sweep i uses the seed shuffle_seed + i, so all workers agree on the reading order.
+        self._shuffle_seed = shuffle_seed
+        self._sweep_count = 0
+        self._sweep_length = self._num_images
+        self._num_workers = 1
+        self._worker_rank = 0
+
+        # prefetching: a bounded queue of (index, flip, sweep_end, async_result) entries in reading order
+        self._prefetch_queue_depth = prefetch_queue_depth
+        self._prefetch_queue = deque()
+        self._prefetch_pool = None
+        if prefetch_queue_depth > 0:
+            pool_type = Pool if prefetch_use_processes else ThreadPool
+            self._prefetch_pool = pool_type(max(1, prefetch_num_workers))
+        self._num_consumed = 0
+        self._num_stalls = 0
+        self._wait_time = 0.0
+
+        # resized and padded images are cached on disk to skip decoding in later epochs and runs
+        self._image_cache = None
+        if image_cache_dir is not None and image_cache_max_bytes > 0:
+            self._image_cache = PreprocessedImageCache(image_cache_dir, pad_width, pad_height, image_cache_max_bytes)
+
+    def get_next_input(self, roi_out=None):
         '''
         Reads image data and return image, annotations and shape information
+        :param roi_out: optional zero initialized float32 array of shape (max_annotations_per_image, 5) that receives the annotations
         :return:
         img_data - The image data in CNTK format. The image is scale to fit into the size given in the constructor, centered and padded.
         roi_data - The ground truth annotations as numpy array of shape (max_annotations_per_image, 5), i.e. 4 coords + label per roi.
+                   This is roi_out if given, otherwise a buffer of the reader that is overwritten by the next call.
         img_dims - (pad_width, pad_height, scaled_image_width, scaled_image_height, orig_img_width, orig_img_height)
         '''
 
-        index = self._get_next_image_index()
-        roi_data = self._get_gt_annotations(index)
+        if self._prefetch_pool is None:
+            index = self._get_next_image_index()
+            flip = self._flip_image
+            self._sweep_end = self._reading_index >= self._sweep_length
+            load_func, load_args, cache_entry = self._create_load_job(index, flip)
+            result = load_func(*load_args)
+        else:
+            index, flip, cache_entry, result = self._get_prefetched_image()
+
+        img_data, img_stats, resized_with_pad = self._finish_load_job(index, flip, cache_entry, result)
+
+        img_dims = self._get_image_dims(index, img_stats)
+        roi_data = self._get_gt_annotations(index, flip, roi_out)
         if DEBUG:
-            img_data, img_dims, resized_with_pad = self._load_resize_and_pad_image(index)
             self._debug_plot(resized_with_pad, roi_data)
-        else:
-            img_data, img_dims = self._load_resize_and_pad_image(index)
-        buffered_proposals = self._get_buffered_proposals(index)
+        buffered_proposals = self._get_buffered_proposals(index, flip)
 
         return img_data, roi_data, img_dims, buffered_proposals
 
     def sweep_end(self):
-        return self._reading_index >= self._num_images
+        return self._sweep_end
+
+    def set_worker_shard(self, num_workers, worker_rank):
+        '''
+        Selects the shard of the data that is read by this worker. The change takes effect at the start of the next sweep.
+        '''
+        assert num_workers > 0 and 0 <= worker_rank < num_workers, \
+            "Invalid worker rank {} for {} workers".format(worker_rank, num_workers)
+        self._num_workers = num_workers
+        self._worker_rank = worker_rank
+
+    def prefetch_stats(self):
+        '''
+        Returns counters describing how long the consumer waited for prefetched images:
+        num_samples - number of images handed out from the prefetch queue
+        num_stalls  - number of images that were not decoded yet when they were requested
+        wait_time   - total time in seconds the consumer spent blocked on the prefetch queue
+        '''
+        return {'num_samples': self._num_consumed, 'num_stalls': self._num_stalls, 'wait_time': self._wait_time}
+
+    def reset_prefetch_stats(self):
+        self._num_consumed = 0
+        self._num_stalls = 0
+        self._wait_time = 0.0
+
+    def close(self):
+        '''
+        Stops the prefetching workers and flushes the image cache. Images that were prefetched but not read are dropped.
+        '''
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.close()
+            self._prefetch_pool.join()
+            self._prefetch_pool = None
+        for _, _, _, cache_entry, _ in self._prefetch_queue:
+            if cache_entry is not None:
+                self._image_cache.unpin(cache_entry)
+        self._prefetch_queue.clear()
+        if self._image_cache is not None:
+            self._image_cache.flush()
+
+    def _fill_prefetch_queue(self, start_new_sweep):
+        while len(self._prefetch_queue) < self._prefetch_queue_depth:
+            # Without a shuffle seed the shuffle for the next sweep draws from the global numpy RNG. Do not cross the sweep boundary
+            # before the consumer asks for the first image of the next sweep, so the reading order is the
+            # same as without prefetching.
+            if self._randomize and self._shuffle_seed is None and self._num_workers == 1 and \
+                    self._reading_index >= self._sweep_length and \
+                    not (start_new_sweep and len(self._prefetch_queue) == 0):
+                break
+
+            index = self._get_next_image_index()
+            flip = self._flip_image
+            sweep_end = self._reading_index >= self._sweep_length
+            load_func, load_args, cache_entry = self._create_load_job(index, flip)
+            async_result = self._prefetch_pool.apply_async(load_func, load_args)
+            self._prefetch_queue.append((index, flip, sweep_end, cache_entry, async_result))
+
+    def _get_prefetched_image(self):
+        self._fill_prefetch_queue(start_new_sweep=True)
+        index, flip, sweep_end, cache_entry, async_result = self._prefetch_queue.popleft()
+
+        self._num_consumed += 1
+        if not async_result.ready():
+            self._num_stalls += 1
+        start = time.time()
+        result = async_result.get()
+        self._wait_time += time.time() - start
+
+        self._sweep_end = sweep_end
+        self._fill_prefetch_queue(start_new_sweep=False)
+        return index, flip, cache_entry, result
+
+    def _create_load_job(self, index, flip):
+        # returns the function and arguments that load the image, either from the image cache or from its file
+        image_path = self._img_file_paths[index]
+        cache_entry = None
+        if self._image_cache is not None:
+            # the slot is pinned until the job is finished, so that it is not reused before it is read
+            cache_entry = self._image_cache.lookup(image_path, self._pad_value, pin=True)
+        if cache_entry is not None:
+            return load_cached_image, (self._image_cache.slab_file, self._image_cache.slot_shape, cache_entry, flip), cache_entry
+
+        return _load_resize_and_pad_image, (image_path, self._img_stats[index], self._pad_width, self._pad_height,
+                                            self._pad_value, flip, self._image_cache is not None), None
+
+    def _finish_load_job(self, index, flip, cache_entry, result):
+        image_path = self._img_file_paths[index]
+        if cache_entry is not None:
+            self._image_cache.unpin(cache_entry)
+            if result is not None:
+                return result, cache_entry[3], None
+
+            print("Warning: cached image for {} is corrupt, decoding it again".format(image_path))
+            self._image_cache.invalidate(image_path, self._pad_value)
+            result = _load_resize_and_pad_image(image_path, self._img_stats[index], self._pad_width, self._pad_height,
+                                                self._pad_value, flip, True)
+
+        img_data, img_stats, resized_with_pad, cacheable_image = result
+        if self._image_cache is not None:
+            self._image_cache.put(image_path, self._pad_value, cacheable_image, img_stats)
+            if self._sweep_end:
+                self._image_cache.flush()
+        return img_data, img_stats, resized_with_pad
 
     def _debug_plot(self, img_data, roi_data):
         color = (0, 255, 0)
@@ -85,32 +245,23 @@ class ObjectDetectionReader:
         img_base_path = os.path.dirname(os.path.abspath(img_map_file))
         self._img_file_paths = [os.path.join(img_base_path, x.split('\t')[1]) for x in img_map_lines]
 
-        # read roi map file
-        with open(roi_map_file) as f:
-            roi_map_lines = f.readlines()
-        # TODO: check whether this avoids reading empty lines
-        roi_map_lines = [line for line in roi_map_lines if len(line) > 0]
+        # parse the central directory of every zip archive only once
+        for archive_path in sorted(set(x[:x.find('@')] for x in self._img_file_paths if "@" in x)):
+            _zip_archives.build_index(archive_path)
+
+        # read the annotations from the annotation store next to the roi map file or parse the roi map file
+        roi_sequence_numbers, offsets, boxes = load_annotations(roi_map_file)
         if max_images is not None:
-            roi_map_lines = roi_map_lines[:max_images]
-        roi_sequence_numbers = []
-        for roi_line in roi_map_lines:
-            roi_sequence_numbers.append(int(roi_line[:roi_line.find(' ')]))
-            rest = roi_line[roi_line.find(' ')+1:]
-            bbox_input = rest[rest.find(' ')+1:]
-            bbox_floats = np.fromstring(bbox_input, dtype=np.float32, sep=' ')
-            num_floats = len(bbox_floats)
-            assert num_floats % 5 == 0, "Ground truth annotation file is corrupt. Lines must contain 4 coordinates and a label per roi."
-            annotations = np.zeros((max_annotations_per_image, 5))
-            num_annotations = int(num_floats / 5)
-
-            if num_annotations > max_annotations_per_image:
-                print('Warning: The number of ground truth annotations ({}) is larger than the provided maximum number ({}).'
-                      .format(num_annotations, max_annotations_per_image))
-                bbox_floats = bbox_floats[:(max_annotations_per_image * 5)]
-                num_annotations = max_annotations_per_image
-
-            annotations[:num_annotations,:] = np.array(bbox_floats).reshape((num_annotations, 5))
-            self._gt_annotations.append(annotations)
+            roi_sequence_numbers = roi_sequence_numbers[:max_images]
+            offsets = offsets[:max_images + 1]
+        self._gt_offsets = offsets
+        self._gt_raw_boxes = np.array(boxes[:offsets[-1]], dtype=np.float32)
+        self._gt_boxes = self._gt_raw_boxes.copy()
+
+        num_annotations = np.diff(offsets)
+        for count in num_annotations[num_annotations > max_annotations_per_image]:
+            print('Warning: The number of ground truth annotations ({}) is larger than the provided maximum number ({}), '
+                  'only the first {} are used.'.format(count, max_annotations_per_image, max_annotations_per_image))
 
         # make sure sequence numbers match
         assert len(img_sequence_numbers) == len(roi_sequence_numbers), "number of images and annotation lines do not match"
@@ -121,110 +272,180 @@ class ObjectDetectionReader:
     def _reset_reading_order(self):
         self._reading_order = np.arange(self._num_images)
         if self._randomize:
-            np.random.shuffle(self._reading_order)
+            if self._shuffle_seed is None and self._num_workers == 1:
+                np.random.shuffle(self._reading_order)
+            else:
+                # all workers have to use the same shuffle, workers fall back to seed 0 if no seed is given
+                shuffle_seed = 0 if self._shuffle_seed is None else self._shuffle_seed
+                np.random.RandomState(shuffle_seed + self._sweep_count).shuffle(self._reading_order)
         # if flipping should be used then we alternate between epochs from flipped to non-flipped
         self._flip_image = not self._flip_image if self._use_flipping else False
 
-        self._reading_index = 0
-
-    def _read_image(self, image_path):
-        if "@" in image_path:
-            at = str.find(image_path, '@')
-            zip_file = image_path[:at]
-            img_name = image_path[(at + 2):]
-            archive = zipfile.ZipFile(zip_file, 'r')
-            imgdata = archive.read(img_name)
-            imgnp = np.array(bytearray(imgdata), dtype=np.uint8)
-            img = cv2.imdecode(imgnp, 1)
-        else:
-            img = cv2.imread(image_path)
+        if self._num_workers > 1:
+            # wrap around to give every worker the same number of images per sweep, so that all workers
+            # report the end of a sweep for the same minibatch
+            shard_size = (self._num_images + self._num_workers - 1) // self._num_workers
+            padded_order = np.resize(self._reading_order, shard_size * self._num_workers)
+            self._reading_order = padded_order[self._worker_rank::self._num_workers]
 
-        return img
-
-    def _prepare_annotations_and_image_stats(self, index, img_width, img_height):
-        annotations = self._gt_annotations[index]
-        do_scale_w = img_width > img_height
-        target_w = self._pad_width
-        target_h = self._pad_height
-
-        if do_scale_w:
-            scale_factor = float(self._pad_width) / float(img_width)
-            target_h = int(np.round(img_height * scale_factor))
-        else:
-            scale_factor = float(self._pad_height) / float(img_height)
-            target_w = int(np.round(img_width * scale_factor))
+        self._sweep_count += 1
+        self._sweep_length = len(self._reading_order)
+        self._reading_index = 0
 
-        top = int(max(0, np.round((self._pad_height - target_h) / 2)))
-        left = int(max(0, np.round((self._pad_width - target_w) / 2)))
-        bottom = self._pad_height - top - target_h
-        right = self._pad_width - left - target_w
+    def _prepare_annotations_and_image_stats(self, index, img_stats):
+        start, end = self._gt_offsets[index], self._gt_offsets[index + 1]
+        target_w, target_h, img_width, img_height, top, bottom, left, right = img_stats
+        scale_factor = _get_scale_factor(img_width, img_height, self._pad_width, self._pad_height)
 
-        xyxy = annotations[:, :4]
-        xyxy *= scale_factor
+        # the coordinates are scaled in float64 and rounded, the rounded values are exact in float32
+        xyxy = self._gt_raw_boxes[start:end, :4].astype(np.float64) * scale_factor
         xyxy += (left, top, left, top)
 
-        # not needed since xyxy is just a reference: annotations[:, :4] = xyxy
         # TODO: do we need to round/floor/ceil xyxy coords?
-        annotations[:, 0] = np.round(annotations[:, 0])
-        annotations[:, 1] = np.round(annotations[:, 1])
-        annotations[:, 2] = np.round(annotations[:, 2])
-        annotations[:, 3] = np.round(annotations[:, 3])
+        self._gt_boxes[start:end, :4] = np.round(xyxy)
 
         # keep image stats for scaling and padding images later
-        img_stats = [target_w, target_h, img_width, img_height, top, bottom, left, right]
         self._img_stats[index] = img_stats
 
+    def _prepare_all_annotations_and_image_stats(self, sizes):
+        # same as _prepare_annotations_and_image_stats for every image with a known (width, height)
+        known = np.where((sizes[:, 0] > 0) & (sizes[:, 1] > 0))[0]
+        scale_and_offsets = np.zeros((self._num_images, 3))
+        for index in known:
+            img_width, img_height = int(sizes[index, 0]), int(sizes[index, 1])
+            img_stats = _compute_image_stats(img_width, img_height, self._pad_width, self._pad_height)
+            scale_and_offsets[index] = (_get_scale_factor(img_width, img_height, self._pad_width, self._pad_height),
+                                        img_stats[6], img_stats[4])
+            self._img_stats[index] = img_stats
+
+        # the image index of every annotation row
+        images = np.repeat(np.arange(self._num_images), np.diff(self._gt_offsets))
+        has_stats = np.zeros(self._num_images, dtype=bool)
+        has_stats[known] = True
+        rows = has_stats[images]
+        images = images[rows]
+        xyxy = self._gt_raw_boxes[rows, :4].astype(np.float64) * scale_and_offsets[images, 0:1]
+        xyxy += scale_and_offsets[images][:, [1, 2, 1, 2]]
+        self._gt_boxes[rows, :4] = np.round(xyxy)
+
     def _get_next_image_index(self):
-        if self._reading_index < 0 or self._reading_index >= self._num_images:
+        if self._reading_index < 0 or self._reading_index >= self._sweep_length:
             self._reset_reading_order()
         next_image_index = self._reading_order[self._reading_index]
         self._reading_index += 1
         return next_image_index
 
-    def _load_resize_and_pad_image(self, index):
-        image_path = self._img_file_paths[index]
-
-        img = self._read_image(image_path)
+    def _get_image_dims(self, index, img_stats):
+        # the image stats of an image are computed once while loading it for the first time, unless they were
+        # prepared from the probed image size. They are prepared again if the decoded image has a different size.
         if self._img_stats[index] is None:
-            img_width = len(img[0])
-            img_height = len(img)
-            self._prepare_annotations_and_image_stats(index, img_width, img_height)
-
-        target_w, target_h, img_width, img_height, top, bottom, left, right = self._img_stats[index]
-
-        resized = cv2.resize(img, (target_w, target_h), 0, 0, interpolation=cv2.INTER_NEAREST)
-        resized_with_pad = cv2.copyMakeBorder(resized, top, bottom, left, right, cv2.BORDER_CONSTANT,
-                                              value=self._pad_value)
-        if self._flip_image:
-            resized_with_pad = cv2.flip(resized_with_pad, 1)
-
-        # transpose(2,0,1) converts the image to the HWC format which CNTK accepts
-        model_arg_rep = np.ascontiguousarray(np.array(resized_with_pad, dtype=np.float32).transpose(2, 0, 1))
+            self._prepare_annotations_and_image_stats(index, img_stats)
+        elif list(self._img_stats[index]) != list(img_stats):
+            print("Warning: the decoded size of {} differs from its probed size".format(self._img_file_paths[index]))
+            self._prepare_annotations_and_image_stats(index, img_stats)
 
+        target_w, target_h, img_width, img_height, _, _, _, _ = self._img_stats[index]
         # dims = pad_width, pad_height, scaled_image_width, scaled_image_height, orig_img_width, orig_img_height
-        dims = (self._pad_width, self._pad_height, target_w, target_h, img_width, img_height)
-        if DEBUG:
-            return model_arg_rep, dims, resized_with_pad
-        return model_arg_rep, dims
-
-    def _get_gt_annotations(self, index):
-        annotations = self._gt_annotations[index]
-        if self._flip_image:
-            flipped_annotations = np.array(annotations)
-            flipped_annotations[:,0] = self._pad_width - annotations[:,2] - 1
-            flipped_annotations[:,2] = self._pad_width - annotations[:,0] - 1
-            return flipped_annotations
-        return annotations
-
-    def _get_buffered_proposals(self, index):
+        return (self._pad_width, self._pad_height, target_w, target_h, img_width, img_height)
+
+    def _get_gt_annotations(self, index, flip, out=None):
+        # only the stored boxes of the image are written, the rows after them are zero
+        annotations = self._gt_boxes[self._gt_offsets[index]:self._gt_offsets[index + 1]][:self._max_annotations_per_image]
+        num_annotations = len(annotations)
+        if out is None:
+            out = self._roi_buffer
+            out[num_annotations:self._roi_buffer_rows] = 0
+            self._roi_buffer_rows = num_annotations
+
+        out[:num_annotations] = annotations
+        if flip:
+            out[:num_annotations,0] = self._pad_width - annotations[:,2] - 1
+            out[:num_annotations,2] = self._pad_width - annotations[:,0] - 1
+        return out
+
+    def _get_buffered_proposals(self, index, flip):
         if self._buffered_rpn_proposals is None:
             return None
 
         buffered_proposals = self._buffered_rpn_proposals[index]
-        if self._flip_image:
+        if flip:
             flipped_proposals = np.array(buffered_proposals, dtype=np.float32)
             flipped_proposals[:,0] = self._pad_width - buffered_proposals[:,2] - 1
             flipped_proposals[:,2] = self._pad_width - buffered_proposals[:,0] - 1
             return flipped_proposals
         return buffered_proposals
 
+
+# The functions below are executed by the prefetching workers and hence do not access the reader object
+
+# open zip archives are shared by all readers and prefetching threads, worker processes open their own handles
+_zip_archives = ZipArchivePool()
+
+def _read_image(image_path):
+    if "@" in image_path:
+        at = str.find(image_path, '@')
+        zip_file = image_path[:at]
+        img_name = image_path[(at + 2):]
+        imgdata = _zip_archives.read(zip_file, img_name)
+        imgnp = np.frombuffer(imgdata, dtype=np.uint8)
+        img = cv2.imdecode(imgnp, 1)
+    else:
+        img = cv2.imread(image_path)
+
+    return img
+
+def _get_scale_factor(img_width, img_height, pad_width, pad_height):
+    if img_width > img_height:
+        return float(pad_width) / float(img_width)
+    return float(pad_height) / float(img_height)
+
+def _compute_image_stats(img_width, img_height, pad_width, pad_height):
+    do_scale_w = img_width > img_height
+    target_w = pad_width
+    target_h = pad_height
+
+    scale_factor = _get_scale_factor(img_width, img_height, pad_width, pad_height)
+    if do_scale_w:
+        target_h = int(np.round(img_height * scale_factor))
+    else:
+        target_w = int(np.round(img_width * scale_factor))
+
+    top = int(max(0, np.round((pad_height - target_h) / 2)))
+    left = int(max(0, np.round((pad_width - target_w) / 2)))
+    bottom = pad_height - top - target_h
+    right = pad_width - left - target_w
+
+    return [target_w, target_h, img_width, img_height, top, bottom, left, right]
+
+def _resize_and_pad_image(img, img_stats, pad_value, flip):
+    target_w, target_h, img_width, img_height, top, bottom, left, right = img_stats
+
+    resized = cv2.resize(img, (target_w, target_h), 0, 0, interpolation=cv2.INTER_NEAREST)
+    resized_with_pad = cv2.copyMakeBorder(resized, top, bottom, left, right, cv2.BORDER_CONSTANT,
+                                          value=pad_value)
+    if flip:
+        resized_with_pad = cv2.flip(resized_with_pad, 1)
+
+    # transpose(2,0,1) converts the image to the HWC format which CNTK accepts
+    model_arg_rep = np.ascontiguousarray(np.array(resized_with_pad, dtype=np.float32).transpose(2, 0, 1))
+    return model_arg_rep, resized_with_pad
+
+def _load_resize_and_pad_image(image_path, img_stats, pad_width, pad_height, pad_value, flip, return_cacheable=False):
+    img = _read_image(image_path)
+    img_width = len(img[0])
+    img_height = len(img)
+    # the given image stats are ignored if they were computed for a different image size, e.g. a wrong probed size
+    if img_stats is None or img_stats[2] != img_width or img_stats[3] != img_height:
+        img_stats = _compute_image_stats(img_width, img_height, pad_width, pad_height)
+
+    model_arg_rep, resized_with_pad = _resize_and_pad_image(img, img_stats, pad_value, flip)
+
+    # the image cache stores the non-flipped uint8 image in CNTK format
+    cacheable_image = None
+    if return_cacheable:
+        unflipped = resized_with_pad[:, ::-1] if flip else resized_with_pad
+        cacheable_image = np.ascontiguousarray(unflipped.transpose(2, 0, 1))
+
+    if DEBUG:
+        return model_arg_rep, img_stats, resized_with_pad, cacheable_image
+    return model_arg_rep, img_stats, None, cacheable_image
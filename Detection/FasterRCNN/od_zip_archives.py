@@ -0,0 +1,148 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import mmap
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+
+# size and layout of the local file header that precedes the data of every zip member
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_FORMAT = "<4s5H3L2H"
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+class ZipArchivePool:
+    '''
+    Thread-safe pool of open zip archives for images that are addressed as '<archive>@/<member>' in map files.
+
+    The central directory of every archive is parsed once into an index from member name to
+    (data offset, compression type, compressed size, file size, crc32). Stored and deflated members are read
+    through a memory-mapped view of the archive, other members through the zipfile module. At most
+    max_open_archives archives are kept open, the least recently used one is closed first.
+    '''
+
+    def __init__(self, max_open_archives=16):
+        assert max_open_archives > 0
+        self._max_open_archives = max_open_archives
+        self._lock = threading.Lock()
+        self._members = {}
+        self._handles = OrderedDict()
+        self._pid = os.getpid()
+
+    def build_index(self, archive_path):
+        self._get_members(archive_path)
+
+    def read(self, archive_path, member_name):
+        members = self._get_members(archive_path)
+        if member_name not in members:
+            raise KeyError("There is no item named '{}' in the archive {}".format(member_name, archive_path))
+        data_offset, compress_type, compress_size, file_size, crc = members[member_name]
+
+        handle = self._acquire(archive_path)
+        try:
+            if data_offset is None:
+                with handle.lock:
+                    return handle.zip_file.read(member_name)
+
+            raw = handle.mm[data_offset:data_offset + compress_size]
+        finally:
+            self._release(handle)
+
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(raw, -15)
+        else:
+            data = raw
+        if len(data) != file_size or (zlib.crc32(data) & 0xffffffff) != crc:
+            raise zipfile.BadZipfile("Bad CRC-32 for member '{}' in the archive {}".format(member_name, archive_path))
+        return data
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles.values():
+                handle.evicted = True
+                if handle.users == 0:
+                    handle.close()
+            self._handles.clear()
+
+    def _check_process(self):
+        # handles inherited from a parent process share its file offsets and are not used in forked workers
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._handles = OrderedDict()
+
+    def _get_members(self, archive_path):
+        members = self._members.get(archive_path)
+        if members is not None:
+            return members
+
+        handle = self._acquire(archive_path)
+        try:
+            with handle.lock:
+                members = _index_members(handle.zip_file, handle.mm)
+        finally:
+            self._release(handle)
+        with self._lock:
+            self._members[archive_path] = members
+        return members
+
+    def _acquire(self, archive_path):
+        with self._lock:
+            self._check_process()
+            handle = self._handles.get(archive_path)
+            if handle is None:
+                handle = _ArchiveHandle(archive_path)
+                self._handles[archive_path] = handle
+                while len(self._handles) > self._max_open_archives:
+                    _, lru_handle = self._handles.popitem(last=False)
+                    lru_handle.evicted = True
+                    if lru_handle.users == 0:
+                        lru_handle.close()
+            else:
+                self._handles.move_to_end(archive_path)
+            handle.users += 1
+            return handle
+
+    def _release(self, handle):
+        with self._lock:
+            handle.users -= 1
+            if handle.evicted and handle.users == 0:
+                handle.close()
+
+
+class _ArchiveHandle:
+    def __init__(self, archive_path):
+        self.file = open(archive_path, 'rb')
+        self.zip_file = zipfile.ZipFile(self.file, 'r')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        # the zipfile object reads through the shared file object and has to be used by one thread at a time
+        self.lock = threading.Lock()
+        self.users = 0
+        self.evicted = False
+
+    def close(self):
+        self.mm.close()
+        self.zip_file.close()
+        self.file.close()
+
+
+def _index_members(zip_file, mm):
+    members = {}
+    for info in zip_file.infolist():
+        # encrypted members and compression types other than stored and deflated are read via the zipfile module
+        data_offset = None
+        if info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) and not info.flag_bits & 0x1:
+            header = mm[info.header_offset:info.header_offset + _LOCAL_HEADER_SIZE]
+            if len(header) == _LOCAL_HEADER_SIZE:
+                fields = struct.unpack(_LOCAL_HEADER_FORMAT, header)
+                if fields[0] == _LOCAL_HEADER_SIGNATURE:
+                    name_length, extra_length = fields[9], fields[10]
+                    data_offset = info.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length
+        members[info.filename] = (data_offset, info.compress_type, info.compress_size, info.file_size, info.CRC)
+    return members
@@ -4,36 +4,54 @@
 # for full license information.
 # ==============================================================================
 
+import json
 import numpy as np
 import os
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
 
-def _getFilesInDirectory(directory, postfix = ""):
-    fileNames = [s for s in os.listdir(directory) if not os.path.isdir(os.path.join(directory, s))]
+ANNOTATION_STORE_VERSION = 1
+DATA_SET_INDEX_FILE = "dataset_index.json"
+DATA_SET_INDEX_VERSION = 1
+
+def _scanDirectory(directory):
+    # returns the names and modification times of the files in a directory, read with a single directory listing
+    files = OrderedDict()
+    for entry in os.scandir(directory):
+        if not entry.is_dir():
+            files[entry.name] = entry.stat().st_mtime
+    return files
+
+def _getFilesInDirectory(directory, postfix = "", fileNames = None):
+    if fileNames is None:
+        fileNames = list(_scanDirectory(directory))
     if not postfix or postfix == "":
         return fileNames
     else:
         return [s for s in fileNames if s.lower().endswith(postfix)]
 
-def _get_image_paths(img_dir, training_set):
-    if training_set:
-        subDirs = ['positive', 'negative']
-    else:
-        subDirs = ['testImages']
+def _get_sub_dirs(training_set):
+    return ['positive', 'negative'] if training_set else ['testImages']
 
+def _get_image_file_names(sub_dir_path, fileNames = None):
+    imgFilenames = _getFilesInDirectory(sub_dir_path, ".jpg", fileNames)
+    imgFilenames += _getFilesInDirectory(sub_dir_path, ".png", fileNames)
+    imgFilenames += _getFilesInDirectory(sub_dir_path, ".jpeg", fileNames)
+    imgFilenames += _getFilesInDirectory(sub_dir_path, ".JPEG", fileNames)
+    return imgFilenames
+
+def _get_image_paths(img_dir, training_set):
     image_paths = []
-    for subdir in subDirs:
+    for subdir in _get_sub_dirs(training_set):
         sub_dir_path = os.path.join(img_dir, subdir)
-        imgFilenames = _getFilesInDirectory(sub_dir_path, ".jpg")
-        imgFilenames += _getFilesInDirectory(sub_dir_path, ".png")
-        imgFilenames += _getFilesInDirectory(sub_dir_path, ".jpeg")
-        imgFilenames += _getFilesInDirectory(sub_dir_path, ".JPEG")
-
-
-        for img in imgFilenames:
+        for img in _get_image_file_names(sub_dir_path):
             image_paths.append("{}/{}".format(subdir, img))
 
     return image_paths
 
+def _get_annotation_paths(imgPath):
+    return imgPath[:-4] + ".bboxes.tsv", imgPath[:-4] + ".bboxes.labels.tsv"
+
 def _removeLineEndCharacters(line):
     if line.endswith(b'\r\n'):
         return line[:-2]
@@ -43,60 +61,234 @@ def _removeLineEndCharacters(line):
         return line
 
 def _load_annotation(imgPath, class_dict):
-    bboxesPaths = imgPath[:-4] + ".bboxes.tsv"
-    labelsPaths = imgPath[:-4] + ".bboxes.labels.tsv"
+    bboxesPaths, labelsPaths = _get_annotation_paths(imgPath)
     # if no ground truth annotations are available, return None
     if not os.path.exists(bboxesPaths) or not os.path.exists(labelsPaths):
         return None
-    bboxes = np.loadtxt(bboxesPaths, np.float32)
+    bboxes, labels = _parse_annotation_files((bboxesPaths, labelsPaths))
+    return _to_annotations(bboxes, labels, class_dict, imgPath)
 
-    # in case there's only one annotation and numpy read the array as single array,
-    # we need to make sure the input is treated as a multi dimensional array instead of a list/ 1D array
-    if len(bboxes.shape) == 1:
-        bboxes = np.array([bboxes])
-
-    with open(labelsPaths, 'rb') as f:
-        lines = f.readlines()
-    labels = [_removeLineEndCharacters(s) for s in lines]
+def _parse_annotation_files(paths):
+    # returns the boxes as float32 array and the labels of an image, None for annotation files that do not exist
+    bboxesPaths, labelsPaths = paths
+    bboxes, labels = None, None
+    if bboxesPaths is not None:
+        with open(bboxesPaths, 'rb') as f:
+            # one box per line, a single box is read as one row as well
+            bboxes = np.array(f.read().split(), dtype=np.float32).reshape((-1, 4))
+    if labelsPaths is not None:
+        with open(labelsPaths, 'rb') as f:
+            lines = f.readlines()
+        labels = [_removeLineEndCharacters(s).decode('utf-8') for s in lines]
+    return bboxes, labels
 
-    label_idxs = None
+def _to_annotations(bboxes, labels, class_dict, imgPath):
     try:
-        label_idxs = np.asarray([class_dict[l.decode('utf-8')] for l in labels])
-    except:
+        label_idxs = np.asarray([class_dict[l] for l in labels])
+    except KeyError:
         print (imgPath)
+        raise
     label_idxs.shape = label_idxs.shape + (1,)
-    annotations = np.hstack((bboxes, label_idxs))
-
-    return annotations
+    return np.hstack((bboxes, label_idxs))
 
 def create_map_files(data_folder, class_dict, training_set):
     # get relative paths for map files
     img_file_paths = _get_image_paths(data_folder, training_set)
 
+    annotated_images = []
+    for img_path in img_file_paths:
+        abs_img_path = os.path.join(data_folder, img_path)
+        gt_annotations = _load_annotation(abs_img_path, class_dict)
+        if gt_annotations is not None:
+            annotated_images.append((img_path, gt_annotations))
+
+    _write_map_files(data_folder, training_set, annotated_images)
+
+def _write_map_files(data_folder, training_set, annotated_images):
+    # writes the image and roi map files and the annotation store for a list of (image path, annotations)
     out_map_file_path = os.path.join(data_folder, "{}_img_file.txt".format("train" if training_set else "test"))
     roi_file_path = os.path.join(data_folder, "{}_roi_file.txt".format("train" if training_set else "test"))
 
     counter = 0
+    sequence_numbers, annotations = [], []
     with open(out_map_file_path, 'w') as img_file:
         with open(roi_file_path, 'w') as roi_file:
-            for img_path in img_file_paths:
-                abs_img_path = os.path.join(data_folder, img_path)
-                gt_annotations = _load_annotation(abs_img_path, class_dict)
-                if gt_annotations is None:
-                    continue
-
+            for img_path, gt_annotations in annotated_images:
                 img_line = "{}\t{}\t0\n".format(counter, img_path)
                 img_file.write(img_line)
 
-                roi_line = "{} |roiAndLabel".format(counter)
-                for val in gt_annotations.flatten():
-                    roi_line += " {}".format(val)
-
-                roi_file.write(roi_line + "\n")
+                roi_values = " ".join(str(val) for val in gt_annotations.flatten().tolist())
+                roi_file.write("{} |roiAndLabel {}\n".format(counter, roi_values) if roi_values else
+                               "{} |roiAndLabel\n".format(counter))
+                sequence_numbers.append(counter)
+                annotations.append(gt_annotations)
                 counter += 1
                 if counter % 500 == 0:
                     print("Processed {} images".format(counter))
 
+    # the binary annotation store is read by ObjectDetectionReader instead of parsing the roi file
+    write_annotation_store(annotation_store_path(roi_file_path), sequence_numbers, annotations)
+
+def index_data_set(data_folder, num_workers=None):
+    '''
+    Creates the class map file and the map files of the training and test set in a single pass over the data set,
+    i.e. the same files as create_class_dict and create_map_files, and returns the class dictionary.
+
+    The annotation files are parsed in a pool of num_workers processes (all cores by default). The parsed annotations
+    are kept in an index file in the data folder together with the modification times of the annotation files, so
+    that running the indexer again only parses the annotation files that were added or changed.
+    '''
+    index_path = os.path.join(data_folder, DATA_SET_INDEX_FILE)
+    index = _load_data_set_index(index_path)
+
+    # list every folder once, the annotation files of an image are looked up in the listing
+    images = OrderedDict()
+    for training_set in [True, False]:
+        for subdir in _get_sub_dirs(training_set):
+            sub_dir_path = os.path.join(data_folder, subdir)
+            files = _scanDirectory(sub_dir_path)
+            for img in _get_image_file_names(sub_dir_path, list(files)):
+                img_path = "{}/{}".format(subdir, img)
+                bboxes_name, labels_name = _get_annotation_paths(img)
+                mtimes = [files.get(bboxes_name), files.get(labels_name)]
+                paths = tuple(None if mtime is None else os.path.join(sub_dir_path, name)
+                              for name, mtime in zip([bboxes_name, labels_name], mtimes))
+                images[img_path] = (training_set, mtimes, paths)
+
+    changed = [img_path for img_path, (_, mtimes, _) in images.items()
+               if img_path not in index or index[img_path]['mtimes'] != mtimes]
+    num_workers = cpu_count() if num_workers is None else num_workers
+    args = [images[img_path][2] for img_path in changed]
+    if num_workers > 1 and len(changed) > num_workers:
+        pool = Pool(num_workers)
+        try:
+            parsed = pool.map(_parse_annotation_files, args, chunksize=max(1, len(args) // (4 * num_workers)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed = [_parse_annotation_files(a) for a in args]
+    for img_path, (bboxes, labels) in zip(changed, parsed):
+        index[img_path] = {'mtimes': images[img_path][1], 'labels': labels,
+                           'bboxes': None if bboxes is None else bboxes.tolist()}
+    print("Indexed {} images, parsed the annotations of {} new or changed images".format(len(images), len(changed)))
+
+    # the classes are numbered in the order in which they first appear in the training set
+    train_classes = ["__background__"]
+    for img_path, (training_set, _, _) in images.items():
+        for label in (index[img_path]['labels'] or []) if training_set else []:
+            if not label in train_classes:
+                train_classes.append(label)
+    class_dict = {k: v for v, k in enumerate(train_classes)}
+    _write_class_map_file(data_folder, train_classes)
+
+    for training_set in [True, False]:
+        annotated_images = []
+        for img_path, (img_training_set, _, _) in images.items():
+            entry = index[img_path]
+            if img_training_set != training_set or entry['bboxes'] is None or entry['labels'] is None:
+                continue
+            bboxes = np.array(entry['bboxes'], dtype=np.float32).reshape((-1, 4))
+            annotated_images.append((img_path, _to_annotations(bboxes, entry['labels'], class_dict,
+                                                               os.path.join(data_folder, img_path))))
+        _write_map_files(data_folder, training_set, annotated_images)
+
+    # images that were removed from the data set are dropped from the index
+    if len(changed) > 0 or len(index) != len(images):
+        _write_data_set_index(index_path, OrderedDict((img_path, index[img_path]) for img_path in images))
+    return class_dict
+
+def _load_data_set_index(index_path):
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except ValueError:
+        print("Warning: data set index {} is corrupt, parsing all annotations again".format(index_path))
+        return {}
+    return index.get('images', {}) if index.get('version') == DATA_SET_INDEX_VERSION else {}
+
+def _write_data_set_index(index_path, images):
+    tmp_path = index_path + ".{}.tmp".format(os.getpid())
+    with open(tmp_path, 'w') as f:
+        # json.dumps uses the C encoder, json.dump encodes in Python
+        f.write(json.dumps({'version': DATA_SET_INDEX_VERSION, 'images': images}))
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    os.rename(tmp_path, index_path)
+
+def annotation_store_path(roi_file_path):
+    # the annotation store is kept next to the roi map file, e.g. train_roi_file.txt -> train_roi_file.npz
+    return os.path.splitext(roi_file_path)[0] + ".npz"
+
+def write_annotation_store(store_path, sequence_numbers, annotations):
+    '''
+    Writes the ground truth annotations of all images to a binary annotation store (.npz) with the arrays:
+
+        boxes:              the (x1, y1, x2, y2, label) rows of all images as float32. shape = (n, 5)
+        offsets:            the rows of image i are boxes[offsets[i]:offsets[i+1]]. shape = (num_images + 1,)
+        sequence_numbers:   the sequence number of every image as in the image map file. shape = (num_images,)
+    '''
+    counts = [len(a) for a in annotations]
+    boxes = [np.asarray(a, dtype=np.float32).reshape((-1, 5)) for a in annotations] + [np.zeros((0, 5), dtype=np.float32)]
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # write to a temporary file first, so that readers never see a partially written store
+    tmp_path = store_path + ".{}.tmp".format(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, version=np.int64(ANNOTATION_STORE_VERSION), boxes=np.concatenate(boxes), offsets=offsets,
+                 sequence_numbers=np.asarray(sequence_numbers, dtype=np.int64))
+    if os.path.exists(store_path):
+        os.remove(store_path)
+    os.rename(tmp_path, store_path)
+
+def load_annotation_store(store_path):
+    '''
+    Returns the (sequence_numbers, offsets, boxes) arrays of an annotation store written by write_annotation_store
+    or None if the store has a different version.
+    '''
+    with np.load(store_path) as store:
+        if int(store['version']) != ANNOTATION_STORE_VERSION:
+            return None
+        return store['sequence_numbers'], store['offsets'], store['boxes']
+
+def parse_roi_map_file(roi_map_file):
+    '''
+    Parses a roi map file with lines "<sequence number> |roiAndLabel x1 y1 x2 y2 label ..." and returns the
+    annotations in the format of load_annotation_store.
+    '''
+    with open(roi_map_file) as f:
+        roi_map_lines = [line for line in f.readlines() if len(line.strip()) > 0]
+
+    sequence_numbers = np.zeros(len(roi_map_lines), dtype=np.int64)
+    offsets = np.zeros(len(roi_map_lines) + 1, dtype=np.int64)
+    boxes = [np.zeros(0, dtype=np.float32)]
+    for i, roi_line in enumerate(roi_map_lines):
+        # "<sequence number> |roiAndLabel" is followed by the values, there are none for images without boxes
+        values = roi_line.split()
+        sequence_numbers[i] = int(values[0])
+        bbox_floats = np.array(values[2:], dtype=np.float32)
+        assert len(bbox_floats) % 5 == 0, "Ground truth annotation file is corrupt. Lines must contain 4 coordinates and a label per roi."
+        offsets[i + 1] = offsets[i] + len(bbox_floats) // 5
+        boxes.append(bbox_floats)
+
+    return sequence_numbers, offsets, np.concatenate(boxes).reshape((-1, 5))
+
+def load_annotations(roi_map_file):
+    '''
+    Returns the annotations of a roi map file in the format of load_annotation_store. They are read from the
+    annotation store next to the roi map file if it is up to date, otherwise the roi map file is parsed.
+    '''
+    store_path = annotation_store_path(roi_map_file)
+    if os.path.exists(store_path) and \
+            (not os.path.exists(roi_map_file) or os.path.getmtime(store_path) >= os.path.getmtime(roi_map_file)):
+        annotations = load_annotation_store(store_path)
+        if annotations is not None:
+            return annotations
+    return parse_roi_map_file(roi_map_file)
+
 def create_class_dict(data_folder):
     # get relative paths for map files
     img_file_paths = _get_image_paths(data_folder, True)
@@ -104,28 +296,26 @@ def create_class_dict(data_folder):
 
     for img_path in img_file_paths:
         abs_img_path = os.path.join(data_folder, img_path)
-        labelsPaths = abs_img_path[:-4] + ".bboxes.labels.tsv"
+        labelsPaths = _get_annotation_paths(abs_img_path)[1]
         if not os.path.exists(labelsPaths):
             continue
-        with open(labelsPaths, 'rb') as f:
-            lines = f.readlines()
-        labels = [_removeLineEndCharacters(s).decode('utf-8') for s in lines]
+        _, labels = _parse_annotation_files((None, labelsPaths))
 
         for label in labels:
             if not label in train_classes:
                 train_classes.append(label)
 
     class_dict = {k: v for v, k in enumerate(train_classes)}
-    class_list = [None]*len(class_dict)
-    for k in class_dict:
-        class_list[class_dict[k]]=k
+    _write_class_map_file(data_folder, train_classes)
+
+    return class_dict
+
+def _write_class_map_file(data_folder, class_list):
     class_map_file_path = os.path.join(data_folder, "class_map.txt")
     with open(class_map_file_path, 'w') as class_map_file:
         for i in range(len(class_list)):
             class_map_file.write("{}\t{}\n".format(class_list[i], i))
 
-    return class_dict
-
 def parse_class_map_file(class_map_file):
     with open(class_map_file, "r") as f:
         lines = f.readlines()
@@ -0,0 +1,381 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+# Micro benchmarks for the numpy post-processing code, run with: python benchmarks.py
+
+from __future__ import print_function
+import os, sys
+abs_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(abs_path))
+sys.path.append(os.path.join(abs_path, ".."))
+
+import timeit
+import numpy as np
+
+def _time(func, number):
+    # best of three repetitions in milliseconds per call
+    return min(timeit.repeat(func, repeat=3, number=number)) / number * 1000.0
+
+def _random_rois(num_rois, max_coord=500, max_size=400):
+    x1y1 = np.random.random_sample((num_rois, 2)) * max_coord
+    wh = np.random.random_sample((num_rois, 2)) * max_size
+    return np.hstack((x1y1, x1y1 + wh + 10)).astype(np.float32)
+
+def benchmark_regress_rois(num_classes=17, number=20):
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from cntk_helpers import regress_rois
+    from rpn.bbox_transform import bbox_transform_inv
+
+    def regress_rois_loop(roi_proposals, roi_regression_factors, labels):
+        for i in range(len(labels)):
+            label = labels[i]
+            if label > 0:
+                deltas = roi_regression_factors[i:i+1,label*4:(label+1)*4]
+                roi_proposals[i,:] = bbox_transform_inv(roi_proposals[i:i+1,:], deltas)
+        return roi_proposals
+
+    print("regress_rois ({} classes)".format(num_classes))
+    for num_rois in [300, 2000]:
+        rois = _random_rois(num_rois)
+        regression_factors = (np.random.random_sample((num_rois, num_classes * 4)) - 0.5).astype(np.float32)
+        labels = np.random.randint(0, num_classes, num_rois)
+
+        loop_ms = _time(lambda: regress_rois_loop(rois.copy(), regression_factors, labels), number)
+        vectorized_ms = _time(lambda: regress_rois(rois.copy(), regression_factors, labels, None), number)
+        print("  {:5d} rois: loop {:8.3f} ms, vectorized {:8.3f} ms, speedup {:6.1f}x"
+              .format(num_rois, loop_ms, vectorized_ms, loop_ms / vectorized_ms))
+
+def _rpn_like_dets(num_boxes, feature_map_size=61, feat_stride=16):
+    # anchors on a regular grid with small random offsets and random scores, like the RPN pre-nms boxes
+    from utils.rpn.generate_anchors import generate_anchors
+    from utils.rpn.bbox_transform import bbox_transform_inv
+    anchors = generate_anchors(scales=np.array((8, 16, 32)))
+    shift_x, shift_y = np.meshgrid(np.arange(feature_map_size) * feat_stride, np.arange(feature_map_size) * feat_stride)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(), shift_x.ravel(), shift_y.ravel())).transpose()
+    all_anchors = (anchors[np.newaxis, :, :] + shifts[:, np.newaxis, :]).reshape((-1, 4))
+    boxes = bbox_transform_inv(all_anchors, np.random.randn(len(all_anchors), 4) * 0.1)
+    boxes = boxes.clip(0, feature_map_size * feat_stride - 1)
+    scores = np.random.random_sample(len(boxes))
+    order = scores.argsort()[::-1][:num_boxes]
+    return np.hstack((boxes[order], scores[order, np.newaxis])).astype(np.float32)
+
+def benchmark_nms(number=3):
+    from utils.nms.nms import nms, cpu_nms
+
+    backends = ['numpy', 'blocked'] + (['cython'] if cpu_nms is not None else [])
+    print("nms ({})".format(", ".join(backends)))
+    for num_boxes in [100, 300, 1000, 2000, 6000, 12000]:
+        dets = _rpn_like_dets(num_boxes)
+        for thresh in [0.3, 0.7]:
+            timings = [_time(lambda: nms(dets.copy(), thresh, backend=backend), number) for backend in backends]
+            print("  {:5d} boxes, thresh {:.1f}: ".format(num_boxes, thresh) +
+                  ", ".join("{} {:8.3f} ms".format(b, t) for b, t in zip(backends, timings)) +
+                  ", speedup {:5.1f}x".format(timings[0] / timings[1]))
+
+def benchmark_pre_nms_selection(number=20):
+    from utils.rpn.anchor_grid import get_anchor_grid
+    from utils.rpn.bbox_transform import bbox_transform_inv, clip_boxes
+    from utils.rpn.proposal_layer import select_pre_nms_proposals, _filter_boxes
+
+    def full_sort(anchor_grid, scores, bbox_deltas, im_info, pre_nms_topN, min_size):
+        # decode, clip and filter all anchors, then sort all scores as in the original ProposalLayer
+        proposals = clip_boxes(bbox_transform_inv(anchor_grid.anchors, bbox_deltas), im_info)
+        keep = _filter_boxes(proposals, min_size * im_info[2] / im_info[4])
+        proposals, scores = proposals[keep, :], scores[keep]
+        order = scores.argsort()[::-1][:pre_nms_topN]
+        return proposals[order, :], scores[order].reshape((-1, 1))
+
+    print("pre-nms proposal selection")
+    for feature_map_size in [38, 61]:
+        anchor_grid = get_anchor_grid(feature_map_size, feature_map_size, 16)
+        num_anchors = len(anchor_grid.anchors)
+        # distinct scores, for equal scores the order of the two implementations may differ
+        scores = ((np.random.permutation(num_anchors) + 1) / float(num_anchors + 1)).astype(np.float32)
+        bbox_deltas = ((np.random.random_sample((num_anchors, 4)) - 0.5) * 0.2).astype(np.float32)
+        im_info = np.array([1000, 1000, 1000, 600, 500, 300], dtype=np.float32)
+        for pre_nms_topN in [6000, 12000]:
+            expected = full_sort(anchor_grid, scores, bbox_deltas, im_info.copy(), pre_nms_topN, 16)
+            selected = select_pre_nms_proposals(anchor_grid, scores, bbox_deltas, im_info.copy(), pre_nms_topN, 16)
+            assert all(np.array_equal(a, b) for a, b in zip(expected, selected))
+
+            full_sort_ms = _time(lambda: full_sort(anchor_grid, scores, bbox_deltas, im_info.copy(), pre_nms_topN, 16), number)
+            top_k_ms = _time(lambda: select_pre_nms_proposals(anchor_grid, scores, bbox_deltas, im_info.copy(), pre_nms_topN, 16), number)
+            print("  {:5d} anchors, top {:5d}: full sort {:8.3f} ms, top-k {:8.3f} ms, speedup {:6.1f}x"
+                  .format(num_anchors, pre_nms_topN, full_sort_ms, top_k_ms, full_sort_ms / top_k_ms))
+
+def benchmark_bbox_transform(number=50):
+    from utils.rpn.bbox_transform import bbox_transform, bbox_transform_inv
+    from utils.caffe_layers.bbox_transform import bbox_transform as caffe_bbox_transform, \
+        bbox_transform_inv as caffe_bbox_transform_inv
+
+    print("bbox_transform / bbox_transform_inv (caffe reference vs fused)")
+    for num_rois in [2000, 33489]:
+        ex_rois = _random_rois(num_rois)
+        gt_rois = ex_rois + np.random.random_sample((num_rois, 4)).astype(np.float32)
+        deltas = ((np.random.random_sample((num_rois, 4)) - 0.5) * 0.2).astype(np.float32)
+        for name, reference, fused in [
+                ("bbox_transform", lambda: caffe_bbox_transform(ex_rois, gt_rois), lambda: bbox_transform(ex_rois, gt_rois)),
+                ("bbox_transform_inv", lambda: caffe_bbox_transform_inv(ex_rois, deltas), lambda: bbox_transform_inv(ex_rois, deltas))]:
+            assert np.array_equal(reference(), fused())
+            reference_ms = _time(reference, number)
+            fused_ms = _time(fused, number)
+            print("  {:5d} rois, {:18s}: reference {:8.3f} ms, fused {:8.3f} ms, speedup {:6.1f}x"
+                  .format(num_rois, name, reference_ms, fused_ms, reference_ms / fused_ms))
+
+def benchmark_roi_target_labels(rois_per_image=256, num_classes=21, number=50):
+    from utils.rpn.proposal_target_layer import _get_bbox_regression_labels
+
+    def regression_labels_loop(bbox_target_data, num_classes):
+        # the per roi loop and the np.eye one-hot labels of the original ProposalTargetLayer
+        clss = bbox_target_data[:, 0].astype(int)
+        bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
+        bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
+        for ind in np.where(clss > 0)[0]:
+            start = 4 * clss[ind]
+            bbox_targets[ind, start:start + 4] = bbox_target_data[ind, 1:]
+            bbox_inside_weights[ind, start:start + 4] = [1.0, 1.0, 1.0, 1.0]
+        labels_dense = np.eye(num_classes, dtype=np.float32)[[i.item() for i in clss]]
+        return labels_dense, bbox_targets, bbox_inside_weights
+
+    def regression_labels_vectorized(bbox_target_data, num_classes):
+        labels_dense = np.zeros((len(bbox_target_data), num_classes), dtype=np.float32)
+        labels_dense[np.arange(len(bbox_target_data)), bbox_target_data[:, 0].astype(int)] = 1.0
+        return (labels_dense,) + _get_bbox_regression_labels(bbox_target_data, num_classes)
+
+    print("roi regression targets and one-hot labels ({} rois, {} classes)".format(rois_per_image, num_classes))
+    for fg_fraction in [0.25, 1.0]:
+        num_fg = int(rois_per_image * fg_fraction)
+        labels = np.zeros(rois_per_image, dtype=np.float32)
+        labels[:num_fg] = np.random.randint(1, num_classes, num_fg)
+        bbox_target_data = np.hstack((labels[:, np.newaxis], np.random.randn(rois_per_image, 4))).astype(np.float32)
+
+        expected = regression_labels_loop(bbox_target_data, num_classes)
+        assert all(np.array_equal(a, b) for a, b in zip(expected, regression_labels_vectorized(bbox_target_data, num_classes)))
+
+        loop_ms = _time(lambda: regression_labels_loop(bbox_target_data, num_classes), number)
+        vectorized_ms = _time(lambda: regression_labels_vectorized(bbox_target_data, num_classes), number)
+        print("  {:3d} fg rois: loop {:8.3f} ms, vectorized {:8.3f} ms, speedup {:6.1f}x"
+              .format(num_fg, loop_ms, vectorized_ms, loop_ms / vectorized_ms))
+
+def _random_gt_and_detections(num_images, num_classes, max_gt_per_image=5, dets_per_class=40):
+    # ground truth infos in the format of eval_faster_rcnn_mAP and jittered copies of the ground truth boxes as detections
+    classes = ['__background__'] + ['class_{}'.format(i) for i in range(1, num_classes)]
+    all_gt_infos = {cls: [] for cls in classes}
+    all_boxes = [[[] for _ in range(num_images)] for _ in range(num_classes)]
+    for img_index in range(num_images):
+        num_gt = np.random.randint(1, max_gt_per_image + 1)
+        gt_boxes = np.hstack((_random_rois(num_gt, max_size=150), np.random.randint(1, num_classes, (num_gt, 1))))
+        for cls_index, cls in enumerate(classes[1:], 1):
+            cls_gt_boxes = gt_boxes[gt_boxes[:, -1] == cls_index]
+            all_gt_infos[cls].append({'bbox': cls_gt_boxes, 'difficult': [False] * len(cls_gt_boxes),
+                                      'det': [False] * len(cls_gt_boxes)})
+            jitter = np.random.randn(dets_per_class, 4) * np.random.choice([2.0, 10.0, 40.0])
+            dets = gt_boxes[np.random.randint(0, num_gt, dets_per_class), :4] + jitter
+            all_boxes[cls_index][img_index] = np.hstack((dets, np.random.random_sample((dets_per_class, 1)))).astype(np.float32)
+    return classes, all_gt_infos, all_boxes
+
+def benchmark_voc_matching(num_images=300, num_classes=5, number=1):
+    import copy
+    from utils.map.map_helpers import _evaluate_detections, max_overlap_with_class, max_overlap_with_classes
+    from utils.map.ground_truth_store import GroundTruthStore
+
+    def voc_matching_loop(className, all_gt_infos, confidence, image_ids, BB, confusions, ovthresh=0.5):
+        # the per detection matching and false positive analysis as in the VOCdevkit
+        sorted_ind = np.argsort(-confidence)
+        BB = BB[sorted_ind, :]
+        image_ids = [image_ids[x] for x in sorted_ind]
+        tp, fp, fp_error = np.zeros(len(BB)), np.zeros(len(BB)), np.zeros(6).astype(int)
+        sim_classes, otr_classes = confusions[className]
+        for d in range(len(BB)):
+            R = all_gt_infos[className][image_ids[d]]
+            bb = BB[d, :].astype(float)
+            ovmax, jmax = max_overlap_with_class(className, image_ids[d], all_gt_infos, bb)
+            if ovmax > ovthresh:
+                if not R['det'][jmax]:
+                    tp[d], R['det'][jmax] = 1., 1
+                    fp_error[5] += 1
+                else:
+                    fp[d] = 1.
+                    fp_error[4] += 1
+            else:
+                fp[d] = 1.
+                if ovmax >= 0.1:
+                    fp_error[0] += 1
+                else:
+                    _, sim_ovmax = max_overlap_with_classes(list(sim_classes), image_ids[d], all_gt_infos, bb)
+                    _, otr_ovmax = max_overlap_with_classes(list(otr_classes), image_ids[d], all_gt_infos, bb)
+                    fp_error[1 if sim_ovmax >= otr_ovmax and sim_ovmax > 0.1 else 2 if otr_ovmax > 0.1 else 3] += 1
+        return tp, fp, fp_error
+
+    classes, all_gt_infos, all_boxes = _random_gt_and_detections(num_images, num_classes)
+    confusions = {cls: [set(classes[1:2]) - set([cls]), [c for c in classes[2:] if c != cls]] for cls in classes[1:]}
+    num_dets = sum(len(dets) for boxes in all_boxes for dets in boxes)
+
+    def loop():
+        gt_infos = copy.deepcopy(all_gt_infos)
+        for cls_index, cls in enumerate(classes[1:], 1):
+            dets = np.vstack([d for d in all_boxes[cls_index] if len(d) > 0])
+            image_ids = [i for i, d in enumerate(all_boxes[cls_index]) for _ in range(len(d))]
+            voc_matching_loop(cls, gt_infos, dets[:, -1], image_ids, dets[:, :4] + 1, confusions)
+
+    gt_store = GroundTruthStore.from_gt_infos(all_gt_infos, classes)
+    def vectorized():
+        gt_store.reset()
+        for cls_index, cls in enumerate(classes[1:], 1):
+            _evaluate_detections(cls_index, cls, all_boxes, gt_store, confusions=confusions)
+
+    print("voc matching ({} images, {} classes)".format(num_images, num_classes - 1))
+    loop_ms = _time(loop, number)
+    vectorized_ms = _time(vectorized, number)
+    print("  {:5d} detections: loop {:8.3f} ms, vectorized {:8.3f} ms, speedup {:6.1f}x"
+          .format(num_dets, loop_ms, vectorized_ms, loop_ms / vectorized_ms))
+
+def benchmark_gt_store(num_images=5000, num_classes=21, number=3):
+    from utils.map.ground_truth_store import GroundTruthStore
+
+    def gt_infos_dicts(classes, gt_boxes_per_image):
+        # one dict per class and image, as built by the original evaluation loop
+        all_gt_infos = {cls: [] for cls in classes}
+        for gt_boxes in gt_boxes_per_image:
+            for cls_index, cls_name in enumerate(classes):
+                if cls_index == 0: continue
+                cls_gt_boxes = gt_boxes[np.where(gt_boxes[:, -1] == cls_index)]
+                all_gt_infos[cls_name].append({'bbox': np.array(cls_gt_boxes), 'difficult': [False] * len(cls_gt_boxes),
+                                               'det': [False] * len(cls_gt_boxes)})
+        return all_gt_infos
+
+    classes = ['__background__'] + ['class_{}'.format(i) for i in range(1, num_classes)]
+    gt_boxes_per_image = []
+    for _ in range(num_images):
+        num_gt = np.random.randint(1, 6)
+        gt_boxes_per_image.append(np.hstack((_random_rois(num_gt), np.random.randint(1, num_classes, (num_gt, 1)))))
+
+    print("ground truth infos ({} images, {} classes)".format(num_images, num_classes - 1))
+    dicts_ms = _time(lambda: gt_infos_dicts(classes, gt_boxes_per_image), number)
+    store = GroundTruthStore.from_image_boxes(classes, gt_boxes_per_image)
+    store_ms = _time(lambda: GroundTruthStore.from_image_boxes(classes, gt_boxes_per_image), number)
+    reset_ms = _time(store.reset, number)
+    print("  build: dicts {:8.3f} ms, store {:8.3f} ms, speedup {:6.1f}x, store reset {:8.3f} ms"
+          .format(dicts_ms, store_ms, dicts_ms / store_ms, reset_ms))
+
+def benchmark_annotation_loading(num_images=20000, max_annotations_per_image=3000, number=1):
+    import tempfile, shutil
+    from utils.annotations.annotations_helper import annotation_store_path, write_annotation_store, \
+        load_annotations, parse_roi_map_file
+
+    def parse_dense(roi_map_file):
+        # one zero padded float64 array per image, as built by the original ObjectDetectionReader
+        all_annotations = []
+        with open(roi_map_file) as f:
+            for roi_line in f.readlines():
+                rest = roi_line[roi_line.find(' ')+1:]
+                bbox_floats = np.fromstring(rest[rest.find(' ')+1:], dtype=np.float32, sep=' ')
+                annotations = np.zeros((max_annotations_per_image, 5))
+                annotations[:len(bbox_floats) // 5, :] = bbox_floats.reshape((-1, 5))
+                all_annotations.append(annotations)
+        return all_annotations
+
+    annotations = [np.hstack((_random_rois(n), np.random.randint(1, 20, (n, 1)))).astype(np.float32)
+                   for n in np.random.randint(1, 6, num_images)]
+    data_dir = tempfile.mkdtemp()
+    try:
+        roi_map_file = os.path.join(data_dir, "train_roi_file.txt")
+        with open(roi_map_file, 'w') as f:
+            f.writelines("{} |roiAndLabel{}\n".format(i, "".join(" {}".format(v) for v in a.flatten()))
+                         for i, a in enumerate(annotations))
+        write_annotation_store(annotation_store_path(roi_map_file), range(num_images), annotations)
+
+        print("annotation loading ({} images, padded to {} rows)".format(num_images, max_annotations_per_image))
+        dense_ms = _time(lambda: parse_dense(roi_map_file), number)
+        parse_ms = _time(lambda: parse_roi_map_file(roi_map_file), number)
+        store_ms = _time(lambda: load_annotations(roi_map_file), number)
+        dense_mb = num_images * max_annotations_per_image * 5 * 8 / 1e6
+        store_mb = sum(map(len, annotations)) * 5 * 4 / 1e6
+        print("  dense {:8.1f} ms, compact parse {:8.1f} ms, store {:8.1f} ms, speedup {:6.1f}x"
+              .format(dense_ms, parse_ms, store_ms, dense_ms / store_ms))
+        print("  memory: dense {:8.1f} MB, store {:8.3f} MB".format(dense_mb, store_mb))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def benchmark_data_set_indexing(num_images=2000, number=1):
+    import tempfile, shutil
+    from utils.annotations.annotations_helper import create_class_dict, create_map_files, index_data_set, \
+        DATA_SET_INDEX_FILE
+
+    def two_passes(data_dir):
+        class_dict = create_class_dict(data_dir)
+        create_map_files(data_dir, class_dict, training_set=True)
+        create_map_files(data_dir, class_dict, training_set=False)
+
+    def full_index(data_dir):
+        index_file = os.path.join(data_dir, DATA_SET_INDEX_FILE)
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        index_data_set(data_dir)
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        for subdir, count in [('positive', num_images // 2), ('negative', num_images // 4), ('testImages', num_images // 4)]:
+            os.makedirs(os.path.join(data_dir, subdir))
+            for i in range(count):
+                img_base = os.path.join(data_dir, subdir, "img_{}".format(i))
+                open(img_base + ".jpg", 'w').close()
+                rois = _random_rois(np.random.randint(1, 6))
+                np.savetxt(img_base + ".bboxes.tsv", rois, fmt='%.2f', delimiter='\t')
+                with open(img_base + ".bboxes.labels.tsv", 'w') as f:
+                    f.writelines("class_{}\n".format(c) for c in np.random.randint(0, 5, len(rois)))
+
+        print("data set indexing ({} images)".format(num_images))
+        two_passes_ms = _time(lambda: two_passes(data_dir), number)
+        full_ms = _time(lambda: full_index(data_dir), number)
+        incremental_ms = _time(lambda: index_data_set(data_dir), number)
+        print("  two passes {:8.1f} ms, index {:8.1f} ms, incremental index {:8.1f} ms, speedup {:6.1f}x / {:6.1f}x"
+              .format(two_passes_ms, full_ms, incremental_ms, two_passes_ms / full_ms, two_passes_ms / incremental_ms))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def benchmark_image_size_probe(num_images=200, number=1):
+    import tempfile, shutil, cv2
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_image_sizes import load_image_sizes
+
+    def decode_sizes(image_paths):
+        # the reader computes the image stats only after decoding the image
+        return [cv2.imread(image_path).shape[1::-1] for image_path in image_paths]
+
+    def probe_sizes(image_paths, sizes_file):
+        if os.path.exists(sizes_file):
+            os.remove(sizes_file)
+        return load_image_sizes(image_paths, sizes_file, None)
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        image_paths = [os.path.join(data_dir, "img_{}.jpg".format(i)) for i in range(num_images)]
+        for image_path in image_paths:
+            cv2.imwrite(image_path, np.random.randint(0, 255, (480, 640, 3)).astype(np.uint8))
+        sizes_file = os.path.join(data_dir, "img_file_sizes.npz")
+
+        print("image sizes ({} images of 640 x 480)".format(num_images))
+        decode_ms = _time(lambda: decode_sizes(image_paths), number)
+        probe_ms = _time(lambda: probe_sizes(image_paths, sizes_file), number)
+        stored_ms = _time(lambda: load_image_sizes(image_paths, sizes_file, None), number)
+        print("  decode {:8.1f} ms, probe {:8.1f} ms, stored {:8.1f} ms, speedup {:6.1f}x / {:6.1f}x"
+              .format(decode_ms, probe_ms, stored_ms, decode_ms / probe_ms, decode_ms / stored_ms))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    np.random.seed(0)
+    benchmark_regress_rois()
+    benchmark_nms()
+    benchmark_pre_nms_selection()
+    benchmark_bbox_transform()
+    benchmark_roi_target_labels()
+    benchmark_voc_matching()
+    benchmark_gt_store()
+    benchmark_annotation_loading()
+    benchmark_data_set_indexing()
+    benchmark_image_size_probe()
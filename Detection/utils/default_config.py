@@ -52,6 +52,11 @@ __C.CNTK.RESULTS_NMS_THRESHOLD = 0.3 # see also: __C.TEST.NMS = 0.3
 __C.CNTK.RESULTS_NMS_CONF_THRESHOLD = 0.7
 __C.CNTK.RESULTS_BGR_PLOT_THRESHOLD = 0.1
 __C.CNTK.RESULTS_NMS_SOFT = True
+# 'numpy', 'blocked' or 'cython' (requires utils/cython_modules/cpu_nms), None uses 'blocked' with a block size chosen by the number of boxes
+__C.CNTK.NMS_BACKEND = None
+# score decay used by soft nms: 'linear' (score * (1 - IoU) above the nms threshold) or 'gaussian' (score * exp(-IoU^2 / sigma))
+__C.CNTK.RESULTS_NMS_SOFT_METHOD = 'linear'
+__C.CNTK.RESULTS_NMS_SOFT_SIGMA = 0.5
 
 __C.CNTK.GRAPH_TYPE = "png" # "png" or "pdf"
 __C.CNTK.DEBUG_OUTPUT = True
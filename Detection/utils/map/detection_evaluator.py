@@ -0,0 +1,185 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+from multiprocessing.pool import Pool, ThreadPool
+
+from utils.nms.nms_wrapper import apply_nms_to_test_set_results
+from utils.map.ground_truth_store import GroundTruthStore
+from utils.map.map_helpers import evaluate_detections_coco, _parse_class_detections, _voc_match_detections, \
+    _precision_recall_ap
+
+class DetectionEvaluator:
+    '''
+    Incremental version of evaluate_detections: nms and the matching against the ground truth boxes are done per
+    image as the results arrive. Per class only the detection scores, their TP / FP flags and the number of ground
+    truth boxes are kept, so the memory use does not depend on the number of boxes per image and summarize() can
+    be called at any time to report the mAP of the images added so far.
+
+    The results are the same as those of evaluate_detections when the images are added in the same order,
+    except that equal scores within an image may be matched in a different order.
+
+    With keep_detections=True the detections after nms and the ground truth boxes are kept as well, so that
+    evaluate_coco() can compute the COCO-style metrics without collecting and suppressing all results again.
+
+    With nms_num_workers > 1 the nms of the classes of an image runs in a pool of workers that is kept until close().
+    '''
+
+    def __init__(self, classes, use_07_metric=False, apply_nms=True, nms_threshold=0.5, conf_threshold=0.0, soft=False,
+                 confusions=None, compact_interval=256, keep_detections=False, nms_num_workers=1, nms_use_processes=False):
+        self._classes = classes
+        self._use_07_metric = use_07_metric
+        self._apply_nms = apply_nms
+        self._nms_threshold = nms_threshold
+        self._conf_threshold = conf_threshold
+        self._soft = soft
+        self._confusions = confusions
+        self._compact_interval = compact_interval
+        self._nms_num_workers = nms_num_workers
+        self._nms_pool = None
+        if apply_nms and nms_num_workers > 1:
+            self._nms_pool = (Pool if nms_use_processes else ThreadPool)(nms_num_workers)
+
+        num_classes = len(classes)
+        self._image_ids = set()
+        # per class lists of arrays in the order the images were added, merged every compact_interval images
+        self._scores = [[] for _ in range(num_classes)]
+        self._tp = [[] for _ in range(num_classes)]
+        self._fp = [[] for _ in range(num_classes)]
+        self._npos = np.zeros(num_classes, dtype=np.int64)
+        self._fp_errors = np.zeros((num_classes, 6), dtype=np.int64) if confusions else None
+        # per class lists of the (x1, y1, x2, y2, score) detections after nms and of their image positions
+        self._keep_detections = keep_detections
+        self._kept_boxes = [[] for _ in range(num_classes)]
+        self._kept_positions = [[] for _ in range(num_classes)]
+        self._kept_gt = []
+        self._kept_difficult = []
+        self.num_rois_before_nms = 0
+        self.num_rois_after_nms = 0
+
+    @property
+    def num_images(self):
+        return len(self._image_ids)
+
+    def add(self, image_id, detections, gt, difficult=None):
+        '''
+        Adds the results of one image.
+
+        Args:
+            image_id:       a unique id of the image
+            detections:     the detections per class as in all_boxes[:][image], i.e. detections[cls] = N x 5 array
+                            of (x1, y1, x2, y2, score) or [] if there are none
+            gt:             the ground truth boxes of the image as (x1, y1, x2, y2, class index). shape = (n, 5)
+            difficult:      optional flags that mark difficult ground truth boxes. shape = (n,)
+        '''
+        assert image_id not in self._image_ids, "The image {} was added before".format(image_id)
+        assert len(detections) == len(self._classes)
+        position = len(self._image_ids)
+        self._image_ids.add(image_id)
+
+        gt = np.asarray(gt, dtype=np.float32).reshape((-1, 5))
+        difficult = np.zeros(len(gt), dtype=bool) if difficult is None else np.asarray(difficult, dtype=bool)
+
+        # all_boxes and the ground truth store for a single image
+        all_boxes = [[dets] for dets in detections]
+        self.num_rois_before_nms += sum(len(dets) for dets in detections)
+        if self._apply_nms:
+            all_boxes, _ = apply_nms_to_test_set_results(all_boxes, self._nms_threshold, self._conf_threshold, self._soft,
+                                                         num_workers=self._nms_num_workers, pool=self._nms_pool)
+        self.num_rois_after_nms += sum(len(boxes[0]) for boxes in all_boxes)
+        if self._keep_detections:
+            self._kept_gt.append(gt)
+            self._kept_difficult.append(difficult)
+            for cls_index in range(1, len(self._classes)):
+                boxes = all_boxes[cls_index][0]
+                if len(boxes) > 0:
+                    self._kept_boxes[cls_index].append(np.asarray(boxes, dtype=np.float32)[:, :5])
+                    self._kept_positions[cls_index].append(np.full(len(boxes), position, dtype=np.int64))
+
+        gt_store = GroundTruthStore.from_image_boxes(self._classes, [gt], [difficult])
+        self._npos += np.diff(gt_store.class_offsets)
+
+        for cls_index, cls_name in enumerate(self._classes):
+            if cls_index == 0: continue
+            confidence, image_ids, BB = _parse_class_detections(cls_index, all_boxes)
+            if len(BB) == 0:
+                continue
+            sorted_ind, tp, fp, fp_error = _voc_match_detections(cls_name, gt_store, confidence, image_ids, BB,
+                                                                 confusions=self._confusions)
+            # the flags are stored in the original order of the detections, like the scores
+            self._scores[cls_index].append(confidence)
+            self._tp[cls_index].append(_unsort(tp, sorted_ind).astype(np.bool_))
+            self._fp[cls_index].append(_unsort(fp, sorted_ind).astype(np.bool_))
+            if fp_error is not None:
+                self._fp_errors[cls_index] += fp_error
+
+        if self.num_images % self._compact_interval == 0:
+            self._compact()
+
+    def summarize(self):
+        '''
+        Returns the average precision per class {classname: ap} and the false positive statistics per class
+        (or None without confusions) of the images added so far, like evaluate_detections.
+        '''
+        self._compact()
+        aps = {}
+        fp_errors = {}
+        for cls_index, cls_name in enumerate(self._classes):
+            if cls_index == 0: continue
+            if len(self._scores[cls_index]) == 0:
+                aps[cls_name] = 0.0
+                continue
+
+            confidence = self._scores[cls_index][0]
+            sorted_ind = np.argsort(-confidence)
+            _, _, aps[cls_name] = _precision_recall_ap(self._tp[cls_index][0][sorted_ind].astype(float),
+                                                       self._fp[cls_index][0][sorted_ind].astype(float),
+                                                       self._npos[cls_index], self._use_07_metric)
+            if self._fp_errors is not None:
+                fp_errors[cls_name] = self._fp_errors[cls_index].copy()
+
+        return aps, fp_errors if len(fp_errors) > 0 else None
+
+    def close(self):
+        if self._nms_pool is not None:
+            self._nms_pool.close()
+            self._nms_pool.join()
+            self._nms_pool = None
+
+    def evaluate_coco(self, **kwargs):
+        '''
+        Returns the COCO-style report of evaluate_detections_coco for the images added so far, computed from the
+        detections after nms that were kept by add(). Requires keep_detections=True. The keyword arguments are
+        passed to evaluate_detections_coco, except for the nms arguments since nms was applied by add().
+        '''
+        assert self._keep_detections, "The detections are only kept with keep_detections=True"
+        self._compact()
+        num_images = self.num_images
+        all_boxes = [[[] for _ in range(num_images)] for _ in self._classes]
+        for cls_index in range(1, len(self._classes)):
+            if len(self._kept_boxes[cls_index]) == 0:
+                continue
+            # the detections are stored in the order the images were added
+            boxes, positions = self._kept_boxes[cls_index][0], self._kept_positions[cls_index][0]
+            offsets = np.searchsorted(positions, np.arange(num_images + 1))
+            for position in np.unique(positions):
+                all_boxes[cls_index][position] = boxes[offsets[position]:offsets[position + 1]]
+
+        gt_store = GroundTruthStore.from_image_boxes(self._classes, self._kept_gt, self._kept_difficult)
+        return evaluate_detections_coco(all_boxes, gt_store, self._classes, use_07_metric=self._use_07_metric,
+                                        apply_mms=False, **kwargs)
+
+    def _compact(self):
+        for per_class in (self._scores, self._tp, self._fp, self._kept_boxes, self._kept_positions):
+            for cls_index, arrays in enumerate(per_class):
+                if len(arrays) > 1:
+                    per_class[cls_index] = [np.concatenate(arrays)]
+
+
+def _unsort(values, sorted_ind):
+    unsorted = np.empty_like(values)
+    unsorted[sorted_ind] = values
+    return unsorted
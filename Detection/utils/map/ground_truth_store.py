@@ -0,0 +1,121 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import numpy as np
+
+class GroundTruthStore:
+    '''
+    Columnar store of the ground truth boxes of a test set: one contiguous array with the boxes of all classes and
+    images, sorted by class and image, and boolean arrays with the 'difficult' and 'det' (already detected) flags.
+    The boxes of class c in image i are the rows class_offsets[c] + image_offsets[c][i] ... + image_offsets[c][i+1].
+
+    The store is built once per test set. The evaluation marks the matched boxes as detected, reset() restores the
+    initial flags so that the same store can be evaluated again.
+    '''
+
+    def __init__(self, classes, num_images, boxes, image_indices, class_indices, difficult=None, det=None):
+        '''
+        Args:
+            classes:        a list of class names, the class indices refer to it
+            num_images:     the number of images of the test set
+            boxes:          the (x1, y1, x2, y2) ground truth boxes of all images and classes. shape = (n, >= 4)
+            image_indices:  the image index of every box. shape = (n,)
+            class_indices:  the class index of every box. shape = (n,)
+            difficult:      optional flags that mark difficult boxes. shape = (n,)
+            det:            optional flags that mark boxes as already detected. shape = (n,)
+        '''
+        self.classes = list(classes)
+        self.num_images = num_images
+        self._class_lookup = {cls: i for i, cls in enumerate(self.classes)}
+
+        num_boxes = len(image_indices)
+        image_indices = np.asarray(image_indices, dtype=np.int64)
+        class_indices = np.asarray(class_indices, dtype=np.int64)
+        # the boxes of a class and image keep their order
+        order = np.argsort(class_indices * num_images + image_indices, kind='mergesort')
+
+        self.boxes = np.ascontiguousarray(np.asarray(boxes, dtype=float).reshape((num_boxes, -1))[order, :4])
+        self.image_indices = image_indices[order]
+        self.class_indices = class_indices[order]
+        self.difficult = np.zeros(num_boxes, dtype=bool) if difficult is None else np.asarray(difficult, dtype=bool)[order]
+        self._initial_det = np.zeros(num_boxes, dtype=bool) if det is None else np.asarray(det, dtype=bool)[order]
+        self.det = self._initial_det.copy()
+
+        self.class_offsets = np.searchsorted(self.class_indices, np.arange(len(self.classes) + 1))
+        self._image_offsets = {}
+
+    @classmethod
+    def from_image_boxes(cls, classes, gt_boxes_per_image, difficult_per_image=None):
+        '''
+        Builds the store from the ground truth boxes of every image as (x1, y1, x2, y2, class index) rows.
+        '''
+        counts = [len(gt_boxes) for gt_boxes in gt_boxes_per_image]
+        rows = [np.asarray(gt_boxes, dtype=float).reshape((-1, 5)) for gt_boxes in gt_boxes_per_image if len(gt_boxes) > 0]
+        rows = np.concatenate(rows) if len(rows) > 0 else np.zeros((0, 5))
+        difficult = None
+        if difficult_per_image is not None:
+            difficult = np.concatenate([np.asarray(d, dtype=bool) for d in difficult_per_image] + [np.zeros(0, dtype=bool)])
+        image_indices = np.repeat(np.arange(len(counts)), counts)
+        return cls(classes, len(counts), rows[:, :4], image_indices, rows[:, 4].astype(np.int64), difficult)
+
+    @classmethod
+    def from_gt_infos(cls, all_gt_infos, classes):
+        '''
+        Builds the store from ground truth infos in the format of evaluate_detections:
+        {'class_A': [{'bbox': array([[ 376.,  210.,  456.,  288.,   10.]], dtype=float32), 'det': [False], 'difficult': [False]}, ... ]}
+        '''
+        num_images = max([len(all_gt_infos.get(c, [])) for c in classes] + [0])
+        boxes, image_indices, class_indices, difficult, det = [np.zeros((0, 4))], [], [], [], []
+        for class_index, class_name in enumerate(classes):
+            for image_index, R in enumerate(all_gt_infos.get(class_name, [])):
+                count = len(R['bbox'])
+                if count == 0:
+                    continue
+                boxes.append(np.asarray(R['bbox'], dtype=float)[:, :4])
+                image_indices.append(np.full(count, image_index, dtype=np.int64))
+                class_indices.append(np.full(count, class_index, dtype=np.int64))
+                difficult.extend(R['difficult'])
+                det.extend(R['det'])
+        image_indices = np.concatenate(image_indices) if len(image_indices) > 0 else np.zeros(0, dtype=np.int64)
+        class_indices = np.concatenate(class_indices) if len(class_indices) > 0 else np.zeros(0, dtype=np.int64)
+        return cls(classes, num_images, np.concatenate(boxes), image_indices, class_indices,
+                   np.array(difficult, dtype=bool), np.array(det, dtype=bool))
+
+    def reset(self):
+        '''
+        Restores the initial 'det' flags of all boxes.
+        '''
+        np.copyto(self.det, self._initial_det)
+
+    def class_index(self, class_name):
+        return self._class_lookup[class_name]
+
+    def num_boxes(self, class_name):
+        class_index = self.class_index(class_name)
+        return int(self.class_offsets[class_index + 1] - self.class_offsets[class_index])
+
+    def class_gt(self, class_name):
+        '''
+        Returns the boxes, difficult flags and det flags of a class as views of the store and the offsets of the
+        images, the boxes of image i are rows offsets[i]:offsets[i+1].
+        '''
+        class_index = self.class_index(class_name)
+        start, end = self.class_offsets[class_index], self.class_offsets[class_index + 1]
+        offsets = self._image_offsets.get(class_index)
+        if offsets is None:
+            offsets = np.searchsorted(self.image_indices[start:end], np.arange(self.num_images + 1))
+            self._image_offsets[class_index] = offsets
+        return self.boxes[start:end], self.difficult[start:end], self.det[start:end], offsets
+
+    def image_boxes(self, class_names, image_index):
+        '''
+        Returns the boxes of the given classes in an image, stacked in the order of the classes.
+        '''
+        boxes = []
+        for class_name in class_names:
+            class_boxes, _, _, offsets = self.class_gt(class_name)
+            boxes.append(class_boxes[offsets[image_index]:offsets[image_index + 1]])
+        return np.concatenate(boxes) if len(boxes) > 0 else np.zeros((0, 4))
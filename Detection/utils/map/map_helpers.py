@@ -5,41 +5,46 @@
 
 import os
 import numpy as np
+from collections import OrderedDict
 
 from utils.nms.nms_wrapper import apply_nms_to_test_set_results
+from utils.map.ground_truth_store import GroundTruthStore
 
-def evaluate_detections(all_boxes, all_gt_infos, classes, use_07_metric=False, apply_mms=True, nms_threshold=0.5, conf_threshold=0.0, soft=False, confusions=None):
+# IoU thresholds 0.50:0.05:0.95 and object size ranges (box area in pixels) of the COCO evaluation
+COCO_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+COCO_AREA_RANGES = OrderedDict([('small', (0, 32 ** 2)), ('medium', (32 ** 2, 96 ** 2)), ('large', (96 ** 2, np.inf))])
+
+def evaluate_detections(all_boxes, all_gt_infos, classes, use_07_metric=False, apply_mms=True, nms_threshold=0.5, conf_threshold=0.0, soft=False, confusions=None,
+                        nms_num_workers=1, nms_use_processes=False):
     '''
     Computes per-class average precision.
 
     Args:
         all_boxes:          shape of all_boxes: e.g. 21 classes x 4952 images x 58 rois x 5 coords+score
-        all_gt_infos:       a dictionary that contains all ground truth annoations in the following form:
+        all_gt_infos:       a GroundTruthStore or a dictionary that contains all ground truth annoations in the following form:
                             {'class_A': [{'bbox': array([[ 376.,  210.,  456.,  288.,   10.]], dtype=float32), 'det': [False], 'difficult': [False]}, ... ]}
                             'class_B': [ <bbox_list> ], <more_class_to_bbox_list_entries> }
+                            A store is reset before the evaluation and has the matched boxes marked as detected afterwards.
         classes:            a list of class name, e.g. ['__background__', 'avocado', 'orange', 'butter']
         use_07_metric:      whether to use VOC07's 11 point AP computation (default False)
         apply_mms:          whether to apply non maximum suppression before computing average precision values
         nms_threshold:      the threshold for discarding overlapping ROIs in nms
         conf_threshold:     a minimum value for the score of an ROI. ROIs with lower score will be discarded
+        nms_num_workers:    the number of workers that apply nms to the (class, image) results in parallel
+        nms_use_processes:  use worker processes instead of threads for nms
 
     Returns:
         aps - average precision value per class in a dictionary {classname: ap}
     '''
 
-    if apply_mms:
-        print ("Number of rois before non-maximum suppression: %d" % sum([len(all_boxes[i][j]) for i in range(len(all_boxes)) for j in range(len(all_boxes[0]))]))
-        nms_dets,_ = apply_nms_to_test_set_results(all_boxes, nms_threshold, conf_threshold, soft)
-        print ("Number of rois  after non-maximum suppression: %d" % sum([len(nms_dets[i][j]) for i in range(len(all_boxes)) for j in range(len(all_boxes[0]))]))
-    else:
-        print ("Skipping non-maximum suppression")
-        nms_dets = all_boxes
+    gt_store = _as_gt_store(all_gt_infos, classes)
+    nms_dets = _apply_nms(all_boxes, apply_mms, nms_threshold, conf_threshold, soft, nms_num_workers, nms_use_processes)
 
     aps = {}
     fp_errors = {}
     for classIndex, className in enumerate(classes):
         if className != '__background__':
-            rec, prec, ap, fp_error = _evaluate_detections(classIndex, className, nms_dets, all_gt_infos, use_07_metric=use_07_metric, confusions=confusions)
+            rec, prec, ap, fp_error = _evaluate_detections(classIndex, className, nms_dets, gt_store, use_07_metric=use_07_metric, confusions=confusions)
             aps[className] = ap
             if fp_error is not None:
                 fp_errors[className] = fp_error
@@ -49,33 +54,136 @@ def evaluate_detections(all_boxes, all_gt_infos, classes, use_07_metric=False, a
     else:
         return aps, None
 
-def _evaluate_detections(classIndex, className, all_boxes, all_gt_infos, overlapThreshold=0.5, use_07_metric=False, confusions=None):
+def evaluate_detections_coco(all_boxes, all_gt_infos, classes, iou_thresholds=COCO_IOU_THRESHOLDS, area_ranges=COCO_AREA_RANGES,
+                             max_detections=(1, 10, 100), use_07_metric=False, apply_mms=True, nms_threshold=0.5,
+                             conf_threshold=0.0, soft=False, nms_num_workers=1, nms_use_processes=False):
+    '''
+    Computes COCO-style metrics from a single matching pass: the overlaps of the detections with the ground truth
+    boxes are computed once per class and the greedy assignment of evaluate_detections is repeated for every
+    IoU threshold, so the AP at IoU 0.5 is the same as the one of evaluate_detections.
+
+    Args:
+        all_boxes, all_gt_infos, classes, use_07_metric and the nms arguments are the same as for evaluate_detections
+        iou_thresholds:     the IoU thresholds to evaluate at
+        area_ranges:        {name: (min_area, max_area)} of the object sizes for the AP by size. Ground truth boxes
+                            outside the range are ignored, as are unmatched detections outside the range.
+        max_detections:     the numbers of top scoring detections per image to compute the recall for
+
+    Returns:
+        a dictionary with
+            iou_thresholds  - the IoU thresholds
+            ap              - {classname: AP per IoU threshold}
+            ap_by_size      - {size name: {classname: AP per IoU threshold}}
+            recall          - {max detections: {classname: recall per IoU threshold}}
+            summary         - mAP@[.50:.95], mAP@.50, mAP@.75, mAP per size and AR@max detections averaged over the
+                              IoU thresholds and classes. Classes without ground truth boxes are not included.
+    '''
+    gt_store = _as_gt_store(all_gt_infos, classes)
+    nms_dets = _apply_nms(all_boxes, apply_mms, nms_threshold, conf_threshold, soft, nms_num_workers, nms_use_processes)
+    iou_thresholds = np.asarray(iou_thresholds)
+    report = {'iou_thresholds': iou_thresholds,
+              'ap': OrderedDict(),
+              'ap_by_size': OrderedDict((size, OrderedDict()) for size in area_ranges),
+              'recall': OrderedDict((k, OrderedDict()) for k in max_detections)}
+
+    all_ranges = OrderedDict([('all', (-np.inf, np.inf))] + list(area_ranges.items()))
+    for classIndex, className in enumerate(classes):
+        if className == '__background__':
+            continue
+
+        detConfidences, detImgIndices, detBboxes = _parse_class_detections(classIndex, nms_dets)
+        gt_boxes, gt_difficult, gt_det, gt_offsets = gt_store.class_gt(className)
+        if len(detBboxes) == 0:
+            detBboxes = np.zeros((0, 4))
+        _, BB, image_ids, ovmax, gt_index = _match_detections(gt_boxes, gt_offsets, detConfidences, detImgIndices, detBboxes)
+        det_rank = np.zeros(len(BB), dtype=int)
+        for _, det_inds in _group_by_image(image_ids):
+            det_rank[det_inds] = np.arange(len(det_inds))
+
+        gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0] + 1.) * (gt_boxes[:, 3] - gt_boxes[:, 1] + 1.)
+        det_areas = (BB[:, 2] - BB[:, 0] + 1.) * (BB[:, 3] - BB[:, 1] + 1.)
+        for size, (min_area, max_area) in all_ranges.items():
+            gt_outside = (gt_areas < min_area) | (gt_areas > max_area)
+            det_outside = (det_areas < min_area) | (det_areas > max_area)
+            # difficult ground truth boxes are ignored but counted, as in evaluate_detections
+            npos = np.sum(~gt_outside)
+
+            aps = np.full(len(iou_thresholds), np.nan)
+            recalls = np.full((len(max_detections), len(iou_thresholds)), np.nan)
+            for t, ovthresh in enumerate(iou_thresholds):
+                if npos == 0:
+                    continue
+                matched, candidates, first = _assign_detections(ovmax, gt_index, ovthresh, gt_difficult | gt_outside, gt_det)
+                tp = np.zeros(len(BB))
+                tp[first] = 1.
+                fp = np.zeros(len(BB))
+                fp[candidates] = 1.
+                fp[first] = 0.
+                fp[~matched & ~det_outside] = 1.
+
+                if size == 'all':
+                    for k, max_dets in enumerate(max_detections):
+                        recalls[k, t] = np.sum(tp[det_rank < max_dets]) / float(npos)
+
+                _, _, aps[t] = _precision_recall_ap(tp, fp, npos, use_07_metric)
+
+            if size == 'all':
+                report['ap'][className] = aps
+                for k, max_dets in enumerate(max_detections):
+                    report['recall'][max_dets][className] = recalls[k]
+            else:
+                report['ap_by_size'][size][className] = aps
+
+    report['summary'] = _summarize_coco_report(report)
+    return report
+
+def _summarize_coco_report(report):
+    def mean_over_classes(values_by_class, t=None):
+        values = [v if t is None else v[t:t+1] for v in values_by_class.values()]
+        values = [np.mean(v) for v in values if not np.all(np.isnan(v))]
+        return np.mean(values) if len(values) > 0 else np.nan
+
+    iou_thresholds = report['iou_thresholds']
+    summary = OrderedDict()
+    summary['mAP@[{:.2f}:{:.2f}]'.format(iou_thresholds[0], iou_thresholds[-1])] = mean_over_classes(report['ap'])
+    for ovthresh in [0.5, 0.75]:
+        t = np.where(np.isclose(iou_thresholds, ovthresh))[0]
+        if len(t) > 0:
+            summary['mAP@{:.2f}'.format(ovthresh)] = mean_over_classes(report['ap'], t[0])
+    for size, aps in report['ap_by_size'].items():
+        summary['mAP_{}'.format(size)] = mean_over_classes(aps)
+    for max_dets, recalls in report['recall'].items():
+        summary['AR@{}'.format(max_dets)] = mean_over_classes(recalls)
+    return summary
+
+def _as_gt_store(all_gt_infos, classes):
+    if isinstance(all_gt_infos, GroundTruthStore):
+        all_gt_infos.reset()
+        return all_gt_infos
+    return GroundTruthStore.from_gt_infos(all_gt_infos, classes)
+
+def _apply_nms(all_boxes, apply_mms, nms_threshold, conf_threshold, soft, nms_num_workers, nms_use_processes):
+    if apply_mms:
+        print ("Number of rois before non-maximum suppression: %d" % sum([len(all_boxes[i][j]) for i in range(len(all_boxes)) for j in range(len(all_boxes[0]))]))
+        nms_dets,_ = apply_nms_to_test_set_results(all_boxes, nms_threshold, conf_threshold, soft,
+                                                   num_workers=nms_num_workers, use_processes=nms_use_processes)
+        print ("Number of rois  after non-maximum suppression: %d" % sum([len(nms_dets[i][j]) for i in range(len(all_boxes)) for j in range(len(all_boxes[0]))]))
+    else:
+        print ("Skipping non-maximum suppression")
+        nms_dets = all_boxes
+    return nms_dets
+
+def _evaluate_detections(classIndex, className, all_boxes, gt_store, overlapThreshold=0.5, use_07_metric=False, confusions=None):
     '''
     Top level function that does the PASCAL VOC evaluation.
     '''
 
-    # parse detections for this class
-    # shape of all_boxes: e.g. 21 classes x 4952 images x 58 rois x 5 coords+score
-    num_images = len(all_boxes[0])
-    detBboxes = []
-    detImgIndices = []
-    detConfidences = []
-    for imgIndex in range(num_images):
-        dets = all_boxes[classIndex][imgIndex]
-        if dets != []:
-            for k in range(dets.shape[0]):
-                detImgIndices.append(imgIndex)
-                # access the last element of k-th roi
-                detConfidences.append(dets[k, -1])
-                # the VOCdevkit expects 1-based indices
-                detBboxes.append([dets[k, 0] + 1, dets[k, 1] + 1, dets[k, 2] + 1, dets[k, 3] + 1])
-    detBboxes = np.array(detBboxes)
-    detConfidences = np.array(detConfidences)
+    detConfidences, detImgIndices, detBboxes = _parse_class_detections(classIndex, all_boxes)
 
     # compute precision / recall / ap
     rec, prec, ap, fp_error = _voc_computePrecisionRecallAp(
         className,
-        all_gt_infos=all_gt_infos,
+        gt_store=gt_store,
         confidence=detConfidences,
         image_ids=detImgIndices,
         BB=detBboxes,
@@ -84,6 +192,24 @@ def _evaluate_detections(classIndex, className, all_boxes, all_gt_infos, overlap
         confusions=confusions)
     return rec, prec, ap, fp_error
 
+def _parse_class_detections(classIndex, all_boxes):
+    '''
+    Returns the confidence, image index and (1-based) box of all detections of a class.
+    '''
+    # shape of all_boxes: e.g. 21 classes x 4952 images x 58 rois x 5 coords+score
+    num_images = len(all_boxes[0])
+    img_dets = [(imgIndex, all_boxes[classIndex][imgIndex]) for imgIndex in range(num_images)
+                if len(all_boxes[classIndex][imgIndex]) > 0]
+    if len(img_dets) == 0:
+        return np.array([]), np.array([], dtype=int), np.array([])
+
+    detImgIndices = np.concatenate([np.full(len(dets), imgIndex, dtype=int) for imgIndex, dets in img_dets])
+    # access the last element of each roi
+    detConfidences = np.concatenate([dets[:, -1] for _, dets in img_dets])
+    # the VOCdevkit expects 1-based indices
+    detBboxes = np.concatenate([dets[:, :4] + 1 for _, dets in img_dets])
+    return detConfidences, detImgIndices, detBboxes
+
 def computeAveragePrecision(recalls, precisions, use_07_metric=False):
     '''
     Computes VOC AP given precision and recall.
@@ -104,8 +230,7 @@ def computeAveragePrecision(recalls, precisions, use_07_metric=False):
         mprecisions = np.concatenate(([0.], precisions, [0.]))
 
         # compute the precision envelope
-        for i in range(mprecisions.size - 1, 0, -1):
-            mprecisions[i - 1] = np.maximum(mprecisions[i - 1], mprecisions[i])
+        mprecisions = np.maximum.accumulate(mprecisions[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -115,27 +240,46 @@ def computeAveragePrecision(recalls, precisions, use_07_metric=False):
         ap = np.sum((mrecalls[i + 1] - mrecalls[i]) * mprecisions[i + 1])
     return ap
 
-def _voc_computePrecisionRecallAp(className, all_gt_infos, confidence, image_ids, BB, ovthresh=0.5, use_07_metric=False, confusions=None):
+def _voc_computePrecisionRecallAp(className, gt_store, confidence, image_ids, BB, ovthresh=0.5, use_07_metric=False, confusions=None):
     '''
     Computes precision, recall. and average precision
 
     Args:
-         class_recs: ground-truth boxes info
+         gt_store: ground-truth boxes info as GroundTruthStore
          BB: detection roi info
     '''
     if len(BB) == 0:
         return 0.0, 0.0, 0.0, None
 
-    # sort by confidence
-    sorted_ind = np.argsort(-confidence)
+    sorted_ind, tp, fp, fp_error = _voc_match_detections(className, gt_store, confidence, image_ids, BB, ovthresh, confusions)
+
+    # compute precision recall
+    npos = gt_store.num_boxes(className)
+    rec, prec, ap = _precision_recall_ap(tp, fp, npos, use_07_metric)
+    return rec, prec, ap, fp_error
+
+def _voc_match_detections(className, gt_store, confidence, image_ids, BB, ovthresh=0.5, confusions=None):
+    '''
+    Marks the detections of a class as TP or FP (both 0 for detections of difficult ground truth boxes) and the
+    ground truth boxes of the true positives as detected in the GroundTruthStore.
+
+    Returns:
+        sorted_ind - the indices of the detections in order of decreasing confidence
+        tp, fp     - per detection in the order of sorted_ind
+        fp_error   - the false positive statistics if confusions are given, otherwise None
+    '''
+    gt_boxes, gt_difficult, gt_det, gt_offsets = gt_store.class_gt(className)
+    sorted_ind, BB, image_ids, ovmax, gt_index = _match_detections(gt_boxes, gt_offsets, confidence, image_ids, BB)
 
-    BB = BB[sorted_ind, :]
-    image_ids = [image_ids[x] for x in sorted_ind]
-    
     # go down dets and mark TPs and FPs
-    nd = len(image_ids)
-    tp = np.zeros(nd)
-    fp = np.zeros(nd)
+    matched, candidates, first = _assign_detections(ovmax, gt_index, ovthresh, gt_difficult, gt_det)
+    gt_det[gt_index[first]] = True
+    tp = np.zeros(len(BB))
+    tp[first] = 1.
+    fp = np.zeros(len(BB))
+    fp[candidates] = 1.
+    fp[first] = 0.
+    fp[~matched] = 1.
 
     # statics for false positive results
     # 0:localization error, 1:confusion with similiar objects
@@ -144,58 +288,126 @@ def _voc_computePrecisionRecallAp(className, all_gt_infos, confidence, image_ids
     fp_error = None
     if confusions:
         fp_error = np.zeros(6).astype(int)
+        fp_error[5] = len(first)
+        fp_error[4] = len(candidates) - len(first)
+
+        missed = np.where(~matched)[0]
+        # localization error
+        localization_errors = ovmax[missed] >= 0.1
+        fp_error[0] = np.sum(localization_errors)
+        # confuse with objects
         conf = confusions[className]
-        sim_classes = conf[0]
-        otr_classes = conf[1]
-    
-    for d in range(nd):
-        # ground-truth boxes for particular image
-        R = all_gt_infos[className][image_ids[d]]
-        # all detected rois for particular image
-        bb = BB[d, :].astype(float)
-        ovmax, jmax = max_overlap_with_class(className, image_ids[d], all_gt_infos, bb)
-
-        if ovmax > ovthresh:
-            if not R['difficult'][jmax]:
-                if not R['det'][jmax]:
-                    tp[d] = 1.
-                    R['det'][jmax] = 1
-                    if fp_error is not None:
-                        fp_error[5] += 1
-                else:
-                    # duplicate detection on the detected gt
-                    fp[d] = 1.
-                    if fp_error is not None:
-                        fp_error[4] += 1
-        else:
-            fp[d] = 1.
+        sim_ovmax = _max_overlap_with_classes(list(conf[0]), gt_store, BB, image_ids, missed[~localization_errors])
+        otr_ovmax = _max_overlap_with_classes(list(conf[1]), gt_store, BB, image_ids, missed[~localization_errors])
+        similar = (sim_ovmax >= otr_ovmax) & (sim_ovmax > 0.1)
+        other = ~similar & (otr_ovmax >= sim_ovmax) & (otr_ovmax > 0.1)
+        fp_error[1] = np.sum(similar)
+        fp_error[2] = np.sum(other)
+        # confusion with background
+        fp_error[3] = np.sum(~similar & ~other)
 
-            if fp_error is not None:
-                # localization error
-                if ovmax >= 0.1:
-                    fp_error[0] += 1
-                else:
-                    # confuse with objects
-                    sim_ovmax_cls, sim_ovmax = max_overlap_with_classes(list(sim_classes), image_ids[d], all_gt_infos, bb)
-                    otr_ovmax_cls, otr_ovmax = max_overlap_with_classes(list(otr_classes), image_ids[d], all_gt_infos, bb)
-                    
-                    if sim_ovmax>=otr_ovmax and sim_ovmax>0.1:
-                        fp_error[1] += 1
-                    elif otr_ovmax>=sim_ovmax and otr_ovmax>0.1:
-                        fp_error[2] += 1
-                    else:
-                        # confusion with background
-                        fp_error[3] += 1
-                    
-    # compute precision recall
-    npos = sum([len(cr['bbox']) for cr in all_gt_infos[className]])
+    return sorted_ind, tp, fp, fp_error
+
+def _precision_recall_ap(tp, fp, npos, use_07_metric=False):
+    # tp and fp per detection in order of decreasing confidence
     fp = np.cumsum(fp)
     tp = np.cumsum(tp)
     rec = tp / float(npos)
     # avoid divide by zero in case the first detection matches a difficult ground truth
     prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
     ap = computeAveragePrecision(rec, prec, use_07_metric)
-    return rec, prec, ap, fp_error
+    return rec, prec, ap
+
+def _match_detections(gt_boxes, gt_offsets, confidence, image_ids, BB):
+    '''
+    Sorts the detections by confidence and computes the overlap of every detection with the best matching
+    ground truth box of its image. The ground truth boxes are given as by GroundTruthStore.class_gt.
+
+    Returns:
+        sorted_ind - the indices of the detections in order of decreasing confidence
+        BB         - the sorted detection boxes as float64
+        image_ids  - the image index of each sorted detection
+        ovmax      - the maximum overlap with a ground truth box of the image, -inf if the image has none
+        gt_index   - the index of that ground truth box in the arrays of GroundTruthStore.class_gt
+    '''
+    # sort by confidence
+    sorted_ind = np.argsort(-confidence)
+
+    BB = BB[sorted_ind, :].astype(float)
+    image_ids = np.asarray(image_ids, dtype=int)[sorted_ind]
+
+    ovmax = np.full(len(BB), -np.inf)
+    gt_index = np.zeros(len(BB), dtype=int)
+    for img_id, det_inds in _group_by_image(image_ids):
+        BBGT = gt_boxes[gt_offsets[img_id]:gt_offsets[img_id + 1]]
+        if len(BBGT) > 0:
+            overlaps = _overlaps(BB[det_inds], BBGT)
+            ovmax[det_inds] = np.max(overlaps, axis=1)
+            gt_index[det_inds] = gt_offsets[img_id] + np.argmax(overlaps, axis=1)
+    return sorted_ind, BB, image_ids, ovmax, gt_index
+
+def _assign_detections(ovmax, gt_index, ovthresh, gt_ignore, gt_det):
+    '''
+    Greedy assignment of the sorted detections: the first (highest confidence) detection that overlaps a ground
+    truth box by more than ovthresh is a TP, later ones are duplicates. Detections of ignored (e.g. difficult)
+    ground truth boxes are neither TP nor FP.
+
+    Returns:
+        matched    - mask of the detections that overlap a ground truth box by more than ovthresh
+        candidates - the indices of the detections that are matched to a ground truth box that is not ignored
+        first      - the indices of the true positives
+    '''
+    matched = ovmax > ovthresh
+    matched_ignored = np.zeros(len(ovmax), dtype=bool)
+    matched_ignored[matched] = gt_ignore[gt_index[matched]]
+    candidates = np.where(matched & ~matched_ignored)[0]
+    _, first = np.unique(gt_index[candidates], return_index=True)
+    first = candidates[first]
+    first = first[~gt_det[gt_index[first]]]
+    return matched, candidates, first
+
+def _group_by_image(image_ids):
+    # yields (image id, indices) for each image, the indices keep their (confidence) order
+    by_image = np.argsort(image_ids, kind='mergesort')
+    boundaries = np.where(np.diff(image_ids[by_image]) != 0)[0] + 1
+    for det_inds in np.split(by_image, boundaries):
+        if len(det_inds) > 0:
+            yield image_ids[det_inds[0]], det_inds
+
+def _overlaps(bb, BBGT):
+    '''
+    IoU between detections bb (n x 4) and ground truth boxes BBGT (k x 4), computed like max_overlap_with_class.
+    '''
+    ixmin = np.maximum(BBGT[np.newaxis, :, 0], bb[:, 0, np.newaxis])
+    iymin = np.maximum(BBGT[np.newaxis, :, 1], bb[:, 1, np.newaxis])
+    ixmax = np.minimum(BBGT[np.newaxis, :, 2], bb[:, 2, np.newaxis])
+    iymax = np.minimum(BBGT[np.newaxis, :, 3], bb[:, 3, np.newaxis])
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih
+
+    # union
+    uni = ((bb[:, 2, np.newaxis] - bb[:, 0, np.newaxis] + 1.) * (bb[:, 3, np.newaxis] - bb[:, 1, np.newaxis] + 1.) +
+           (BBGT[np.newaxis, :, 2] - BBGT[np.newaxis, :, 0] + 1.) *
+           (BBGT[np.newaxis, :, 3] - BBGT[np.newaxis, :, 1] + 1.) - inters)
+
+    return inters / uni
+
+def _max_overlap_with_classes(classes, gt_store, BB, image_ids, det_inds):
+    '''
+    Same as max_overlap_with_classes for the detections BB[det_inds]: the maximum overlap with the ground truth
+    boxes of the given classes in the same image, -inf if there are none and 0 if classes is empty.
+    '''
+    if classes is None or len(classes)==0:
+        return np.zeros(len(det_inds))
+
+    # the ground truth boxes of all the classes are stacked into one array per image
+    ovmax = np.full(len(det_inds), -np.inf)
+    for img_id, inds in _group_by_image(image_ids[det_inds]):
+        BBGT = gt_store.image_boxes(classes, img_id)
+        if len(BBGT) > 0:
+            ovmax[inds] = np.max(_overlaps(BB[det_inds[inds]], BBGT), axis=1)
+    return ovmax
 
 def max_overlap_with_class(className, image_id, all_gt_infos, bb):
     # ground-truth boxes for particular image
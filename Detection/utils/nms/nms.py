@@ -7,7 +7,106 @@
 
 import numpy as np
 
-def nms(dets, ovr_thresh, soft=False, conf_thresh=0.7):
+try:
+    from utils.cython_modules.cpu_nms import cpu_nms
+except ImportError:
+    cpu_nms = None
+
+NMS_BACKENDS = ('numpy', 'blocked', 'cython')
+SOFT_NMS_METHODS = ('linear', 'gaussian')
+
+def nms(dets, ovr_thresh, soft=False, conf_thresh=0.7, backend=None, soft_method='linear', sigma=0.5):
+    '''
+    Greedy non-maximum suppression. Returns the indices of the boxes to keep in order of decreasing score.
+
+    Args:
+        dets:           (x_min, y_min, x_max, y_max, score) per box. shape = (n, 5)
+        ovr_thresh:     boxes that overlap a kept box by more than this IoU are suppressed
+        soft:           decays the scores of overlapping boxes instead of suppressing them, see soft_nms
+        conf_thresh:    soft nms stops when the highest remaining score drops below this value
+        backend:        'numpy', 'blocked', 'cython' or None. None uses 'blocked' with a block size chosen by
+                        the number of boxes, which is faster than 'numpy' at every size we benchmarked
+                        (utils/benchmarks.py, benchmark_nms). 'numpy' and 'blocked' return identical results.
+                        The cython cpu_nms module also suppresses boxes with an IoU of exactly ovr_thresh and is
+                        therefore only used on request.
+        soft_method:    'linear' or 'gaussian' score decay for soft nms
+        sigma:          the width of the gaussian score decay
+    '''
+    if soft:
+        return soft_nms(dets, ovr_thresh, soft_method, sigma, conf_thresh)
+
+    if backend is None:
+        backend = 'blocked'
+
+    if backend == 'numpy':
+        return _nms_numpy(dets, ovr_thresh)
+    if backend == 'blocked':
+        return _nms_blocked(dets, ovr_thresh, _block_size(len(dets)))
+    if backend == 'cython':
+        if cpu_nms is None:
+            raise ImportError("The cython nms backend requires the compiled module utils/cython_modules/cpu_nms")
+        return cpu_nms(np.ascontiguousarray(dets, dtype=np.float32), ovr_thresh)
+    raise ValueError("Unknown nms backend '{}', expected one of {}".format(backend, NMS_BACKENDS))
+
+def soft_nms(dets, ovr_thresh, method='linear', sigma=0.5, score_thresh=0.7):
+    '''
+    Soft non-maximum suppression (Bodla et al., 2017). Repeatedly keeps the box with the highest remaining score
+    and decays the scores of the remaining boxes by their overlap with it:
+        linear:     score * (1 - IoU) if IoU > ovr_thresh
+        gaussian:   score * exp(-IoU^2 / sigma)
+    The box with the highest score is always kept, after that boxes are kept until the highest remaining
+    score is below score_thresh. Equal scores are resolved in favor of the lower index.
+    The scores in dets are not modified.
+
+    Returns the indices of the kept boxes in the order they were selected.
+    '''
+    if method not in SOFT_NMS_METHODS:
+        raise ValueError("Unknown soft nms method '{}', expected one of {}".format(method, SOFT_NMS_METHODS))
+
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    scores = dets[:, 4].copy()
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    keep = []
+    # indices of the boxes that can still be selected. Boxes whose score decayed below score_thresh are dropped
+    # from it, so the work per selected box shrinks with the number of candidates that are left.
+    remaining = np.arange(len(dets))
+    while remaining.size > 0:
+        best = np.argmax(scores[remaining])
+        i = remaining[best]
+        keep.append(i)
+
+        xx1 = np.maximum(x1[i], x1[remaining])
+        yy1 = np.maximum(y1[i], y1[remaining])
+        xx2 = np.minimum(x2[i], x2[remaining])
+        yy2 = np.minimum(y2[i], y2[remaining])
+
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[remaining] - inter)
+
+        if method == 'linear':
+            decayed = ovr > ovr_thresh
+            scores[remaining[decayed]] *= 1 - ovr[decayed]
+        else:
+            scores[remaining] *= np.exp(-(ovr * ovr) / sigma)
+
+        alive = scores[remaining] >= score_thresh
+        alive[best] = False
+        remaining = remaining[alive]
+
+    return keep
+
+def _block_size(num_boxes):
+    # smaller blocks waste less work on boxes that are suppressed by an earlier box of the same block,
+    # larger blocks need fewer python iterations. 32 is faster for the 6000-12000 RPN pre-nms boxes.
+    return 64 if num_boxes <= 2000 else 32
+
+def _nms_numpy(dets, ovr_thresh):
     x1 = dets[:, 0]
     y1 = dets[:, 1]
     x2 = dets[:, 2]
@@ -16,7 +115,7 @@ def nms(dets, ovr_thresh, soft=False, conf_thresh=0.7):
 
     areas = (x2 - x1 + 1) * (y2 - y1 + 1)
     order = scores.argsort()[::-1]
-    
+
     keep = []
     while order.size > 0:
         i = order[0]
@@ -31,19 +130,57 @@ def nms(dets, ovr_thresh, soft=False, conf_thresh=0.7):
         inter = w * h
         ovr = inter / (areas[i] + areas[order[1:]] - inter)
 
-        if soft:
-            inds = np.where(ovr > ovr_thresh)[0]
-            reduc = order[inds+1]
-            ovrs = ovr[inds]
-            scores[reduc] = scores[reduc] * (1-ovrs)
-            order = scores.argsort()[::-1]
-            order = order[[idx for idx, val in enumerate(order) if val not in keep]]
-            
-            if order.size!=0 and scores[order[0]]<conf_thresh:
-                return keep
-            
-        else:
-            inds = np.where(ovr <= ovr_thresh)[0]
-            order = order[inds + 1]
+        inds = np.where(ovr <= ovr_thresh)[0]
+        order = order[inds + 1]
 
     return keep
+
+def _nms_blocked(dets, ovr_thresh, block_size):
+    '''
+    Same result as _nms_numpy, but processes the remaining boxes in blocks of block_size boxes:
+    the greedy suppression within a block runs on the block's IoU matrix and the kept boxes of the block
+    then suppress all later boxes at once with a single (kept x remaining) IoU matrix.
+    '''
+    scores = dets[:, 4]
+    areas = (dets[:, 2] - dets[:, 0] + 1) * (dets[:, 3] - dets[:, 1] + 1)
+    order = scores.argsort()[::-1]
+
+    # coordinates and areas in score order, one row each
+    boxes = np.vstack((dets[order, :4].T, areas[order]))
+
+    keep = []
+    remaining = np.arange(len(order))
+    while remaining.size > 0:
+        block = remaining[:block_size]
+        ovr = _overlaps(boxes[:, block], boxes[:, block])
+        alive = np.ones(len(block), dtype=np.bool_)
+        block_keep = []
+        for k in range(len(block)):
+            if alive[k]:
+                block_keep.append(k)
+                alive[k+1:] &= ovr[k, k+1:] <= ovr_thresh
+        block_keep = block[block_keep]
+        keep.extend(order[block_keep])
+
+        remaining = remaining[block_size:]
+        if remaining.size > 0:
+            ovr = _overlaps(boxes[:, block_keep], boxes[:, remaining])
+            remaining = remaining[np.all(ovr <= ovr_thresh, axis=0)]
+
+    return keep
+
+def _overlaps(boxes_a, boxes_b):
+    # IoU matrix between the columns of two (x1, y1, x2, y2, area) arrays, with the same arithmetic as _nms_numpy
+    w = np.minimum(boxes_a[2][:, None], boxes_b[2][None, :])
+    w -= np.maximum(boxes_a[0][:, None], boxes_b[0][None, :])
+    w += 1
+    np.maximum(w, 0.0, out=w)
+    h = np.minimum(boxes_a[3][:, None], boxes_b[3][None, :])
+    h -= np.maximum(boxes_a[1][:, None], boxes_b[1][None, :])
+    h += 1
+    np.maximum(h, 0.0, out=h)
+    w *= h
+    union = boxes_a[4][:, None] + boxes_b[4][None, :]
+    union -= w
+    w /= union
+    return w
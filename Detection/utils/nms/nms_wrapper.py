@@ -5,6 +5,7 @@
 # ==============================================================================
 
 import numpy as np
+from multiprocessing.pool import Pool, ThreadPool
 from utils.nms.nms import nms
 
 try:
@@ -49,7 +50,8 @@ def apply_nms_to_single_image_results(coords, labels, scores, nms_threshold=0.5,
     assert (len(nmsKeepIndices) == len(set(nmsKeepIndices))) # check if no roi indices was added >1 times
     return nmsKeepIndices
 
-def apply_nms_to_test_set_results(all_boxes, nms_threshold, conf_threshold, soft=False):
+def apply_nms_to_test_set_results(all_boxes, nms_threshold, conf_threshold, soft=False, num_workers=1, use_processes=False,
+                                  chunk_size=None, pool=None):
     '''
     Applies nms to the results of multiple images.
 
@@ -57,10 +59,14 @@ def apply_nms_to_test_set_results(all_boxes, nms_threshold, conf_threshold, soft
         all_boxes:      shape of all_boxes: e.g. 21 classes x 4952 images x 58 rois x 5 coords+score
         nms_threshold:  the threshold for discarding overlapping ROIs in nms
         conf_threshold: a minimum value for the score of an ROI. ROIs with lower score will be discarded
+        num_workers:    the number of workers that run the independent (class, image) nms jobs in parallel
+        use_processes:  use worker processes instead of threads
+        chunk_size:     the number of (class, image) jobs that are sent to a worker at once
+        pool:           an optional pool of num_workers workers that is used instead of starting a new one
 
     Returns:
         nms_boxes - the reduced set of rois after nms
-        nmsKeepIndices - the indices of the ROIs to keep after nms
+        nmsKeepIndices - the indices of the ROIs to keep after nms, in order of decreasing score
     '''
 
     num_classes = len(all_boxes)
@@ -69,22 +75,50 @@ def apply_nms_to_test_set_results(all_boxes, nms_threshold, conf_threshold, soft
                  for _ in range(num_classes)]
     nms_keepIndices = [[[] for _ in range(num_images)]
                  for _ in range(num_classes)]
-    for cls_ind in range(num_classes):
-        for im_ind in range(num_images):
-            dets = all_boxes[cls_ind][im_ind]
-            if dets == []:
-                continue
-            keep = nms(dets.astype(np.float32), nms_threshold, soft, conf_threshold)
-
-            # also filter out low confidences
-            if conf_threshold > 0:
-                #pdb.set_trace()
-                keep_conf_idx = np.where(dets[:, -1] > conf_threshold)
-                keep = list(set(keep_conf_idx[0]).intersection(keep))
-
-            if len(keep) == 0:
-                continue
-            nms_boxes[cls_ind][im_ind] = dets[keep, :].copy()
-            nms_keepIndices[cls_ind][im_ind] = keep
+
+    jobs = [(cls_ind, im_ind) for cls_ind in range(num_classes) for im_ind in range(num_images)
+            if len(all_boxes[cls_ind][im_ind]) > 0]
+    # the config is passed explicitly since worker processes do not see changes to cfg made at runtime
+    nms_args = (nms_threshold, conf_threshold, soft, cfg["CNTK"].NMS_BACKEND,
+                cfg["CNTK"].RESULTS_NMS_SOFT_METHOD, cfg["CNTK"].RESULTS_NMS_SOFT_SIGMA)
+
+    num_workers = min(num_workers, len(jobs))
+    if num_workers > 1:
+        if chunk_size is None:
+            chunk_size = max(1, len(jobs) // (num_workers * 4))
+        chunks = [([all_boxes[cls_ind][im_ind] for cls_ind, im_ind in jobs[start:start + chunk_size]], nms_args)
+                  for start in range(0, len(jobs), chunk_size)]
+        if pool is not None:
+            all_keep = [keep for chunk_keep in pool.map(_apply_nms_to_chunk, chunks) for keep in chunk_keep]
+        else:
+            pool = (Pool if use_processes else ThreadPool)(num_workers)
+            try:
+                all_keep = [keep for chunk_keep in pool.map(_apply_nms_to_chunk, chunks) for keep in chunk_keep]
+            finally:
+                pool.close()
+                pool.join()
+    else:
+        all_keep = _apply_nms_to_chunk(([all_boxes[cls_ind][im_ind] for cls_ind, im_ind in jobs], nms_args))
+
+    for (cls_ind, im_ind), keep in zip(jobs, all_keep):
+        if len(keep) == 0:
+            continue
+        nms_boxes[cls_ind][im_ind] = all_boxes[cls_ind][im_ind][keep, :].copy()
+        nms_keepIndices[cls_ind][im_ind] = keep
     return nms_boxes, nms_keepIndices
 
+def _apply_nms_to_chunk(args):
+    all_dets, (nms_threshold, conf_threshold, soft, backend, soft_method, sigma) = args
+    all_keep = []
+    for dets in all_dets:
+        # rois with a low confidence can not suppress rois with a higher score, so they are filtered before nms
+        candidates = np.arange(len(dets))
+        if conf_threshold > 0:
+            candidates = np.where(dets[:, -1] > conf_threshold)[0]
+        if len(candidates) == 0:
+            all_keep.append([])
+            continue
+        keep = nms(dets[candidates].astype(np.float32), nms_threshold, soft, conf_threshold, backend=backend,
+                   soft_method=soft_method, sigma=sigma)
+        all_keep.append(candidates[keep].tolist())
+    return all_keep
@@ -0,0 +1,128 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from utils.rpn.generate_anchors import generate_anchors
+
+MAX_ANCHOR_GRIDS = 4
+MAX_PADDING_GEOMETRIES = 16
+
+_anchor_grids = OrderedDict()
+_anchor_grids_lock = threading.Lock()
+
+def get_anchor_grid(height, width, feat_stride, scales=(8, 16, 32), ratios=(0.5, 1, 2)):
+    '''
+    Returns the AnchorGrid for a feature map of size (height, width). The grids of the most recently used feature map
+    sizes and anchor settings are kept, so the anchors are only computed once for the fixed input size of the network.
+    '''
+    key = (int(height), int(width), feat_stride, tuple(np.atleast_1d(scales).tolist()), tuple(ratios))
+    with _anchor_grids_lock:
+        grid = _anchor_grids.pop(key, None)
+        if grid is None:
+            grid = AnchorGrid(height, width, feat_stride, scales, ratios)
+            if len(_anchor_grids) >= MAX_ANCHOR_GRIDS:
+                _anchor_grids.popitem(last=False)
+        _anchor_grids[key] = grid
+    return grid
+
+class AnchorGrid:
+    '''
+    The anchors shifted to every cell of a feature map and the data that the rpn layers derive from them.
+    All arrays are shared between the callers and must not be modified.
+
+        anchors:    the shifted anchors ordered by (h, w, a) from slowest to fastest. shape = (height * width * A, 4)
+    '''
+
+    def __init__(self, height, width, feat_stride, scales=(8, 16, 32), ratios=(0.5, 1, 2)):
+        self.num_anchors = len(scales) * len(ratios)
+        self.anchors = _read_only(shift_anchors(generate_anchors(ratios=list(ratios), scales=np.array(scales)),
+                                                feat_stride, height, width))
+        self._lock = threading.Lock()
+        self._whctrs = {}
+        self._inside = OrderedDict()
+
+    def widths_heights_centers(self, dtype):
+        '''
+        Returns the widths, heights and x and y centers of the anchors in the given dtype as used by
+        bbox_transform_inv, see apply_bbox_deltas.
+        '''
+        dtype = np.dtype(dtype)
+        with self._lock:
+            if dtype not in self._whctrs:
+                anchors = self.anchors.astype(dtype, copy=False)
+                widths = anchors[:, 2] - anchors[:, 0] + 1.0
+                heights = anchors[:, 3] - anchors[:, 1] + 1.0
+                ctr_x = anchors[:, 0] + 0.5 * widths
+                ctr_y = anchors[:, 1] + 0.5 * heights
+                self._whctrs[dtype] = tuple(_read_only(a) for a in (widths, heights, ctr_x, ctr_y))
+            return self._whctrs[dtype]
+
+    def inside_anchors(self, im_info, allowed_border=0):
+        '''
+        Returns the indices and the coordinates (contiguous float64) of the anchors that lie inside the scaled image.
+
+        Args:
+            im_info:        (pad_width, pad_height, scaled_image_width, scaled_image_height, ...)
+            allowed_border: anchors may exceed the image by this many pixels
+        '''
+        key = (tuple(im_info[:4].tolist()), im_info.dtype.str, allowed_border)
+        with self._lock:
+            entry = self._inside.pop(key, None)
+            if entry is None:
+                entry = self._compute_inside_anchors(im_info, allowed_border)
+                if len(self._inside) >= MAX_PADDING_GEOMETRIES:
+                    self._inside.popitem(last=False)
+            self._inside[key] = entry
+            return entry
+
+    def _compute_inside_anchors(self, im_info, allowed_border):
+        padded_wh = im_info[0:2]
+        scaled_wh = im_info[2:4]
+        xy_offset = (padded_wh - scaled_wh) / 2
+        xy_min = xy_offset
+        xy_max = xy_offset + scaled_wh
+
+        all_anchors = self.anchors
+        inds_inside = np.where(
+            (all_anchors[:, 0] >= xy_min[0] - allowed_border) &
+            (all_anchors[:, 1] >= xy_min[1] - allowed_border) &
+            (all_anchors[:, 2] < xy_max[0] + allowed_border) &  # width
+            (all_anchors[:, 3] < xy_max[1] + allowed_border)    # height
+        )[0]
+        # the anchors are passed to the cython bbox_overlaps, which does not accept read-only buffers
+        anchors = np.ascontiguousarray(all_anchors[inds_inside, :], dtype=np.float64)
+        return _read_only(inds_inside), anchors
+
+
+def shift_anchors(anchors, feat_stride, height, width):
+    '''
+    Returns the anchors shifted to every cell of a feature map of size (height, width),
+    ordered by (h, w, a) from slowest to fastest. shape = (height * width * A, 4)
+    '''
+    # Enumerate all shifts
+    shift_x = np.arange(0, width) * feat_stride
+    shift_y = np.arange(0, height) * feat_stride
+    shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+    shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
+                        shift_x.ravel(), shift_y.ravel())).transpose()
+
+    # Enumerate all shifted anchors:
+    #
+    # add A anchors (1, A, 4) to
+    # cell K shifts (K, 1, 4) to get
+    # shift anchors (K, A, 4)
+    # reshape to (K*A, 4) shifted anchors
+    A = anchors.shape[0]
+    K = shifts.shape[0]
+    anchors = anchors.reshape((1, A, 4)) + \
+              shifts.reshape((1, K, 4)).transpose((1, 0, 2))
+    return anchors.reshape((K * A, 4))
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
@@ -11,6 +11,7 @@ import yaml
 import numpy as np
 import numpy.random as npr
 from utils.rpn.generate_anchors import generate_anchors
+from utils.rpn.anchor_grid import get_anchor_grid
 from utils.rpn.bbox_transform import bbox_transform
 from utils.cython_modules.cython_bbox import bbox_overlaps
 
@@ -33,12 +34,13 @@ class AnchorTargetLayer(UserFunction):
 
         # parse the layer parameter string, which must be valid YAML
         layer_params = yaml.load(self.param_str_)
-        anchor_scales = layer_params.get('scales', (8, 16, 32))
-        self._anchors = generate_anchors(scales=np.array(anchor_scales))
+        self._anchor_scales = layer_params.get('scales', (8, 16, 32))
+        self._anchors = generate_anchors(scales=np.array(self._anchor_scales))
         self._num_anchors = self._anchors.shape[0]
         self._feat_stride = layer_params['feat_stride']
         self._cfm_shape = cfm_shape
         self._determininistic_mode = deterministic
+        self._target_buffers = None
 
         if DEBUG:
             print ('anchors:')
@@ -96,11 +98,30 @@ class AnchorTargetLayer(UserFunction):
 
         # map of shape (..., H, W)
         height, width = bottom[0].shape[-2:]
-        # GT boxes (x1, y1, x2, y2, label)
-        gt_boxes = bottom[1][0,:]
-        # im_info
-        im_info = bottom[2][0]
 
+        # 1. Generate proposals from bbox deltas and shifted anchors
+        anchor_grid = get_anchor_grid(height, width, self._feat_stride, self._anchor_scales)
+
+        # the anchors are shared by all images, targets are computed per image of the batch
+        num_images = bottom[1].shape[0]
+        batch_targets = None
+        for i in range(num_images):
+            # GT boxes (x1, y1, x2, y2, label) and im_info
+            image_targets = self._compute_image_targets(anchor_grid, bottom[1][i,:], bottom[2][i], height, width)
+
+            # for CNTK: the targets of image i are at index i of the batch axis
+            if batch_targets is None:
+                batch_targets = [np.empty((num_images,) + t.shape, dtype=np.float32) for t in image_targets]
+            for batch_target, image_target in zip(batch_targets, image_targets):
+                batch_target[i] = image_target
+
+        for output_index in range(3):
+            outputs[self.outputs[output_index]] = batch_targets[output_index]
+
+        # No state needs to be passed to backward() so we just pass None
+        return None
+
+    def _compute_image_targets(self, anchor_grid, gt_boxes, im_info, height, width):
         # remove zero padded ground truth boxes
         keep = np.where(
             ((gt_boxes[:,2] - gt_boxes[:,0]) > 0) &
@@ -119,43 +140,15 @@ class AnchorTargetLayer(UserFunction):
             print ('rpn: gt_boxes.shape', gt_boxes.shape)
             #print ('rpn: gt_boxes', gt_boxes)
 
-        # 1. Generate proposals from bbox deltas and shifted anchors
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                            shift_x.ravel(), shift_y.ravel())).transpose()
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
         A = self._num_anchors
-        K = shifts.shape[0]
-        all_anchors = (self._anchors.reshape((1, A, 4)) +
-                       shifts.reshape((1, K, 4)).transpose((1, 0, 2)))
-        all_anchors = all_anchors.reshape((K * A, 4))
-        total_anchors = int(K * A)
-
-        # only keep anchors inside the image
-        padded_wh = im_info[0:2]
-        scaled_wh = im_info[2:4]
-        xy_offset = (padded_wh - scaled_wh) / 2
-        xy_min = xy_offset
-        xy_max = xy_offset + scaled_wh
-
-        inds_inside = np.where(
-            (all_anchors[:, 0] >= xy_min[0] - self._allowed_border) &
-            (all_anchors[:, 1] >= xy_min[1] - self._allowed_border) &
-            (all_anchors[:, 2] < xy_max[0] + self._allowed_border) &  # width
-            (all_anchors[:, 3] < xy_max[1] + self._allowed_border)    # height
-        )[0]
+        total_anchors = anchor_grid.anchors.shape[0]
+
+        # only keep anchors inside the image, they are cached per padding geometry by the anchor grid
+        inds_inside, anchors = anchor_grid.inside_anchors(im_info, self._allowed_border)
 
         if DEBUG:
             print ('total_anchors', total_anchors)
             print ('inds_inside', len(inds_inside))
-
-        # keep only inside anchors
-        anchors = all_anchors[inds_inside, :]
         if DEBUG:
             print ('anchors.shape', anchors.shape)
             print('gt_boxes.shape', gt_boxes.shape)
@@ -166,9 +159,13 @@ class AnchorTargetLayer(UserFunction):
 
         # overlaps between the anchors and the gt boxes
         # overlaps (ex, gt)
-        overlaps = bbox_overlaps(
-            np.ascontiguousarray(anchors, dtype=np.float),
-            np.ascontiguousarray(gt_boxes, dtype=np.float))
+        if self._determininistic_mode:
+            # the same float64 overlaps as the Caffe layer, so that the outputs are identical
+            overlaps = bbox_overlaps(
+                np.ascontiguousarray(anchors, dtype=np.float),
+                np.ascontiguousarray(gt_boxes, dtype=np.float))
+        else:
+            overlaps = _overlaps(anchors.astype(np.float32), gt_boxes.astype(np.float32, copy=False))
         argmax_overlaps = overlaps.argmax(axis=1)
         max_overlaps = overlaps[np.arange(len(inds_inside)), argmax_overlaps]
         gt_argmax_overlaps = overlaps.argmax(axis=0)
@@ -210,15 +207,16 @@ class AnchorTargetLayer(UserFunction):
                 disable_inds = npr.choice(bg_inds, size=(len(bg_inds) - num_bg), replace=False)
             labels[disable_inds] = -1
 
-        bbox_targets = np.zeros((len(inds_inside), 4), dtype=np.float32)
-        bbox_targets = _compute_targets(anchors, gt_boxes[argmax_overlaps, :])
-
-        bbox_inside_weights = np.zeros((len(inds_inside), 4), dtype=np.float32)
-        bbox_inside_weights[labels == 1, :] = np.array((1.0, 1.0, 1.0, 1.0))
+        # only the sampled positive anchors have non-zero bbox_inside_weights, so the regression targets of the
+        # other anchors are not used. They are still computed in deterministic mode to match the Caffe layer.
+        fg_inds = np.where(labels == 1)[0]
+        target_inds = np.arange(len(inds_inside)) if self._determininistic_mode else fg_inds
+        bbox_targets = _compute_targets(anchors[target_inds, :], gt_boxes[argmax_overlaps[target_inds], :])
 
         if DEBUG:
-            self._sums += bbox_targets[labels == 1, :].sum(axis=0)
-            self._squared_sums += (bbox_targets[labels == 1, :] ** 2).sum(axis=0)
+            fg_targets = bbox_targets[labels[target_inds] == 1, :]
+            self._sums += fg_targets.sum(axis=0)
+            self._squared_sums += (fg_targets ** 2).sum(axis=0)
             self._counts += np.sum(labels == 1)
             means = self._sums / self._counts
             stds = np.sqrt(self._squared_sums / self._counts - means ** 2)
@@ -228,9 +226,14 @@ class AnchorTargetLayer(UserFunction):
             print (stds)
 
         # map up to original set of anchors
-        labels = _unmap(labels, total_anchors, inds_inside, fill=-1)
-        bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, fill=0)
-        bbox_inside_weights = _unmap(bbox_inside_weights, total_anchors, inds_inside, fill=0)
+        if self._target_buffers is None or self._target_buffers.total_anchors != total_anchors:
+            self._target_buffers = _AnchorTargetBuffers(total_anchors)
+        buffers = self._target_buffers
+        buffers.reset()
+        buffers.set_labels(inds_inside, labels)
+        buffers.set_bbox_targets(inds_inside[target_inds], bbox_targets)
+        buffers.set_bbox_inside_weights(inds_inside[fg_inds])
+        labels, bbox_targets, bbox_inside_weights = buffers.labels, buffers.bbox_targets, buffers.bbox_inside_weights
 
         if DEBUG:
             print ('rpn: max max_overlap', np.max(max_overlaps))
@@ -244,28 +247,26 @@ class AnchorTargetLayer(UserFunction):
 
         # labels
         labels = labels.reshape((1, height, width, A)).transpose(0, 3, 1, 2)
-        outputs[self.outputs[0]] = np.ascontiguousarray(labels)
 
         # bbox_targets
         bbox_targets = bbox_targets.reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
-        outputs[self.outputs[1]] = np.ascontiguousarray(bbox_targets)
 
         # bbox_inside_weights
         bbox_inside_weights = bbox_inside_weights \
             .reshape((1, height, width, A * 4)).transpose(0, 3, 1, 2)
         assert bbox_inside_weights.shape[2] == height
         assert bbox_inside_weights.shape[3] == width
-        outputs[self.outputs[2]] = np.ascontiguousarray(bbox_inside_weights)
 
-        # No state needs to be passed to backward() so we just pass None
-        return None
+        # views of the reused buffers, they are only valid until the targets of the next image are computed
+        return labels, bbox_targets, bbox_inside_weights
 
     def backward(self, state, root_gradients, variables):
         """This layer does not propagate gradients."""
         pass
 
     def clone(self, cloned_inputs):
-        return AnchorTargetLayer(cloned_inputs[0], cloned_inputs[1], cloned_inputs[2], param_str=self.param_str_, cfm_shape=self._cfm_shape)
+        return AnchorTargetLayer(cloned_inputs[0], cloned_inputs[1], cloned_inputs[2], param_str=self.param_str_, cfm_shape=self._cfm_shape,
+                                 deterministic=self._determininistic_mode)
 
     def serialize(self):
         internal_state = {}
@@ -278,17 +279,58 @@ class AnchorTargetLayer(UserFunction):
         return AnchorTargetLayer(inputs[0], inputs[1], inputs[2], name=name, param_str=param_str)
 
 
-def _unmap(data, count, inds, fill=0):
-    """ Unmap a subset of item (data) back to the original set of items (of size count) """
-    if len(data.shape) == 1:
-        ret = np.empty((count, ), dtype=np.float32)
-        ret.fill(fill)
-        ret[inds] = data
-    else:
-        ret = np.empty((count, ) + data.shape[1:], dtype=np.float32)
-        ret.fill(fill)
-        ret[inds, :] = data
-    return ret
+class _AnchorTargetBuffers:
+    '''
+    The labels, bbox targets and bbox inside weights of all anchors of a feature map, ordered like the anchors.
+    The buffers are reused for every image and only the rows that were set for the previous image are reset.
+    '''
+
+    def __init__(self, total_anchors):
+        self.total_anchors = total_anchors
+        self.labels = np.full((total_anchors, ), -1, dtype=np.float32)
+        self.bbox_targets = np.zeros((total_anchors, 4), dtype=np.float32)
+        self.bbox_inside_weights = np.zeros((total_anchors, 4), dtype=np.float32)
+        self._label_inds = self._target_inds = self._weight_inds = np.zeros(0, dtype=np.int64)
+
+    def reset(self):
+        self.labels[self._label_inds] = -1
+        self.bbox_targets[self._target_inds, :] = 0
+        self.bbox_inside_weights[self._weight_inds, :] = 0
+
+    def set_labels(self, inds, labels):
+        # only the sampled anchors are set, all others are -1 (dont care)
+        self._label_inds = inds[labels != -1]
+        self.labels[self._label_inds] = labels[labels != -1]
+
+    def set_bbox_targets(self, inds, bbox_targets):
+        self._target_inds = inds
+        self.bbox_targets[inds, :] = bbox_targets
+
+    def set_bbox_inside_weights(self, inds):
+        self._weight_inds = inds
+        self.bbox_inside_weights[inds, :] = 1.0
+
+
+def _overlaps(anchors, gt_boxes):
+    '''
+    float32 version of bbox_overlaps: the IoU between the anchors (n, 4) and the gt boxes (k, >= 4). shape = (n, k)
+    '''
+    iw = np.minimum(anchors[:, 2, np.newaxis], gt_boxes[np.newaxis, :, 2])
+    iw -= np.maximum(anchors[:, 0, np.newaxis], gt_boxes[np.newaxis, :, 0])
+    iw += 1
+    np.maximum(iw, 0, out=iw)
+    ih = np.minimum(anchors[:, 3, np.newaxis], gt_boxes[np.newaxis, :, 3])
+    ih -= np.maximum(anchors[:, 1, np.newaxis], gt_boxes[np.newaxis, :, 1])
+    ih += 1
+    np.maximum(ih, 0, out=ih)
+    # intersection and union
+    iw *= ih
+    anchor_areas = (anchors[:, 2] - anchors[:, 0] + 1) * (anchors[:, 3] - anchors[:, 1] + 1)
+    gt_areas = (gt_boxes[:, 2] - gt_boxes[:, 0] + 1) * (gt_boxes[:, 3] - gt_boxes[:, 1] + 1)
+    np.add(anchor_areas[:, np.newaxis], gt_areas[np.newaxis, :], out=ih)
+    ih -= iw
+    iw /= ih
+    return iw
 
 
 def _compute_targets(ex_rois, gt_rois):
@@ -8,24 +8,33 @@ import numpy as np
 
 # compute example and gt width ctr, width and height
 # and returns optimal target deltas
-def bbox_transform(ex_rois, gt_rois):
-    ex_widths = ex_rois[:, 2] - ex_rois[:, 0] + 1.0
-    ex_heights = ex_rois[:, 3] - ex_rois[:, 1] + 1.0
-    ex_ctr_x = ex_rois[:, 0] + 0.5 * ex_widths
-    ex_ctr_y = ex_rois[:, 1] + 0.5 * ex_heights
-
-    gt_widths = gt_rois[:, 2] - gt_rois[:, 0] + 1.0
-    gt_heights = gt_rois[:, 3] - gt_rois[:, 1] + 1.0
-    gt_ctr_x = gt_rois[:, 0] + 0.5 * gt_widths
-    gt_ctr_y = gt_rois[:, 1] + 0.5 * gt_heights
-
-    targets_dx = (gt_ctr_x - ex_ctr_x) / ex_widths
-    targets_dy = (gt_ctr_y - ex_ctr_y) / ex_heights
-    targets_dw = np.log(gt_widths / ex_widths)
-    targets_dh = np.log(gt_heights / ex_heights)
-
-    targets = np.vstack(
-        (targets_dx, targets_dy, targets_dw, targets_dh)).transpose()
+#
+# the targets are computed in the dtype of the rois, e.g. float32 for float32 rois, and written to a contiguous
+# (n, 4) array or to out. If out has another dtype the targets are converted, like with .astype(out.dtype)
+def bbox_transform(ex_rois, gt_rois, out=None):
+    dtype = np.result_type(ex_rois, gt_rois, 1.0)
+    targets = out if out is not None and out.dtype == dtype else np.empty((len(ex_rois), 4), dtype=dtype)
+
+    # x and y are computed one after the other with the same temporaries
+    ex_size = np.empty(len(ex_rois), dtype=np.result_type(ex_rois, 1.0))
+    ex_ctr = np.empty_like(ex_size)
+    gt_size = np.empty(len(gt_rois), dtype=np.result_type(gt_rois, 1.0))
+    gt_ctr = np.empty_like(gt_size)
+    delta = np.empty(len(ex_rois), dtype=dtype)
+    for i in range(2):
+        _size_and_center(ex_rois, i, ex_size, ex_ctr)
+        _size_and_center(gt_rois, i, gt_size, gt_ctr)
+        # dx = (gt_ctr_x - ex_ctr_x) / ex_widths
+        np.subtract(gt_ctr, ex_ctr, out=delta)
+        np.divide(delta, ex_size, out=targets[:, i])
+        # dw = log(gt_widths / ex_widths), the log is much faster on contiguous arrays
+        np.divide(gt_size, ex_size, out=delta)
+        np.log(delta, out=delta)
+        targets[:, i + 2] = delta
+
+    if out is not None and targets is not out:
+        out[...] = targets
+        return out
     return targets
 
 # gets
@@ -38,41 +47,52 @@ def bbox_transform(ex_rois, gt_rois):
 # --> pred_x_low = pred_ctr_x - 0.5 * pred_w
 # and
 # pred_w = np.exp(dw) * widths
-def bbox_transform_inv(boxes, deltas):
+def bbox_transform_inv(boxes, deltas, out=None):
     if boxes.shape[0] == 0:
         #import pdb; pdb.set_trace()
         return np.zeros((0, deltas.shape[1]), dtype=deltas.dtype)
 
     boxes = boxes.astype(deltas.dtype, copy=False)
-
-    widths = boxes[:, 2] - boxes[:, 0] + 1.0
-    heights = boxes[:, 3] - boxes[:, 1] + 1.0
-    ctr_x = boxes[:, 0] + 0.5 * widths
-    ctr_y = boxes[:, 1] + 0.5 * heights
-
-    # avoid overflow in exp
-    dx = np.clip(deltas[:, 0::4], None, 10)
-    dy = np.clip(deltas[:, 1::4], None, 10)
-    dw = np.clip(deltas[:, 2::4], None, 10)
-    dh = np.clip(deltas[:, 3::4], None, 10)
-
-    pred_ctr_x = dx * widths[:, np.newaxis] + ctr_x[:, np.newaxis]
-    pred_ctr_y = dy * heights[:, np.newaxis] + ctr_y[:, np.newaxis]
-    pred_w = np.exp(dw) * widths[:, np.newaxis]
-    pred_h = np.exp(dh) * heights[:, np.newaxis]
-
-    pred_boxes = np.zeros(deltas.shape, dtype=deltas.dtype)
-    # x1
-    pred_boxes[:, 0::4] = pred_ctr_x - 0.5 * pred_w
-    # y1
-    pred_boxes[:, 1::4] = pred_ctr_y - 0.5 * pred_h
-    # x2
-    pred_boxes[:, 2::4] = pred_ctr_x + 0.5 * pred_w
-    # y2
-    pred_boxes[:, 3::4] = pred_ctr_y + 0.5 * pred_h
+    widths, ctr_x = _size_and_center(boxes, 0)
+    heights, ctr_y = _size_and_center(boxes, 1)
+    return apply_bbox_deltas(widths, heights, ctr_x, ctr_y, deltas, out=out)
+
+# same as bbox_transform_inv for boxes that are given by their widths, heights and centers,
+# e.g. the precomputed values of an AnchorGrid. The boxes are written to a new array or to out,
+# which may be deltas itself, and the two (n, deltas.shape[1] / 4) temporaries are reused for all coordinates.
+def apply_bbox_deltas(widths, heights, ctr_x, ctr_y, deltas, out=None):
+    pred_boxes = out if out is not None else np.empty(deltas.shape, dtype=deltas.dtype)
+    dtype = np.result_type(widths, heights, ctr_x, ctr_y, deltas)
+    num_coords = deltas.shape[1] // 4
+    pred_ctr = np.empty((len(deltas), num_coords), dtype=dtype)
+    half_size = np.empty((len(deltas), num_coords), dtype=dtype)
+
+    for i, sizes, centers in [(0, widths, ctr_x), (1, heights, ctr_y)]:
+        sizes = sizes[:, np.newaxis]
+        # avoid overflow in exp
+        np.minimum(deltas[:, i::4], 10, out=pred_ctr)
+        np.minimum(deltas[:, i + 2::4], 10, out=half_size)
+        # pred_ctr = d * sizes + centers
+        pred_ctr *= sizes
+        pred_ctr += centers[:, np.newaxis]
+        # half_size = 0.5 * exp(d_size) * sizes
+        np.exp(half_size, out=half_size, dtype=deltas.dtype)
+        half_size *= sizes
+        half_size *= 0.5
+        # x1 / y1 and x2 / y2
+        np.subtract(pred_ctr, half_size, out=pred_boxes[:, i::4])
+        np.add(pred_ctr, half_size, out=pred_boxes[:, i + 2::4])
 
     return pred_boxes
 
+# the widths (coord = 0) or heights (coord = 1) and the x or y centers of the boxes, written to size and ctr if given
+def _size_and_center(boxes, coord, size=None, ctr=None):
+    size = np.subtract(boxes[:, coord + 2], boxes[:, coord], out=size, dtype=np.result_type(boxes, 1.0))
+    size += 1.0
+    ctr = np.multiply(size, 0.5, out=ctr)
+    ctr += boxes[:, coord]
+    return size, ctr
+
 def clip_boxes(boxes, im_info):
     '''
     Clip boxes to image boundaries.
@@ -88,12 +108,11 @@ def clip_boxes(boxes, im_info):
     xy_min = xy_offset
     xy_max = xy_offset + scaled_wh
 
-    # x_min <= x1 <= x_max
-    boxes[:, 0::4] = np.maximum(np.minimum(boxes[:, 0::4], xy_max[0] - 1), xy_min[0])
-    # y_min <= y1 <= y_max
-    boxes[:, 1::4] = np.maximum(np.minimum(boxes[:, 1::4], xy_max[1] - 1), xy_min[1])
-    # x_min <= x2 <= x_max
-    boxes[:, 2::4] = np.maximum(np.minimum(boxes[:, 2::4], xy_max[0] - 1), xy_min[0])
-    # y_min <= y2 <= y_max
-    boxes[:, 3::4] = np.maximum(np.minimum(boxes[:, 3::4], xy_max[1] - 1), xy_min[1])
+    # the boxes are clipped in place, columns 0::2 are x1 and x2, columns 1::2 are y1 and y2
+    # x_min <= x1, x2 <= x_max
+    np.minimum(boxes[:, 0::2], xy_max[0] - 1, out=boxes[:, 0::2])
+    np.maximum(boxes[:, 0::2], xy_min[0], out=boxes[:, 0::2])
+    # y_min <= y1, y2 <= y_max
+    np.minimum(boxes[:, 1::2], xy_max[1] - 1, out=boxes[:, 1::2])
+    np.maximum(boxes[:, 1::2], xy_min[1], out=boxes[:, 1::2])
     return boxes
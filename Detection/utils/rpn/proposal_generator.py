@@ -0,0 +1,85 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+from collections import deque
+from multiprocessing.pool import Pool, ThreadPool
+import numpy as np
+import yaml
+from utils.rpn.anchor_grid import get_anchor_grid
+from utils.rpn.proposal_layer import compute_proposals, proposal_nms_args
+
+class ProposalGenerator:
+    '''
+    Turns the raw rpn outputs of minibatches into proposals in a pool of workers, with the same post-processing as
+    ProposalLayer: anchor shifting, bbox_transform_inv, clipping, min size filter, sort and nms.
+
+    generate() consumes the minibatches lazily, so the network evaluation of the next minibatch overlaps with the
+    post-processing of the previous ones. At most max_pending images are post-processed at the same time.
+    '''
+
+    def __init__(self, pre_nms_topN, post_nms_topN, nms_thresh, min_size, param_str=None,
+                 num_workers=4, use_processes=False, max_pending=None):
+        param_str = param_str if param_str is not None else "'feat_stride': 16\n'scales':\n - 8 \n - 16 \n - 32"
+        layer_params = yaml.load(param_str)
+        self._feat_stride = layer_params['feat_stride']
+        self._anchor_scales = tuple(layer_params.get('scales', (8, 16, 32)))
+        # the config is passed explicitly since worker processes do not see changes to cfg made at runtime
+        self._proposal_args = (pre_nms_topN, post_nms_topN, nms_thresh, min_size, proposal_nms_args())
+        self._max_pending = max_pending if max_pending is not None else 2 * max(1, num_workers)
+        self._pool = None
+        if num_workers > 0:
+            self._pool = (Pool if use_processes else ThreadPool)(num_workers)
+
+    def generate(self, minibatches):
+        '''
+        Yields the proposals of every image in the order of the minibatches.
+
+        Args:
+            minibatches:    an iterable of (rpn_cls_prob, rpn_bbox_pred, im_info) with the outputs of the rpn for a
+                            minibatch of N images. shapes = (N, 2 * A, H, W), (N, 4 * A, H, W) and (N, 6)
+
+        Yields:
+            the proposals of one image as float32 array, padded with zeros to post_nms_topN rows like the output
+            of ProposalLayer. shape = (post_nms_topN, 4)
+        '''
+        pending = deque()
+        for rpn_cls_prob, rpn_bbox_pred, im_info in minibatches:
+            num_anchors = rpn_cls_prob.shape[1] // 2
+            for i in range(len(rpn_cls_prob)):
+                # the first set of num_anchors channels are bg probs, the second set are the fg probs
+                args = (self._feat_stride, self._anchor_scales, rpn_cls_prob[i:i+1, num_anchors:],
+                        rpn_bbox_pred[i:i+1], im_info[i], self._proposal_args)
+                if self._pool is None:
+                    yield _compute_padded_proposals(args)
+                    continue
+                pending.append(self._pool.apply_async(_compute_padded_proposals, (args,)))
+
+            while len(pending) > self._max_pending:
+                yield pending.popleft().get()
+
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def _compute_padded_proposals(args):
+    feat_stride, anchor_scales, scores, bbox_deltas, im_info, proposal_args = args
+    # every worker computes the anchors once per feature map size instead of receiving them with every image
+    height, width = scores.shape[-2:]
+    anchor_grid = get_anchor_grid(height, width, feat_stride, anchor_scales)
+
+    pre_nms_topN, post_nms_topN, nms_thresh, min_size, nms_args = proposal_args
+    proposals = compute_proposals(anchor_grid, scores, bbox_deltas, im_info,
+                                  pre_nms_topN, post_nms_topN, nms_thresh, min_size, nms_args)
+    # pad with zeros if too few rois were found
+    padded_proposals = np.zeros((max(post_nms_topN, len(proposals)), 4), dtype=np.float32)
+    padded_proposals[:len(proposals)] = proposals
+    return padded_proposals
@@ -9,7 +9,8 @@ from cntk.ops.functions import UserFunction
 import numpy as np
 import yaml
 from utils.rpn.generate_anchors import generate_anchors
-from utils.rpn.bbox_transform import bbox_transform_inv, clip_boxes
+from utils.rpn.anchor_grid import get_anchor_grid
+from utils.rpn.bbox_transform import apply_bbox_deltas, clip_boxes
 from utils.nms.nms import nms
 
 try:
@@ -19,6 +20,11 @@ except ImportError:
 
 DEBUG = False
 
+# the pre-nms candidates are selected by a partial sort if TOP_K_MAX_FRACTION * k < number of anchors,
+# where k = TOP_K_MARGIN * pre_nms_topN
+TOP_K_MARGIN = 1.25
+TOP_K_MAX_FRACTION = 2
+
 class ProposalLayer(UserFunction):
     '''
     Outputs object detection proposals by applying estimated bounding-box
@@ -32,8 +38,8 @@ class ProposalLayer(UserFunction):
         # parse the layer parameter string, which must be valid YAML
         layer_params = yaml.load(self.param_str_)
         self._feat_stride = layer_params['feat_stride']
-        anchor_scales = layer_params.get('scales', (8, 16, 32))
-        self._anchors = generate_anchors(scales=np.array(anchor_scales))
+        self._anchor_scales = layer_params.get('scales', (8, 16, 32))
+        self._anchors = generate_anchors(scales=np.array(self._anchor_scales))
         self._num_anchors = self._anchors.shape[0]
 
         if DEBUG:
@@ -79,108 +85,38 @@ class ProposalLayer(UserFunction):
             min_size = cfg["TRAIN"].RPN_MIN_SIZE
 
         bottom = arguments
-        assert bottom[0].shape[0] == 1, \
-            'Only single item batches are supported'
-
-        # the first set of _num_anchors channels are bg probs
-        # the second set are the fg probs, which we want
-        scores = bottom[0][:, self._num_anchors:, :, :]
-        bbox_deltas = bottom[1]
-        im_info = bottom[2][0]
-
-        if DEBUG:
-            # im_info = (pad_width, pad_height, scaled_image_width, scaled_image_height, orig_img_width, orig_img_height)
-            # e.g.(1000, 1000, 1000, 600, 500, 300) for an original image of 600x300 that is scaled and padded to 1000x1000
-            print ('im_size: ({}, {})'.format(im_info[0], im_info[1]))
-            print ('scaled im_size: ({}, {})'.format(im_info[2], im_info[3]))
-            print ('original im_size: ({}, {})'.format(im_info[4], im_info[5]))
+        num_images = bottom[0].shape[0]
 
         # 1. Generate proposals from bbox deltas and shifted anchors
-        height, width = scores.shape[-2:]
+        height, width = bottom[0].shape[-2:]
 
         if DEBUG:
-            print ('score map size: {}'.format(scores.shape))
-
-        # Enumerate all shifts
-        shift_x = np.arange(0, width) * self._feat_stride
-        shift_y = np.arange(0, height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = np.vstack((shift_x.ravel(), shift_y.ravel(),
-                            shift_x.ravel(), shift_y.ravel())).transpose()
-
-        # Enumerate all shifted anchors:
-        #
-        # add A anchors (1, A, 4) to
-        # cell K shifts (K, 1, 4) to get
-        # shift anchors (K, A, 4)
-        # reshape to (K*A, 4) shifted anchors
-        A = self._num_anchors
-        K = shifts.shape[0]
-        anchors = self._anchors.reshape((1, A, 4)) + \
-                  shifts.reshape((1, K, 4)).transpose((1, 0, 2))
-        anchors = anchors.reshape((K * A, 4))
-
-        # Transpose and reshape predicted bbox transformations to get them
-        # into the same order as the anchors:
-        #
-        # bbox deltas will be (1, 4 * A, H, W) format
-        # transpose to (1, H, W, 4 * A)
-        # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
-        # in slowest to fastest order
-        bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
-
-        # Same story for the scores:
-        #
-        # scores are (1, A, H, W) format
-        # transpose to (1, H, W, A)
-        # reshape to (1 * H * W * A, 1) where rows are ordered by (h, w, a)
-        scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
-
-        # Convert anchors into proposals via bbox transformations
-        proposals = bbox_transform_inv(anchors, bbox_deltas)
+            print ('score map size: {}'.format(bottom[0].shape))
 
-        # 2. clip predicted boxes to image
-        proposals = clip_boxes(proposals, im_info)
+        anchor_grid = get_anchor_grid(height, width, self._feat_stride, self._anchor_scales)
 
-        # 3. remove predicted boxes with either height or width < threshold
-        # (NOTE: convert min_size to input image scale. Original size = im_info[4:6], scaled size = im_info[2:4])
-        cntk_image_scale = im_info[2] / im_info[4]
-        keep = _filter_boxes(proposals, min_size * cntk_image_scale)
-        proposals = proposals[keep, :]
-        scores = scores[keep]
-
-        # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # 5. take top pre_nms_topN (e.g. 6000)
-        order = scores.ravel().argsort()[::-1]
-        if pre_nms_topN > 0:
-            order = order[:pre_nms_topN]
-        proposals = proposals[order, :]
-        scores = scores[order]
-
-        # 6. apply nms (e.g. threshold = 0.7)
-        # 7. take after_nms_topN (e.g. 300)
-        # 8. return the top proposals (-> RoIs top)
-        keep = nms(np.hstack((proposals, scores)), nms_thresh, soft=cfg["CNTK"].RESULTS_NMS_SOFT)
-        if post_nms_topN > 0:
-            keep = keep[:post_nms_topN]
-        proposals = proposals[keep, :]
-        scores = scores[keep]
+        # the anchors are shared by all images, the remaining steps are done per image of the batch
+        all_proposals = []
+        for i in range(num_images):
+            # the first set of _num_anchors channels are bg probs
+            # the second set are the fg probs, which we want
+            scores = bottom[0][i:i+1, self._num_anchors:, :, :]
+            bbox_deltas = bottom[1][i:i+1]
+            im_info = bottom[2][i]
+            all_proposals.append(compute_proposals(anchor_grid, scores, bbox_deltas, im_info,
+                                                   pre_nms_topN, post_nms_topN, nms_thresh, min_size, proposal_nms_args()))
 
         # pad with zeros if too few rois were found
-        num_found_proposals = proposals.shape[0]
-        if num_found_proposals < post_nms_topN:
-            if DEBUG:
+        num_rois = max([post_nms_topN] + [p.shape[0] for p in all_proposals])
+        proposals = np.zeros((num_images, num_rois, 4), dtype=np.float32)
+        for i, image_proposals in enumerate(all_proposals):
+            num_found_proposals = image_proposals.shape[0]
+            if DEBUG and num_found_proposals < post_nms_topN:
                 print("Only {} proposals generated in ProposalLayer".format(num_found_proposals))
-            proposals_padded = np.zeros(((post_nms_topN,) + proposals.shape[1:]), dtype=np.float32)
-            proposals_padded[:num_found_proposals, :] = proposals
-            proposals = proposals_padded
+            proposals[i, :num_found_proposals, :] = image_proposals
 
         # Output rois blob
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        # for CNTK: add batch axis to output shape
-        proposals.shape = (1,) + proposals.shape
-
+        # for CNTK: the proposals of image i are at index i of the batch axis
         return None, proposals
 
     def backward(self, state, root_gradients, variables):
@@ -203,6 +139,122 @@ class ProposalLayer(UserFunction):
         return ProposalLayer(inputs[0], inputs[1], inputs[2], name=name, param_str=param_str)
 
 
+def compute_proposals(anchor_grid, scores, bbox_deltas, im_info, pre_nms_topN, post_nms_topN, nms_thresh, min_size, nms_args):
+    '''
+    Computes the proposals of a single image from its rpn outputs, see ProposalLayer.forward.
+
+    Args:
+        anchor_grid:    the AnchorGrid of the feature map, see get_anchor_grid
+        scores:         the foreground probabilities. shape = (1, A, H, W)
+        bbox_deltas:    the predicted bbox transformations. shape = (1, 4 * A, H, W)
+        im_info:        (pad_width, pad_height, scaled_image_width, scaled_image_height, orig_img_width, orig_img_height)
+        nms_args:       (soft, backend, soft_method, sigma) that are passed to nms, see proposal_nms_args
+
+    Returns:
+        the proposals ordered by decreasing score. shape = (n, 4), n <= post_nms_topN
+    '''
+    if DEBUG:
+        # im_info = (pad_width, pad_height, scaled_image_width, scaled_image_height, orig_img_width, orig_img_height)
+        # e.g.(1000, 1000, 1000, 600, 500, 300) for an original image of 600x300 that is scaled and padded to 1000x1000
+        print ('im_size: ({}, {})'.format(im_info[0], im_info[1]))
+        print ('scaled im_size: ({}, {})'.format(im_info[2], im_info[3]))
+        print ('original im_size: ({}, {})'.format(im_info[4], im_info[5]))
+
+    # Transpose and reshape predicted bbox transformations to get them
+    # into the same order as the anchors:
+    #
+    # bbox deltas will be (1, 4 * A, H, W) format
+    # transpose to (1, H, W, 4 * A)
+    # reshape to (1 * H * W * A, 4) where rows are ordered by (h, w, a)
+    # in slowest to fastest order
+    bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
+
+    # Same story for the scores:
+    #
+    # scores are (1, A, H, W) format
+    # transpose to (1, H, W, A)
+    # reshape to (1 * H * W * A,) where rows are ordered by (h, w, a)
+    scores = scores.transpose((0, 2, 3, 1)).reshape(-1)
+
+    # 1. - 5. decode, clip and filter the proposals and take the top pre_nms_topN (e.g. 6000)
+    proposals, scores = select_pre_nms_proposals(anchor_grid, scores, bbox_deltas, im_info, pre_nms_topN, min_size)
+
+    # 6. apply nms (e.g. threshold = 0.7)
+    # 7. take after_nms_topN (e.g. 300)
+    # 8. return the top proposals (-> RoIs top)
+    soft, backend, soft_method, sigma = nms_args
+    keep = nms(np.hstack((proposals, scores)), nms_thresh, soft=soft, backend=backend, soft_method=soft_method,
+               sigma=sigma)
+    if post_nms_topN > 0:
+        keep = keep[:post_nms_topN]
+    return proposals[keep, :]
+
+def select_pre_nms_proposals(anchor_grid, scores, bbox_deltas, im_info, pre_nms_topN, min_size):
+    '''
+    Returns the pre_nms_topN proposals with the highest scores that are at least min_size large (at original
+    image scale) and their scores, ordered from highest to lowest score. shapes = (n, 4) and (n, 1)
+
+    Args:
+        scores:         the foreground probabilities ordered like the anchors of anchor_grid. shape = (H * W * A,)
+        bbox_deltas:    the predicted bbox transformations ordered like the anchors. shape = (H * W * A, 4)
+    '''
+    # If pre_nms_topN is small compared to the number of anchors, only the anchors with the highest scores are
+    # decoded: the top k scores are selected with a partial sort, then these candidates are decoded (1.), clipped (2.)
+    # and filtered by their size (3.). k includes a margin for the candidates that are removed by the size filter and
+    # grows if fewer than pre_nms_topN candidates are left. For distinct scores the result is the same as sorting
+    # all decoded proposals, which is done if k is not small enough to pay off.
+    widths, heights, ctr_x, ctr_y = anchor_grid.widths_heights_centers(bbox_deltas.dtype)
+    min_size = min_size * im_info[2] / im_info[4]
+    num_anchors = len(scores)
+    k = int(pre_nms_topN * TOP_K_MARGIN) if pre_nms_topN > 0 else num_anchors
+    while k * TOP_K_MAX_FRACTION < num_anchors:
+        # 4. sort the k (proposal, score) pairs with the highest scores from highest to lowest
+        order = _top_k(scores, k)
+        # the gathered deltas are not used afterwards, so the proposals are decoded in place
+        proposals = bbox_deltas[order]
+        apply_bbox_deltas(widths[order], heights[order], ctr_x[order], ctr_y[order], proposals, out=proposals)
+        proposals = clip_boxes(proposals, im_info)
+        keep = _filter_boxes(proposals, min_size)
+        if len(keep) >= pre_nms_topN:
+            # 5. take top pre_nms_topN (e.g. 6000)
+            keep = keep[:pre_nms_topN]
+            return proposals[keep, :], scores[order[keep]].reshape((-1, 1))
+        # estimate the number of candidates that are needed from the fraction that passed the size filter
+        k = max(2 * k, int(k * TOP_K_MARGIN * pre_nms_topN / max(len(keep), 1)))
+
+    # 1. convert anchors into proposals via bbox transformations
+    proposals = apply_bbox_deltas(widths, heights, ctr_x, ctr_y, bbox_deltas)
+
+    # 2. clip predicted boxes to image
+    proposals = clip_boxes(proposals, im_info)
+
+    # 3. remove predicted boxes with either height or width < threshold
+    # (NOTE: convert min_size to input image scale. Original size = im_info[4:6], scaled size = im_info[2:4])
+    keep = _filter_boxes(proposals, min_size)
+    proposals = proposals[keep, :]
+    scores = scores[keep]
+
+    # 4. sort all (proposal, score) pairs by score from highest to lowest
+    # 5. take top pre_nms_topN (e.g. 6000)
+    order = scores.argsort()[::-1]
+    if pre_nms_topN > 0:
+        order = order[:pre_nms_topN]
+    return proposals[order, :], scores[order].reshape((-1, 1))
+
+def proposal_nms_args():
+    # the nms settings of the proposal layer. They are passed explicitly to compute_proposals since worker processes
+    # do not see changes to cfg made at runtime
+    return (cfg["CNTK"].RESULTS_NMS_SOFT, cfg["CNTK"].NMS_BACKEND, cfg["CNTK"].RESULTS_NMS_SOFT_METHOD,
+            cfg["CNTK"].RESULTS_NMS_SOFT_SIGMA)
+
+def _top_k(scores, k):
+    # the indices of the k highest scores ordered from highest to lowest
+    if k < len(scores):
+        top_k = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+    else:
+        top_k = np.arange(len(scores))
+    return top_k[scores[top_k].argsort()[::-1]]
+
 def _filter_boxes(boxes, min_size):
     """Remove all boxes with any side smaller than min_size."""
     ws = boxes[:, 2] - boxes[:, 0] + 1
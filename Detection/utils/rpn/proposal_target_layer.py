@@ -58,9 +58,28 @@ class ProposalTargetLayer(UserFunction):
     def forward(self, arguments, outputs, device=None, outputs_to_retain=None):
         bottom = arguments
 
-        # Proposal ROIs (0, x1, y1, x2, y2) coming from RPN
+        # for CNTK: the targets of image i are at index i of the batch axis. The outputs are allocated once per batch
+        # and zero padded if too few rois are found, the rois of every image are sampled directly into them
+        num_images = bottom[0].shape[0]
+        rois_per_image = cfg.TRAIN.BATCH_SIZE
+        rois = np.zeros((num_images, rois_per_image, 4), dtype=np.float32)
+        labels = np.zeros((num_images, rois_per_image, self._num_classes), dtype=np.float32)
+        bbox_targets = np.zeros((num_images, rois_per_image, self._num_classes * 4), dtype=np.float32)
+        bbox_inside_weights = np.zeros((num_images, rois_per_image, self._num_classes * 4), dtype=np.float32)
+
+        for i in range(num_images):
+            self._sample_image_rois(bottom[0][i,:], bottom[1][i,:], rois[i], labels[i], bbox_targets[i], bbox_inside_weights[i])
+
+        for output_index, output in enumerate([rois, labels, bbox_targets, bbox_inside_weights]):
+            outputs[self.outputs[output_index]] = output
+
+    def _sample_image_rois(self, all_rois, gt_boxes, rois_out, labels_out, bbox_targets_out, bbox_inside_weights_out):
+        '''
+        Samples the rois of one image and writes the rois, the one-hot labels, the bbox targets and the bbox inside
+        weights to the given (zero initialized) arrays with rois_per_image rows each.
+        '''
+        # Proposal ROIs (x1, y1, x2, y2) coming from RPN
         # (i.e., rpn.proposal_layer.ProposalLayer), or any other source
-        all_rois = bottom[0][0,:]
         # remove zero padded proposals
         keep0 = np.where(
             ((all_rois[:, 2] - all_rois[:, 0]) > 0) &
@@ -71,7 +90,6 @@ class ProposalTargetLayer(UserFunction):
         # GT boxes (x1, y1, x2, y2, label)
         # TODO(rbg): it's annoying that sometimes I have extra info before
         # and other times after box coordinates -- normalize to one format
-        gt_boxes = bottom[1][0,:]
         # remove zero padded ground truth boxes
         keep1 = np.where(
             ((gt_boxes[:,2] - gt_boxes[:,0]) > 0) &
@@ -88,10 +106,6 @@ class ProposalTargetLayer(UserFunction):
         zeros = np.zeros((all_rois.shape[0], 1), dtype=all_rois.dtype)
         all_rois = np.hstack((zeros, all_rois))
 
-        # Sanity check: single batch only
-        assert np.all(all_rois[:, 0] == 0), \
-                'Only single item batches are supported'
-
         rois_per_image = cfg.TRAIN.BATCH_SIZE
         fg_rois_per_image = np.round(cfg["TRAIN"].FG_FRACTION * rois_per_image).astype(int)
 
@@ -100,7 +114,8 @@ class ProposalTargetLayer(UserFunction):
         labels, rois, bbox_targets, bbox_inside_weights = _sample_rois(
             all_rois, gt_boxes, fg_rois_per_image,
             rois_per_image, self._num_classes,
-            deterministic=self._determininistic_mode)
+            deterministic=self._determininistic_mode,
+            bbox_targets=bbox_targets_out, bbox_inside_weights=bbox_inside_weights_out)
 
         if DEBUG:
             print ('num rois: {}'.format(rois_per_image))
@@ -113,52 +128,23 @@ class ProposalTargetLayer(UserFunction):
             print ('num bg avg: {}'.format(self._bg_num / self._count))
             print ('ratio: {:.3f}'.format(float(self._fg_num) / float(self._bg_num)))
 
-        # pad with zeros if too few rois were found
+        # the rows after the found rois stay zero, padded rois have the label 0
         num_found_rois = rois.shape[0]
-        if num_found_rois < rois_per_image:
-            rois_padded = np.zeros((rois_per_image, rois.shape[1]), dtype=np.float32)
-            rois_padded[:num_found_rois, :] = rois
-            rois = rois_padded
-
-            labels_padded = np.zeros((rois_per_image), dtype=np.float32)
-            labels_padded[:num_found_rois] = labels
-            labels = labels_padded
-
-            bbox_targets_padded = np.zeros((rois_per_image, bbox_targets.shape[1]), dtype=np.float32)
-            bbox_targets_padded[:num_found_rois, :] = bbox_targets
-            bbox_targets = bbox_targets_padded
-
-            bbox_inside_weights_padded = np.zeros((rois_per_image, bbox_inside_weights.shape[1]), dtype=np.float32)
-            bbox_inside_weights_padded[:num_found_rois, :] = bbox_inside_weights
-            bbox_inside_weights = bbox_inside_weights_padded
-
-        # for CNTK: get rid of batch ind zeros and add batch axis
-        rois = rois[:,1:]
-
-        # sampled rois
-        rois.shape = (1,) + rois.shape
-        outputs[self.outputs[0]] = np.ascontiguousarray(rois)
+        # for CNTK: get rid of batch ind zeros
+        rois_out[:num_found_rois, :] = rois[:, 1:]
 
         # classification labels
-        labels_as_int = [i.item() for i in labels.astype(int)]
-        labels_dense = np.eye(self._num_classes, dtype=np.float32)[labels_as_int]
-        labels_dense.shape = (1,) + labels_dense.shape # batch axis
-        outputs[self.outputs[1]] = labels_dense
-
-        # bbox_targets
-        bbox_targets.shape = (1,) + bbox_targets.shape # batch axis
-        outputs[self.outputs[2]] = np.ascontiguousarray(bbox_targets)
-
-        # bbox_inside_weights
-        bbox_inside_weights.shape = (1,) + bbox_inside_weights.shape # batch axis
-        outputs[self.outputs[3]] = np.ascontiguousarray(bbox_inside_weights)
+        classes = np.zeros(rois_per_image, dtype=int)
+        classes[:num_found_rois] = labels.astype(int)
+        labels_out[np.arange(rois_per_image), classes] = 1.0
 
     def backward(self, state, root_gradients, variables):
         """This layer does not propagate gradients."""
         pass
 
     def clone(self, cloned_inputs):
-        return ProposalTargetLayer(cloned_inputs[0], cloned_inputs[1], param_str=self.param_str_)
+        return ProposalTargetLayer(cloned_inputs[0], cloned_inputs[1], param_str=self.param_str_,
+                                   deterministic=self._determininistic_mode)
 
     def serialize(self):
         internal_state = {}
@@ -171,28 +157,34 @@ class ProposalTargetLayer(UserFunction):
         return ProposalTargetLayer(inputs[0], inputs[1], name=name, param_str=param_str)
 
 
-def _get_bbox_regression_labels(bbox_target_data, num_classes):
+def _get_bbox_regression_labels(bbox_target_data, num_classes, bbox_targets=None, bbox_inside_weights=None):
     """Bounding-box regression targets (bbox_target_data) are stored in a
     compact form N x (class, tx, ty, tw, th)
 
     This function expands those targets into the 4-of-4*K representation used
     by the network (i.e. only one class has non-zero targets).
 
+    If given, the results are written to the first N rows of the zero initialized
+    arrays bbox_targets and bbox_inside_weights.
+
     Returns:
         bbox_target (ndarray): N x 4K blob of regression targets
         bbox_inside_weights (ndarray): N x 4K blob of loss weights
     """
 
     clss = bbox_target_data[:, 0].astype(int)
-    bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
-    bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
+    if bbox_targets is None:
+        bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
+        bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
+    bbox_targets = bbox_targets[:clss.size]
+    bbox_inside_weights = bbox_inside_weights[:clss.size]
+
+    # scatter the 4 targets of every foreground roi to the columns of its class
     inds = np.where(clss > 0)[0]
-    for ind in inds:
-        cls = clss[ind]
-        start = 4 * cls
-        end = start + 4
-        bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-        bbox_inside_weights[ind, start:end] = [1.0, 1.0, 1.0, 1.0]
+    rows = inds[:, np.newaxis]
+    cols = 4 * clss[rows] + np.arange(4)
+    bbox_targets[rows, cols] = bbox_target_data[inds, 1:]
+    bbox_inside_weights[rows, cols] = 1.0
     return bbox_targets, bbox_inside_weights
 
 
@@ -211,9 +203,11 @@ def _compute_targets(ex_rois, gt_rois, labels):
 
     return np.hstack((labels[:, np.newaxis], targets)).astype(np.float32, copy=False)
 
-def _sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_classes, deterministic=False):
+def _sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_classes, deterministic=False,
+                 bbox_targets=None, bbox_inside_weights=None):
     """Generate a random sample of RoIs comprising foreground and background
-    examples.
+    examples. The regression targets are written to bbox_targets and
+    bbox_inside_weights if given, see _get_bbox_regression_labels.
     """
     # overlaps: (rois x gt_boxes)
     overlaps = bbox_overlaps(
@@ -262,6 +256,6 @@ def _sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_clas
         rois[:, 1:5], gt_boxes[gt_assignment[keep_inds], :4], labels)
 
     bbox_targets, bbox_inside_weights = \
-        _get_bbox_regression_labels(bbox_target_data, num_classes)
+        _get_bbox_regression_labels(bbox_target_data, num_classes, bbox_targets, bbox_inside_weights)
 
     return labels, rois, bbox_targets, bbox_inside_weights
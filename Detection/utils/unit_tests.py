@@ -20,6 +20,7 @@ from rpn.anchor_target_layer import AnchorTargetLayer as CntkAnchorTargetLayer
 from caffe_layers.proposal_layer import ProposalLayer as CaffeProposalLayer
 from caffe_layers.proposal_target_layer import ProposalTargetLayer as CaffeProposalTargetLayer
 from caffe_layers.anchor_target_layer import AnchorTargetLayer as CaffeAnchorTargetLayer
+from utils_tests import _write_test_images
 
 def test_proposal_layer():
     cls_prob_shape_cntk = (18,61,61)
@@ -28,8 +29,10 @@ def test_proposal_layer():
     dims_info_shape = (6,)
     im_info = [1000, 1000, 1]
 
-    # Create input tensors with values
-    cls_prob =  np.random.random_sample(cls_prob_shape_cntk).astype(np.float32)
+    # Create input tensors with values. The scores are distinct since the CNTK layer sorts only the top scores,
+    # which may order equal scores differently than the full sort of the Caffe layer
+    num_scores = int(np.prod(cls_prob_shape_cntk))
+    cls_prob = ((np.random.permutation(num_scores) + 1) / float(num_scores + 1)).reshape(cls_prob_shape_cntk).astype(np.float32)
     rpn_bbox_pred = np.random.random_sample(rpn_bbox_shape).astype(np.float32)
     dims_input = np.array([1000, 1000, 1000, 1000, 1000, 1000]).astype(np.float32)
 
@@ -59,6 +62,98 @@ def test_proposal_layer():
     assert np.allclose(cntk_proposals, caffe_proposals, rtol=0.0, atol=0.0)
     print("Verified ProposalLayer")
 
+def test_proposal_layer_batch():
+    cls_prob_shape_cntk = (18,61,61)
+    rpn_bbox_shape = (36, 61, 61)
+    dims_info_shape = (6,)
+    num_images = 3
+
+    # Create input tensors with values for a batch of images with different scaled sizes
+    cls_prob = np.random.random_sample((num_images,) + cls_prob_shape_cntk).astype(np.float32)
+    rpn_bbox_pred = np.random.random_sample((num_images,) + rpn_bbox_shape).astype(np.float32)
+    dims_input = np.array([[1000, 1000, 1000, 1000, 1000, 1000],
+                           [1000, 1000, 1000, 600, 500, 300],
+                           [1000, 1000, 750, 1000, 600, 800]]).astype(np.float32)
+
+    cls_prob_var = input_variable(cls_prob_shape_cntk)
+    rpn_bbox_var = input_variable(rpn_bbox_shape)
+    dims_info_var = input_variable(dims_info_shape)
+    cntk_layer = user_function(CntkProposalLayer(cls_prob_var, rpn_bbox_var, dims_info_var))
+
+    # the proposals of each image in the batch have to match the proposals computed for the single image
+    state, cntk_output = cntk_layer.forward({cls_prob_var: cls_prob, rpn_bbox_var: rpn_bbox_pred, dims_info_var: dims_input})
+    batch_proposals = cntk_output[next(iter(cntk_output))]
+    assert len(batch_proposals) == num_images
+
+    for i in range(num_images):
+        state, cntk_output = cntk_layer.forward({cls_prob_var: [cls_prob[i]], rpn_bbox_var: [rpn_bbox_pred[i]], dims_info_var: [dims_input[i]]})
+        single_proposals = cntk_output[next(iter(cntk_output))][0]
+        assert np.allclose(batch_proposals[i], single_proposals, rtol=0.0, atol=0.0)
+    print("Verified ProposalLayer with multiple images per batch")
+
+def test_proposal_generator():
+    from rpn.proposal_layer import cfg
+    from utils.rpn.proposal_generator import ProposalGenerator
+
+    cls_prob_shape_cntk = (18,61,61)
+    rpn_bbox_shape = (36, 61, 61)
+    dims_info_shape = (6,)
+    num_images = 5
+
+    cls_prob = np.random.random_sample((num_images,) + cls_prob_shape_cntk).astype(np.float32)
+    rpn_bbox_pred = np.random.random_sample((num_images,) + rpn_bbox_shape).astype(np.float32)
+    dims_input = np.array([[1000, 1000, 1000, 1000, 1000, 1000],
+                           [1000, 1000, 1000, 600, 500, 300],
+                           [1000, 1000, 750, 1000, 600, 800]] * 2)[:num_images].astype(np.float32)
+
+    cls_prob_var = input_variable(cls_prob_shape_cntk)
+    rpn_bbox_var = input_variable(rpn_bbox_shape)
+    dims_info_var = input_variable(dims_info_shape)
+    cntk_layer = user_function(CntkProposalLayer(cls_prob_var, rpn_bbox_var, dims_info_var))
+    state, cntk_output = cntk_layer.forward({cls_prob_var: cls_prob, rpn_bbox_var: rpn_bbox_pred, dims_info_var: dims_input})
+    cntk_proposals = cntk_output[next(iter(cntk_output))]
+
+    # the proposals have to match the ones of the layer (in eval mode) independent of the workers and minibatch sizes
+    for num_workers, use_processes in [(0, False), (2, False), (2, True)]:
+        generator = ProposalGenerator(cfg["TEST"].RPN_PRE_NMS_TOP_N, cfg["TEST"].RPN_POST_NMS_TOP_N,
+                                      cfg["TEST"].RPN_NMS_THRESH, cfg["TEST"].RPN_MIN_SIZE,
+                                      num_workers=num_workers, use_processes=use_processes, max_pending=1)
+        minibatches = [(cls_prob[s:s+2], rpn_bbox_pred[s:s+2], dims_input[s:s+2]) for s in range(0, num_images, 2)]
+        try:
+            proposals = list(generator.generate(minibatches))
+        finally:
+            generator.close()
+
+        assert len(proposals) == num_images
+        for i in range(num_images):
+            assert np.allclose(proposals[i], cntk_proposals[i], rtol=0.0, atol=0.0)
+    print("Verified ProposalGenerator")
+
+def test_select_pre_nms_proposals():
+    from utils.rpn.anchor_grid import get_anchor_grid
+    from utils.rpn.bbox_transform import bbox_transform_inv, clip_boxes
+    from utils.rpn.proposal_layer import select_pre_nms_proposals, _filter_boxes
+
+    anchor_grid = get_anchor_grid(61, 61, 16)
+    num_anchors = len(anchor_grid.anchors)
+    scores = ((np.random.permutation(num_anchors) + 1) / float(num_anchors + 1)).astype(np.float32)
+    bbox_deltas = ((np.random.random_sample((num_anchors, 4)) - 0.5) * 0.5).astype(np.float32)
+    im_info = np.array([1000, 1000, 1000, 600, 500, 300], dtype=np.float32)
+
+    # large min sizes remove most of the top k candidates, so that k has to grow
+    for pre_nms_topN, min_size in [(6000, 16), (12000, 16), (0, 16), (2000, 150), (500, 300), (50000, 16)]:
+        proposals = clip_boxes(bbox_transform_inv(anchor_grid.anchors, bbox_deltas), im_info.copy())
+        keep = _filter_boxes(proposals, min_size * im_info[2] / im_info[4])
+        order = scores[keep].argsort()[::-1]
+        if pre_nms_topN > 0:
+            order = order[:pre_nms_topN]
+
+        selected_proposals, selected_scores = select_pre_nms_proposals(anchor_grid, scores, bbox_deltas, im_info.copy(),
+                                                                       pre_nms_topN, min_size)
+        assert np.array_equal(selected_proposals, proposals[keep][order])
+        assert np.array_equal(selected_scores, scores[keep][order].reshape((-1, 1)))
+    print("Verified select_pre_nms_proposals")
+
 def test_proposal_target_layer():
     num_rois = 400
     all_rois_shape_cntk = (num_rois,4)
@@ -133,6 +228,29 @@ def test_proposal_target_layer():
     assert np.allclose(cntk_bbox_inside_weights, caffe_bbox_inside_weights, rtol=0.0, atol=0.0)
     print("Verified ProposalTargetLayer")
 
+def test_bbox_regression_labels():
+    from utils.rpn.proposal_target_layer import _get_bbox_regression_labels
+
+    num_classes = 5
+    bbox_target_data = np.array([[0, 1, 2, 3, 4],
+                                 [3, 5, 6, 7, 8],
+                                 [1, 9, 10, 11, 12]], dtype=np.float32)
+    expected_targets = np.zeros((3, 4 * num_classes), dtype=np.float32)
+    expected_targets[1, 12:16] = [5, 6, 7, 8]
+    expected_targets[2, 4:8] = [9, 10, 11, 12]
+
+    bbox_targets, bbox_inside_weights = _get_bbox_regression_labels(bbox_target_data, num_classes)
+    assert np.array_equal(bbox_targets, expected_targets)
+    assert np.array_equal(bbox_inside_weights, (expected_targets != 0).astype(np.float32))
+
+    # the results are written to the first rows of the given arrays, the padding rows stay zero
+    padded_targets = np.zeros((5, 4 * num_classes), dtype=np.float32)
+    padded_weights = np.zeros((5, 4 * num_classes), dtype=np.float32)
+    _get_bbox_regression_labels(bbox_target_data, num_classes, padded_targets, padded_weights)
+    assert np.array_equal(padded_targets[:3], expected_targets) and not padded_targets[3:].any()
+    assert np.array_equal(padded_weights[:3], bbox_inside_weights) and not padded_weights[3:].any()
+    print("Verified bbox regression labels")
+
 def test_anchor_target_layer():
     rpn_cls_score_shape_cntk = (1, 18, 61, 61)
     num_gt_boxes = 50
@@ -189,7 +307,130 @@ def test_anchor_target_layer():
     assert np.allclose(cntk_bbox_inside_w, caffe_bbox_inside_w, rtol=0.0, atol=0.0)
     print("Verified AnchorTargetLayer")
 
+def test_anchor_target_sparse_assignment():
+    from utils.rpn.anchor_target_layer import _overlaps, _AnchorTargetBuffers
+    from utils.cython_modules.cython_bbox import bbox_overlaps
+
+    # the float32 overlaps of the non-deterministic mode are close to the float64 ones of the cython implementation
+    x1y1 = np.random.random_sample((1000, 2)) * 500
+    anchors = np.hstack((x1y1, x1y1 + 10 + np.random.random_sample((1000, 2)) * 300))
+    gt_boxes = np.hstack((anchors[:20] + np.random.random_sample((20, 4)) * 20, np.ones((20, 1))))
+    expected = bbox_overlaps(np.ascontiguousarray(anchors), np.ascontiguousarray(gt_boxes))
+    assert np.allclose(_overlaps(anchors.astype(np.float32), gt_boxes.astype(np.float32)), expected, atol=1e-6)
+
+    # rows that were set for the previous image are reset for the next one
+    buffers = _AnchorTargetBuffers(10)
+    for inds, labels in [(np.array([1, 3, 5]), np.array([1, 0, -1], dtype=np.float32)),
+                         (np.array([2, 3]), np.array([0, 1], dtype=np.float32))]:
+        buffers.reset()
+        buffers.set_labels(inds, labels)
+        buffers.set_bbox_targets(inds[labels == 1], np.full((int(np.sum(labels == 1)), 4), 0.5, dtype=np.float32))
+        buffers.set_bbox_inside_weights(inds[labels == 1])
+
+    expected_labels = np.full(10, -1, dtype=np.float32)
+    expected_labels[[2, 3]] = [0, 1]
+    assert np.array_equal(buffers.labels, expected_labels)
+    assert np.array_equal(np.nonzero(buffers.bbox_targets)[0], [3, 3, 3, 3])
+    assert np.array_equal(np.nonzero(buffers.bbox_inside_weights)[0], [3, 3, 3, 3])
+    print("Verified sparse anchor target assignment")
+
+class _FakeEvalModel:
+    # stands in for the eval model of create_eval_model, the outputs of an image only depend on the image
+    def __init__(self, num_rois=40, num_classes=4):
+        self.outputs = [_FakeOutput(name) for name in ['cls_pred', 'rpn_rois', 'bbox_regr']]
+        self._num_rois = num_rois
+        self._num_classes = num_classes
+
+    def __call__(self, image_input, dims_input):
+        return self
+
+    def eval(self, arguments):
+        images, dims = sorted(arguments.values(), key=lambda a: np.asarray(a).ndim, reverse=True)
+        cls_pred, rpn_rois, bbox_regr = [], [], []
+        for image, image_dims in zip(images, dims):
+            rng = np.random.RandomState(int(np.asarray(image, dtype=np.int64).sum()) % (2 ** 31))
+            scores = rng.random_sample((self._num_rois, self._num_classes)).astype(np.float32)
+            cls_pred.append(scores / scores.sum(axis=1, keepdims=True))
+            x1y1 = rng.random_sample((self._num_rois, 2)) * image_dims[0] * 0.7
+            rpn_rois.append(np.hstack((x1y1, x1y1 + 20 + rng.random_sample((self._num_rois, 2)) * 200)).astype(np.float32))
+            bbox_regr.append((rng.random_sample((self._num_rois, 4 * self._num_classes)) - 0.5).astype(np.float32) * 0.2)
+        return dict(zip(self.outputs, [np.array(cls_pred), np.array(rpn_rois), np.array(bbox_regr)]))
+
+class _FakeOutput:
+    def __init__(self, name):
+        self.name = name
+
+def test_faster_rcnn_detector(tmpdir):
+    import cv2
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from cntk_helpers import regress_rois
+    from od_detector import FasterRCNNDetector, _to_original_image_coords
+    from od_reader import ObjectDetectionReader, _load_resize_and_pad_image
+    from utils.nms.nms_wrapper import apply_nms_to_single_image_results
+
+    num_images = 7
+    pad_size = 200
+    data_dir = str(tmpdir)
+    img_map_file, roi_map_file = _write_test_images(data_dir, num_images)
+    img_paths = [os.path.join(data_dir, "img_{}.png".format(i)) for i in range(num_images)]
+    eval_model = _FakeEvalModel()
+
+    # the per image path: regression, nms and the mapping back to the original image of every image on its own
+    expected = []
+    for img_path in img_paths:
+        model_input, img_stats, _, _ = _load_resize_and_pad_image(img_path, None, pad_size, pad_size, 114, False)
+        dims = np.array([pad_size, pad_size] + list(img_stats[:4]), dtype=np.float32)
+        output = eval_model.eval({'features': model_input[np.newaxis], 'dims': dims[np.newaxis]})
+        out_cls_pred, out_rpn_rois, out_bbox_regr = [output[o][0] for o in eval_model.outputs]
+        labels = out_cls_pred.argmax(axis=1)
+        scores = out_cls_pred.max(axis=1)
+        regressed_rois = regress_rois(out_rpn_rois, out_bbox_regr, labels, dims)
+        keep = [k for k in apply_nms_to_single_image_results(regressed_rois, labels, scores, nms_threshold=0.4,
+                                                             conf_threshold=0.0) if labels[k] > 0]
+        expected.append((_to_original_image_coords(regressed_rois[keep], img_stats, pad_size, pad_size),
+                         scores[keep], labels[keep]))
+
+    # batches of images given as paths or arrays, with a last batch that is not full
+    images = img_paths[:4] + [cv2.imread(img_path) for img_path in img_paths[4:]]
+    for batch_size in [1, 3]:
+        with FasterRCNNDetector(eval_model, pad_size, pad_size, 114, batch_size=batch_size, num_workers=2,
+                                nms_threshold=0.4) as detector:
+            detections = detector.detect(images)
+        assert len(detections) == num_images
+        for result, (boxes, scores, labels) in zip(detections, expected):
+            assert len(labels) > 0
+            assert np.array_equal(result['boxes'], boxes)
+            assert np.array_equal(result['scores'], scores) and np.array_equal(result['labels'], labels)
+
+    # the mapping to the original image inverts the scaling and padding of the ground truth by the reader
+    reader = ObjectDetectionReader(img_map_file, roi_map_file, 4, pad_size, pad_size, 114, False, False)
+    for _ in range(num_images):
+        reader.get_next_input()
+    for index in range(num_images):
+        img_stats = reader._img_stats[index]
+        rows = slice(reader._gt_offsets[index], reader._gt_offsets[index + 1])
+        boxes = _to_original_image_coords(reader._gt_boxes[rows, :4], img_stats, pad_size, pad_size)
+        scale_factor = float(pad_size) / max(img_stats[2], img_stats[3])
+        assert np.allclose(boxes, reader._gt_raw_boxes[rows, :4], rtol=0, atol=0.5 / scale_factor + 1e-4)
+
+    print("Verified FasterRCNNDetector")
+
 if __name__ == '__main__':
+    import tempfile, shutil
+
+    def run_in_tmpdir(test):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            test(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
     test_proposal_layer()
+    test_proposal_layer_batch()
+    test_proposal_generator()
+    test_select_pre_nms_proposals()
     test_proposal_target_layer()
+    test_bbox_regression_labels()
     test_anchor_target_layer()
+    test_anchor_target_sparse_assignment()
+    run_in_tmpdir(test_faster_rcnn_detector)
@@ -0,0 +1,800 @@
+# Copyright (c) Microsoft. All rights reserved.
+
+# Licensed under the MIT license. See LICENSE.md file in the project root
+# for full license information.
+# ==============================================================================
+
+# Tests that do not need CNTK, the tests of the CNTK layers and models are in unit_tests.py
+
+import os, sys
+abs_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(abs_path))
+sys.path.append(os.path.join(abs_path, ".."))
+
+import pytest
+import numpy as np
+
+def test_anchor_grid():
+    from utils.rpn.anchor_grid import get_anchor_grid, MAX_ANCHOR_GRIDS
+    from utils.rpn.generate_anchors import generate_anchors
+    from utils.rpn.bbox_transform import bbox_transform_inv, apply_bbox_deltas
+
+    height, width, feat_stride = 61, 40, 16
+    grid = get_anchor_grid(height, width, feat_stride, (8, 16, 32))
+    assert get_anchor_grid(height, width, feat_stride, [8, 16, 32]) is grid
+
+    # the anchors of cell (h, w) are the base anchors shifted by (w, h) * feat_stride
+    base_anchors = generate_anchors(scales=np.array((8, 16, 32)))
+    anchors = grid.anchors.reshape((height, width, len(base_anchors), 4))
+    assert grid.anchors.shape == (height * width * 9, 4)
+    assert np.array_equal(anchors[3, 7], base_anchors + np.array([7, 3, 7, 3]) * feat_stride)
+
+    # decoding with the cached widths, heights and centers is identical to bbox_transform_inv
+    deltas = (np.random.random_sample((len(grid.anchors), 4)).astype(np.float32) - 0.5)
+    assert np.array_equal(apply_bbox_deltas(*(grid.widths_heights_centers(np.float32) + (deltas,))),
+                          bbox_transform_inv(grid.anchors, deltas))
+
+    im_info = np.array([1000, 1000, 750, 1000, 600, 800], dtype=np.float32)
+    inds_inside, inside_anchors = grid.inside_anchors(im_info)
+    expected = np.where((grid.anchors[:, 0] >= 125) & (grid.anchors[:, 1] >= 0) &
+                        (grid.anchors[:, 2] < 875) & (grid.anchors[:, 3] < 1000))[0]
+    assert np.array_equal(inds_inside, expected)
+    assert np.array_equal(inside_anchors, grid.anchors[expected])
+    assert grid.inside_anchors(im_info.copy())[0] is inds_inside
+
+    # least recently used grids are evicted
+    for i in range(MAX_ANCHOR_GRIDS):
+        get_anchor_grid(height + i + 1, width, feat_stride, (8, 16, 32))
+    assert get_anchor_grid(height, width, feat_stride, (8, 16, 32)) is not grid
+    print("Verified AnchorGrid")
+
+def test_bbox_transform():
+    from utils.rpn.bbox_transform import bbox_transform, bbox_transform_inv, clip_boxes
+    from utils.caffe_layers.bbox_transform import bbox_transform as caffe_bbox_transform, \
+        bbox_transform_inv as caffe_bbox_transform_inv, clip_boxes as caffe_clip_boxes
+
+    for dtype in [np.float32, np.float64]:
+        x1y1 = np.random.random_sample((500, 2)) * 500
+        ex_rois = np.hstack((x1y1, x1y1 + 10 + np.random.random_sample((500, 2)) * 400)).astype(dtype)
+        gt_rois = (ex_rois + (np.random.random_sample((500, 4)) - 0.5) * 8).astype(np.float32)
+        targets = bbox_transform(ex_rois, gt_rois)
+        assert targets.flags.c_contiguous
+        assert np.array_equal(targets, caffe_bbox_transform(ex_rois, gt_rois))
+        targets_32 = bbox_transform(ex_rois, gt_rois, out=np.empty((500, 4), dtype=np.float32))
+        assert np.array_equal(targets_32, caffe_bbox_transform(ex_rois, gt_rois).astype(np.float32))
+
+        # deltas for the boxes of 3 classes, decoded into a new array and in place
+        deltas = ((np.random.random_sample((500, 12)) - 0.5) * 4).astype(dtype)
+        expected = caffe_bbox_transform_inv(ex_rois, deltas)
+        assert np.array_equal(bbox_transform_inv(ex_rois, deltas), expected)
+        assert np.array_equal(bbox_transform_inv(ex_rois, deltas, out=deltas), expected)
+
+        # no padding, so that the image boundaries are the same for both implementations
+        im_info = np.array([600, 1000, 600, 1000, 300, 500], dtype=np.float32)
+        boxes = (expected - 100) * 1.5
+        assert np.array_equal(clip_boxes(boxes.copy(), im_info), caffe_clip_boxes(boxes.copy(), (1000, 600)))
+    print("Verified bbox_transform")
+
+def test_regress_rois():
+    # cntk_helpers is imported here since adding the FasterRCNN folder to the path earlier would change the config used by the layers
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from cntk_helpers import regress_rois
+    from rpn.bbox_transform import bbox_transform_inv
+
+    num_rois = 300
+    num_classes = 17
+    x1y1 = np.random.random_sample((num_rois, 2)) * 500
+    wh = np.random.random_sample((num_rois, 2)) * 400
+    rois = np.hstack((x1y1, x1y1 + wh + 10)).astype(np.float32)
+    regression_factors = (np.random.random_sample((num_rois, num_classes * 4)) - 0.5).astype(np.float32)
+    labels = np.random.randint(0, num_classes, num_rois)
+    dims = np.array([1000, 1000, 1000, 600, 500, 300]).astype(np.float32)
+
+    # reference: regress every foreground roi separately
+    expected_rois = rois.copy()
+    for i in range(num_rois):
+        label = labels[i]
+        if label > 0:
+            deltas = regression_factors[i:i+1,label*4:(label+1)*4]
+            expected_rois[i,:] = bbox_transform_inv(expected_rois[i:i+1,:], deltas)
+
+    regressed_rois = regress_rois(rois.copy(), regression_factors, labels, None)
+    assert np.allclose(regressed_rois, expected_rois, rtol=0.0, atol=0.0)
+
+    # no foreground rois and clipping to the scaled image
+    assert np.allclose(regress_rois(rois.copy(), regression_factors, np.zeros(num_rois, dtype=int), None), rois, rtol=0.0, atol=0.0)
+    clipped_rois = regress_rois(rois.copy(), regression_factors, labels, dims)
+    assert clipped_rois[:,1].min() >= 200 and clipped_rois[:,3].max() <= 799
+    print("Verified regress_rois")
+
+def test_proposal_cache(tmpdir):
+    from collections import namedtuple
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_proposal_cache import ProposalCacheWriter, load_proposals, proposal_cache_key
+
+    Parameter = namedtuple('Parameter', ['name', 'value'])
+    RpnModel = namedtuple('RpnModel', ['parameters'])
+    weights = np.random.random_sample((18, 512)).astype(np.float32)
+    settings = {'post_nms_top_n': 2000, 'nms_thresh': 0.7}
+    key = proposal_cache_key(RpnModel([Parameter('W', weights)]), settings)
+    assert key == proposal_cache_key(RpnModel([Parameter('W', weights.copy())]), dict(settings))
+    assert key != proposal_cache_key(RpnModel([Parameter('W', weights * 2)]), settings)
+    assert key != proposal_cache_key(RpnModel([Parameter('W', weights)]), dict(settings, nms_thresh=0.5))
+
+    all_proposals = [np.random.randint(0, 1000, (n, 4)).astype(np.int16) for n in [20, 0, 7, 300]]
+    cache_dir = str(tmpdir)
+    writer = ProposalCacheWriter(cache_dir, key)
+    for proposals in all_proposals[:2]:
+        writer.append(proposals)
+    # an unfinished entry is not used
+    assert load_proposals(cache_dir, key, len(all_proposals)) is None
+    for proposals in all_proposals[2:]:
+        writer.append(proposals)
+    written = writer.close()
+
+    cached = load_proposals(cache_dir, key, len(all_proposals))
+    assert load_proposals(cache_dir, key, len(all_proposals) + 1) is None
+    for buffered in [written, cached]:
+        assert len(buffered) == len(all_proposals)
+        for i, proposals in enumerate(all_proposals):
+            assert buffered[i].dtype == np.int16
+            assert np.array_equal(buffered[i], proposals)
+    del written, cached
+
+    print("Verified proposal cache")
+
+def test_annotation_store(tmpdir):
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_reader import ObjectDetectionReader
+    from utils.annotations.annotations_helper import annotation_store_path, write_annotation_store, \
+        load_annotation_store, load_annotations, parse_roi_map_file
+
+    annotations = [np.array([[10, 20, 110, 220, 1], [0.5, 1.5, 30.25, 40, 3]], dtype=np.float32),
+                   np.zeros((0, 5), dtype=np.float32),
+                   np.array([[5, 6, 7, 8, 2]], dtype=np.float32)]
+    data_dir = str(tmpdir)
+    img_map_file = os.path.join(data_dir, "train_img_file.txt")
+    roi_map_file = os.path.join(data_dir, "train_roi_file.txt")
+    with open(img_map_file, 'w') as f:
+        f.writelines("{}\timg_{}.jpg\t0\n".format(i, i) for i in range(len(annotations)))
+    with open(roi_map_file, 'w') as f:
+        f.writelines("{} |roiAndLabel{}\n".format(i, "".join(" {}".format(v) for v in a.flatten()))
+                     for i, a in enumerate(annotations))
+
+    sequence_numbers, offsets, boxes = parse_roi_map_file(roi_map_file)
+    assert np.array_equal(sequence_numbers, [0, 1, 2]) and np.array_equal(offsets, [0, 2, 2, 3])
+    assert boxes.dtype == np.float32 and np.array_equal(boxes, np.concatenate(annotations))
+
+    # the store holds the same annotations, a store that is older than the roi map file is not used
+    store_path = annotation_store_path(roi_map_file)
+    write_annotation_store(store_path, sequence_numbers, annotations)
+    for stored, parsed in zip(load_annotation_store(store_path), (sequence_numbers, offsets, boxes)):
+        assert np.array_equal(stored, parsed)
+    write_annotation_store(store_path, sequence_numbers, annotations[::-1])
+    assert np.array_equal(load_annotations(roi_map_file)[1], [0, 1, 1, 3])
+    os.utime(store_path, (0, 0))
+    assert np.array_equal(load_annotations(roi_map_file)[1], offsets)
+
+    # the reader pads the annotations of an image when they are handed out
+    reader = ObjectDetectionReader(img_map_file, roi_map_file, max_annotations_per_image=4, pad_width=300,
+                                   pad_height=300, pad_value=114, randomize=False, use_flipping=False)
+    reader._get_image_dims(0, [300, 150, 600, 300, 75, 75, 0, 0])
+    expected = np.zeros((4, 5), dtype=np.float32)
+    expected[:2] = [[5, 85, 55, 185, 1], [0, 76, 15, 95, 3]]
+    assert np.array_equal(reader._get_gt_annotations(0, False), expected)
+    expected[:2, [0, 2]] = 300 - expected[:2, [2, 0]] - 1
+    assert np.array_equal(reader._get_gt_annotations(0, True), expected)
+    assert np.array_equal(reader._get_gt_annotations(1, True), np.zeros((4, 5)))
+
+    print("Verified annotation store")
+
+def test_reader_annotation_padding(tmpdir):
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_reader import ObjectDetectionReader
+
+    annotations = [np.array([[10, 20, 110, 220, 1], [30, 40, 50, 60, 2], [1, 2, 3, 4, 3]], dtype=np.float32),
+                   np.array([[5, 6, 7, 8, 2]], dtype=np.float32)]
+    data_dir = str(tmpdir)
+    img_map_file = os.path.join(data_dir, "train_img_file.txt")
+    roi_map_file = os.path.join(data_dir, "train_roi_file.txt")
+    with open(img_map_file, 'w') as f:
+        f.writelines("{}\timg_{}.jpg\t0\n".format(i, i) for i in range(len(annotations)))
+    with open(roi_map_file, 'w') as f:
+        f.writelines("{} |roiAndLabel{}\n".format(i, "".join(" {}".format(v) for v in a.flatten()))
+                     for i, a in enumerate(annotations))
+
+    # the rows written for the previous image are cleared in the reused buffer
+    reader = ObjectDetectionReader(img_map_file, roi_map_file, max_annotations_per_image=5, pad_width=300,
+                                   pad_height=300, pad_value=114, randomize=False, use_flipping=False)
+    padded = reader._get_gt_annotations(0, False)
+    assert padded.dtype == np.float32 and np.array_equal(padded[:3], annotations[0]) and not padded[3:].any()
+    assert reader._get_gt_annotations(1, True) is padded
+    assert np.array_equal(padded[0], [300 - 7 - 1, 6, 300 - 5 - 1, 8, 2]) and not padded[1:].any()
+
+    # the padded length does not depend on the stored boxes, images with more boxes are truncated
+    reader = ObjectDetectionReader(img_map_file, roi_map_file, max_annotations_per_image=2, pad_width=300,
+                                   pad_height=300, pad_value=114, randomize=False, use_flipping=False)
+    roi_out = np.zeros((2, 5), dtype=np.float32)
+    assert reader._get_gt_annotations(0, False, roi_out) is roi_out
+    assert np.array_equal(roi_out, annotations[0][:2])
+
+    print("Verified reader annotation padding")
+
+def _write_test_images(data_dir, num_images, map_file_prefix="train"):
+    # images of different sizes with one or two annotations each, returns the image and roi map files
+    import cv2
+    img_map_file = os.path.join(data_dir, map_file_prefix + "_img_file.txt")
+    roi_map_file = os.path.join(data_dir, map_file_prefix + "_roi_file.txt")
+    with open(img_map_file, 'w') as img_map, open(roi_map_file, 'w') as roi_map:
+        for i in range(num_images):
+            img_name = "img_{}.png".format(i)
+            img = np.random.randint(0, 256, (40 + 7 * i, 90 - 5 * i, 3)).astype(np.uint8)
+            cv2.imwrite(os.path.join(data_dir, img_name), img)
+            img_map.write("{}\t{}\t0\n".format(i, img_name))
+            rois = [[2 + i, 3, 20 + i, 30, 1 + i % 3], [5, 6, 35, 36, 2]][:1 + i % 2]
+            roi_map.write("{} |roiAndLabel{}\n".format(i, "".join(" {}".format(v) for roi in rois for v in roi)))
+    return img_map_file, roi_map_file
+
+def _read_all(reader, num_inputs):
+    # copies of (image, annotations, dims, sweep end) for the next num_inputs images
+    inputs = []
+    for _ in range(num_inputs):
+        img_data, roi_data, img_dims, _ = reader.get_next_input()
+        inputs.append((img_data.copy(), roi_data.copy(), img_dims, reader.sweep_end()))
+    return inputs
+
+def _assert_same_inputs(inputs, expected_inputs):
+    assert len(inputs) == len(expected_inputs)
+    for (img_data, roi_data, img_dims, sweep_end), expected in zip(inputs, expected_inputs):
+        assert np.array_equal(img_data, expected[0]) and np.array_equal(roi_data, expected[1])
+        assert img_dims == expected[2] and sweep_end == expected[3]
+
+def test_reader_prefetch(tmpdir):
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_reader import ObjectDetectionReader
+
+    num_images = 7
+    data_dir = str(tmpdir)
+    img_map_file, roi_map_file = _write_test_images(data_dir, num_images)
+    args = (img_map_file, roi_map_file, 4, 100, 100, 114)
+
+    # the prefetched images, annotations, dims and sweep end flags are the same as without prefetching, also
+    # across sweeps with flipping and with a reading order drawn from the global numpy RNG
+    for randomize, use_flipping in [(False, False), (False, True), (True, True)]:
+        np.random.seed(3)
+        reader = ObjectDetectionReader(*(args + (randomize, use_flipping)))
+        expected_inputs = _read_all(reader, 3 * num_images)
+        assert [sweep_end for _, _, _, sweep_end in expected_inputs].count(True) == 3
+        for use_processes in [False, True]:
+            np.random.seed(3)
+            reader = ObjectDetectionReader(*(args + (randomize, use_flipping)), prefetch_queue_depth=3,
+                                           prefetch_num_workers=2, prefetch_use_processes=use_processes)
+            _assert_same_inputs(_read_all(reader, 3 * num_images), expected_inputs)
+            assert reader.prefetch_stats()['num_samples'] == 3 * num_images
+            reader.close()
+
+    print("Verified reader prefetch")
+
+def test_image_cache(tmpdir):
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_reader import ObjectDetectionReader
+    from od_image_cache import PreprocessedImageCache, load_cached_image
+
+    num_images = 5
+    data_dir = str(tmpdir)
+    img_map_file, roi_map_file = _write_test_images(data_dir, num_images)
+    args = (img_map_file, roi_map_file, 4, 100, 100, 114, False, True)
+    cache_dir = os.path.join(data_dir, "image_cache")
+    slot_bytes = 3 * 100 * 100
+    expected_inputs = _read_all(ObjectDetectionReader(*args), 2 * num_images)
+
+    # decoded images are stored on the first sweep, cached images equal the decoded ones in both flip states
+    reader = ObjectDetectionReader(*args, image_cache_dir=cache_dir, image_cache_max_bytes=num_images * slot_bytes)
+    _assert_same_inputs(_read_all(reader, 2 * num_images), expected_inputs)
+    reader.close()
+    reader = ObjectDetectionReader(*args, image_cache_dir=cache_dir, image_cache_max_bytes=num_images * slot_bytes)
+    cache = reader._image_cache
+    entries = [cache.lookup(path, 114) for path in reader._img_file_paths]
+    assert None not in entries
+    _assert_same_inputs(_read_all(reader, 2 * num_images), expected_inputs)
+    reader.close()
+
+    # a slot that does not match its checksum is decoded again and replaced
+    slab = np.memmap(cache.slab_file, dtype=np.uint8, mode='r+', shape=(num_images,) + cache.slot_shape)
+    slab[entries[0][0]] ^= 1
+    slab.flush()
+    del slab
+    assert load_cached_image(cache.slab_file, cache.slot_shape, entries[0], False) is None
+    reader = ObjectDetectionReader(*args, image_cache_dir=cache_dir, image_cache_max_bytes=num_images * slot_bytes,
+                                   prefetch_queue_depth=2)
+    _assert_same_inputs(_read_all(reader, 2 * num_images), expected_inputs)
+    entry = reader._image_cache.lookup(reader._img_file_paths[0], 114)
+    assert load_cached_image(cache.slab_file, cache.slot_shape, entry, False) is not None
+    reader.close()
+
+    # the least recently used slot that is not pinned is reused when the cache is full
+    cache = PreprocessedImageCache(os.path.join(data_dir, "small_cache"), 100, 100, 2 * slot_bytes)
+    paths = reader._img_file_paths
+    images = [np.full((3, 100, 100), i, dtype=np.uint8) for i in range(num_images)]
+    cache.put(paths[0], 114, images[0], expected_inputs[0][2])
+    cache.put(paths[1], 114, images[1], expected_inputs[1][2])
+    pinned = cache.lookup(paths[0], 114, pin=True)
+    cache.lookup(paths[1], 114)
+    cache.put(paths[2], 114, images[2], expected_inputs[2][2])
+    assert cache.lookup(paths[1], 114) is None and cache.lookup(paths[2], 114) is not None
+    assert np.array_equal(load_cached_image(cache.slab_file, cache.slot_shape, pinned, False), images[0])
+    # nothing is stored when all slots are pinned
+    pinned_2 = cache.lookup(paths[2], 114, pin=True)
+    cache.put(paths[3], 114, images[3], expected_inputs[3][2])
+    assert cache.lookup(paths[3], 114) is None
+    cache.unpin(pinned)
+    cache.unpin(pinned_2)
+    cache.lookup(paths[2], 114)
+    cache.put(paths[3], 114, images[3], expected_inputs[3][2])
+    assert cache.lookup(paths[0], 114) is None and cache.lookup(paths[3], 114) is not None
+
+    print("Verified image cache")
+
+def test_zip_archive_pool(tmpdir):
+    import zipfile
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_reader import ObjectDetectionReader
+    from od_zip_archives import ZipArchivePool
+
+    num_images = 4
+    data_dir = str(tmpdir)
+    img_map_file, roi_map_file = _write_test_images(data_dir, num_images)
+    member_data = {"img_{}.png".format(i): open(os.path.join(data_dir, "img_{}.png".format(i)), 'rb').read()
+                   for i in range(num_images)}
+    member_data["text.txt"] = b"compressible " * 1000
+    member_data["empty.txt"] = b""
+
+    # more archives than open handles, each with stored, deflated and bzip2 members
+    archive_paths = [os.path.join(data_dir, "images_{}.zip".format(i)) for i in range(5)]
+    for archive_path in archive_paths:
+        with zipfile.ZipFile(archive_path, 'w') as zip_file:
+            for j, (name, data) in enumerate(sorted(member_data.items())):
+                zip_file.writestr(name, data, [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2][j % 3])
+
+    pool = ZipArchivePool(max_open_archives=2)
+    for _ in range(2):
+        for archive_path in archive_paths:
+            with zipfile.ZipFile(archive_path, 'r') as zip_file:
+                for name in member_data:
+                    assert pool.read(archive_path, name) == zip_file.read(name) == member_data[name]
+    assert len(pool._handles) == 2
+    # stored and deflated members are read from the memory-mapped archive, bzip2 members through zipfile
+    for data_offset, compress_type, _, _, _ in pool._members[archive_paths[0]].values():
+        assert (data_offset is None) == (compress_type == zipfile.ZIP_BZIP2)
+    with pytest.raises(KeyError):
+        pool.read(archive_paths[0], "missing.png")
+    pool.close()
+
+    # the reader decodes images inside an archive like the extracted images
+    zip_img_map_file = os.path.join(data_dir, "zip_img_file.txt")
+    with open(zip_img_map_file, 'w') as f:
+        f.writelines("{}\t{}@/img_{}.png\t0\n".format(i, os.path.basename(archive_paths[i % 5]), i)
+                     for i in range(num_images))
+    args = (roi_map_file, 4, 100, 100, 114, False, True)
+    expected_inputs = _read_all(ObjectDetectionReader(img_map_file, *args), 2 * num_images)
+    _assert_same_inputs(_read_all(ObjectDetectionReader(zip_img_map_file, *args), 2 * num_images), expected_inputs)
+
+    print("Verified zip archive pool")
+
+def test_reader_worker_shards(tmpdir):
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_reader import ObjectDetectionReader
+
+    num_images = 10
+    data_dir = str(tmpdir)
+    img_map_file, roi_map_file = _write_test_images(data_dir, num_images)
+    args = (img_map_file, roi_map_file, 4, 100, 100, 114, True, False)
+
+    for num_workers in [2, 3, 5]:
+        shard_size = (num_images + num_workers - 1) // num_workers
+        readers = [ObjectDetectionReader(*args, shuffle_seed=7) for _ in range(num_workers)]
+        for rank, reader in enumerate(readers):
+            reader.set_worker_shard(num_workers, rank)
+
+        sweep_orders = []
+        for sweep in range(2):
+            shards = [[reader._get_next_image_index() for _ in range(shard_size)] for reader in readers]
+            assert all(reader._reading_index == reader._sweep_length == shard_size for reader in readers)
+
+            # the shards have the same length and cover every image, only the images that pad the last
+            # shards to the same length are read twice
+            counts = np.bincount(np.concatenate(shards), minlength=num_images)
+            assert counts.min() == 1 and counts.sum() - num_images == shard_size * num_workers - num_images
+            if num_images % num_workers == 0:
+                assert counts.max() == 1
+            sweep_orders.append(np.array(shards).T.flatten()[:num_images])
+        assert sorted(sweep_orders[0]) == list(range(num_images))
+        assert not np.array_equal(sweep_orders[0], sweep_orders[1])
+
+    print("Verified reader worker shards")
+
+def _write_test_data_set(data_dir, num_images=6):
+    # a data set in the folder layout of the annotations helper, every third training image has no annotations
+    for subdir in ['positive', 'negative', 'testImages']:
+        os.makedirs(os.path.join(data_dir, subdir))
+        for i in range(num_images):
+            img_base = os.path.join(data_dir, subdir, "img_{}".format(i))
+            open(img_base + ".jpg", 'w').close()
+            if subdir != 'testImages' and i % 3 == 2:
+                continue
+            num_boxes = 1 + i % 3
+            x1y1 = np.random.random_sample((num_boxes, 2)) * 300
+            np.savetxt(img_base + ".bboxes.tsv", np.hstack((x1y1, x1y1 + 20)), fmt='%.2f', delimiter='\t')
+            with open(img_base + ".bboxes.labels.tsv", 'w') as f:
+                f.writelines("{}\n".format(['chair', 'bed', 'tv'][(i + j) % 3]) for j in range(num_boxes))
+
+def test_data_set_index(tmpdir):
+    import shutil, filecmp
+    from utils.annotations.annotations_helper import create_class_dict, create_map_files, index_data_set
+
+    map_files = ["class_map.txt", "train_img_file.txt", "train_roi_file.txt", "test_img_file.txt", "test_roi_file.txt"]
+    data_dir = str(tmpdir)
+    # the indexer writes the same files as create_class_dict and create_map_files
+    _write_test_data_set(os.path.join(data_dir, "a"))
+    shutil.copytree(os.path.join(data_dir, "a"), os.path.join(data_dir, "b"))
+    class_dict = create_class_dict(os.path.join(data_dir, "a"))
+    create_map_files(os.path.join(data_dir, "a"), class_dict, training_set=True)
+    create_map_files(os.path.join(data_dir, "a"), class_dict, training_set=False)
+    assert index_data_set(os.path.join(data_dir, "b"), num_workers=1) == class_dict
+    for map_file in map_files:
+        assert filecmp.cmp(os.path.join(data_dir, "a", map_file), os.path.join(data_dir, "b", map_file), shallow=False)
+
+    # annotation files with unchanged modification times are not parsed again
+    labels_file = os.path.join(data_dir, "b", "positive", "img_0.bboxes.labels.tsv")
+    mtime = os.path.getmtime(labels_file)
+    with open(labels_file, 'r') as f:
+        num_boxes = len(f.readlines())
+    with open(labels_file, 'w') as f:
+        f.write("lamp\n" * num_boxes)
+    os.utime(labels_file, (mtime, mtime))
+    assert index_data_set(os.path.join(data_dir, "b"), num_workers=1) == class_dict
+    os.utime(labels_file, (mtime + 10, mtime + 10))
+    assert 'lamp' in index_data_set(os.path.join(data_dir, "b"), num_workers=1)
+
+    print("Verified data set index")
+
+def test_image_size_probe(tmpdir):
+    import struct, cv2
+    from PIL import Image
+    sys.path.append(os.path.join(abs_path, "..", "FasterRCNN"))
+    from od_reader import ObjectDetectionReader
+    from od_image_sizes import image_sizes_path, load_image_sizes, _write_sizes_file
+
+    data_dir = str(tmpdir)
+    img_names = ["img_{}.png".format(i) for i in range(4)] + ["rotated.jpg"]
+    for i, img_name in enumerate(img_names[:-1]):
+        cv2.imwrite(os.path.join(data_dir, img_name), np.zeros((60 + 40 * i, 200 - 30 * i, 3), dtype=np.uint8))
+    # OpenCV applies the EXIF orientation while decoding, a rotation by 90 degrees swaps width and height
+    exif = b"Exif\x00\x00II*\x00\x08\x00\x00\x00\x01\x00" + struct.pack("<HHIHHI", 0x0112, 3, 1, 6, 0, 0)
+    Image.fromarray(np.zeros((50, 120, 3), dtype=np.uint8)).save(os.path.join(data_dir, img_names[-1]), exif=exif)
+
+    img_map_file = os.path.join(data_dir, "test_img_file.txt")
+    roi_map_file = os.path.join(data_dir, "test_roi_file.txt")
+    with open(img_map_file, 'w') as f:
+        f.writelines("{}\t{}\t0\n".format(i, img_name) for i, img_name in enumerate(img_names))
+    with open(roi_map_file, 'w') as f:
+        f.writelines("{} |roiAndLabel 10.5 20 40 45.5 1\n".format(i) for i in range(len(img_names)))
+
+    # the stats and annotations prepared from the probed sizes are the same as after decoding the images
+    args = (img_map_file, roi_map_file, 5, 300, 300, 114, False, False)
+    reader = ObjectDetectionReader(*args)
+    probing_reader = ObjectDetectionReader(*args, probe_image_sizes=True)
+    probed_stats = list(probing_reader._img_stats)
+    for _ in img_names:
+        img_data, roi_data, img_dims, _ = reader.get_next_input()
+        probed_img_data, probed_roi_data, probed_img_dims, _ = probing_reader.get_next_input()
+        assert np.array_equal(img_data, probed_img_data) and np.array_equal(roi_data, probed_roi_data)
+        assert img_dims == probed_img_dims
+    assert reader._img_stats == probed_stats
+    assert probed_stats[-1][2:4] == [50, 120]
+
+    # the sizes are stored next to the map file, a wrong size is fixed when the image is decoded
+    sizes_file = image_sizes_path(img_map_file)
+    sizes = load_image_sizes(probing_reader._img_file_paths, sizes_file, None)
+    assert np.array_equal(sizes, [stats[2:4] for stats in probed_stats])
+    paths = probing_reader._img_file_paths
+    _write_sizes_file(sizes_file, paths, np.array([os.path.getmtime(p) for p in paths]), sizes * 2)
+    probing_reader = ObjectDetectionReader(*args, probe_image_sizes=True)
+    assert probing_reader._img_stats[0][2] == 2 * sizes[0, 0]
+    reader = ObjectDetectionReader(*args)
+    assert np.array_equal(reader.get_next_input()[1], probing_reader.get_next_input()[1])
+    assert probing_reader._img_stats[0] == reader._img_stats[0]
+
+    print("Verified image size probe")
+
+def test_nms_backends():
+    from utils.nms.nms import nms, cpu_nms, _nms_blocked
+
+    num_boxes = 2500
+    x1y1 = np.random.random_sample((num_boxes, 2)) * 500
+    wh = np.random.random_sample((num_boxes, 2)) * 200
+    dets = np.hstack((x1y1, x1y1 + wh, np.random.random_sample((num_boxes, 1)))).astype(np.float32)
+    # duplicate boxes and equal scores
+    dets[100:200] = dets[:100]
+    dets[200:300, 4] = dets[300:400, 4]
+
+    for thresh in [0.0, 0.3, 0.7, 1.0]:
+        expected_keep = nms(dets.copy(), thresh, backend='numpy')
+        assert nms(dets.copy(), thresh) == expected_keep
+        for block_size in [1, 7, 64, num_boxes]:
+            assert _nms_blocked(dets.copy(), thresh, block_size) == expected_keep
+        # cpu_nms also suppresses boxes that overlap by exactly the threshold, e.g. by 0.0 or 1.0
+        if cpu_nms is not None and 0.0 < thresh < 1.0:
+            assert [int(k) for k in nms(dets.copy(), thresh, backend='cython')] == [int(k) for k in expected_keep]
+
+    assert nms(np.zeros((0, 5), dtype=np.float32), 0.7) == []
+    print("Verified nms backends")
+
+def test_soft_nms():
+    from utils.nms.nms import nms, soft_nms
+
+    num_boxes = 500
+    x1y1 = np.random.random_sample((num_boxes, 2)) * 300
+    wh = np.random.random_sample((num_boxes, 2)) * 100
+    dets = np.hstack((x1y1, x1y1 + wh, np.random.random_sample((num_boxes, 1)))).astype(np.float32)
+    scores = dets[:, 4].copy()
+
+    # reference: decay the scores of all boxes that were not selected yet and select the highest one
+    def soft_nms_reference(dets, ovr_thresh, method, sigma, score_thresh):
+        boxes, scores = dets[:, :4], dets[:, 4].copy()
+        selected = np.zeros(len(dets), dtype=bool)
+        keep = []
+        while not selected.all():
+            i = np.where(~selected)[0][np.argmax(scores[~selected])]
+            if len(keep) > 0 and scores[i] < score_thresh:
+                break
+            keep.append(i)
+            selected[i] = True
+            for j in np.where(~selected)[0]:
+                w = max(0.0, min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0]) + 1)
+                h = max(0.0, min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1]) + 1)
+                area_i = (boxes[i, 2] - boxes[i, 0] + 1) * (boxes[i, 3] - boxes[i, 1] + 1)
+                area_j = (boxes[j, 2] - boxes[j, 0] + 1) * (boxes[j, 3] - boxes[j, 1] + 1)
+                ovr = w * h / (area_i + area_j - w * h)
+                if method == 'linear' and ovr > ovr_thresh:
+                    scores[j] *= 1 - ovr
+                elif method == 'gaussian':
+                    scores[j] *= np.exp(-ovr * ovr / sigma)
+        return keep
+
+    for method in ['linear', 'gaussian']:
+        for ovr_thresh, score_thresh in [(0.3, 0.5), (0.5, 0.05)]:
+            keep = soft_nms(dets, ovr_thresh, method, 0.5, score_thresh)
+            assert keep == soft_nms_reference(dets, ovr_thresh, method, 0.5, score_thresh)
+            assert keep == nms(dets, ovr_thresh, soft=True, conf_thresh=score_thresh, soft_method=method, sigma=0.5)
+            assert keep[0] == np.argmax(scores) and len(set(keep)) == len(keep)
+    assert np.array_equal(dets[:, 4], scores)
+
+    # all boxes are kept without a score threshold, the first box even if its score is below the threshold
+    assert sorted(soft_nms(dets, 0.3, 'linear', 0.5, 0.0)) == list(range(num_boxes))
+    assert soft_nms(dets[:1] * [1, 1, 1, 1, 0.1], 0.3, 'linear', 0.5, 0.7) == [0]
+    print("Verified soft nms")
+
+def test_apply_nms_to_test_set_results():
+    from utils.nms.nms import nms
+    from utils.nms.nms_wrapper import apply_nms_to_test_set_results
+
+    num_classes, num_images = 3, 20
+    all_boxes = [[[] for _ in range(num_images)] for _ in range(num_classes)]
+    for cls_ind in range(1, num_classes):
+        for im_ind in range(1, num_images):
+            x1y1 = np.random.random_sample((50, 2)) * 300
+            wh = np.random.random_sample((50, 2)) * 100
+            all_boxes[cls_ind][im_ind] = np.hstack((x1y1, x1y1 + wh, np.random.random_sample((50, 1)))).astype(np.float32)
+
+    conf_threshold = 0.4
+    nms_boxes, nms_keep = apply_nms_to_test_set_results(all_boxes, 0.3, conf_threshold)
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(2)
+    for num_workers, use_processes, shared_pool in [(2, False, None), (2, True, None), (2, False, pool)]:
+        parallel_boxes, parallel_keep = apply_nms_to_test_set_results(all_boxes, 0.3, conf_threshold, num_workers=num_workers,
+                                                                      use_processes=use_processes, chunk_size=3,
+                                                                      pool=shared_pool)
+        assert parallel_keep == nms_keep
+        for cls_ind in range(num_classes):
+            for im_ind in range(num_images):
+                assert np.array_equal(parallel_boxes[cls_ind][im_ind], nms_boxes[cls_ind][im_ind])
+
+    for cls_ind in range(num_classes):
+        for im_ind in range(num_images):
+            dets = all_boxes[cls_ind][im_ind]
+            if len(dets) == 0:
+                assert nms_keep[cls_ind][im_ind] == [] and nms_boxes[cls_ind][im_ind] == []
+                continue
+            # same rois as filtering the nms result by confidence, in order of decreasing score
+            expected_keep = [k for k in nms(dets, 0.3) if dets[k, -1] > conf_threshold]
+            assert nms_keep[cls_ind][im_ind] == expected_keep
+    pool.close()
+    pool.join()
+    print("Verified apply_nms_to_test_set_results")
+
+def test_evaluate_detections():
+    from utils.map.map_helpers import evaluate_detections
+
+    classes = ['__background__', 'a', 'b', 'c']
+    confusions = {'a': [set(['b']), ['c']], 'b': [set(['a']), ['c']], 'c': [set(), ['a', 'b']]}
+    gt_boxes = {'a': np.array([[0, 0, 99, 99, 1], [200, 200, 299, 299, 1]], dtype=np.float32),
+                'b': np.array([[400, 0, 499, 99, 2]], dtype=np.float32),
+                'c': np.array([[0, 400, 99, 499, 3]], dtype=np.float32)}
+    all_gt_infos = {cls: [{'bbox': gt_boxes[cls], 'difficult': [False] * len(gt_boxes[cls]), 'det': [False] * len(gt_boxes[cls])},
+                          {'bbox': np.zeros((0, 5), dtype=np.float32), 'difficult': [], 'det': []}] for cls in classes[1:]}
+    all_gt_infos['a'][0]['difficult'][1] = True
+
+    # detections are shifted by one pixel during evaluation (VOCdevkit convention)
+    all_boxes = [[[] for _ in range(2)] for _ in classes]
+    all_boxes[1][0] = np.array([[-1, -1, 98, 98, 0.9],      # true positive
+                                [-1, -1, 98, 98, 0.8],      # duplicate
+                                [199, 199, 298, 298, 0.7],  # difficult, ignored
+                                [29, 29, 128, 128, 0.6],    # localization error
+                                [399, -1, 498, 98, 0.5],    # confusion with similar class 'b'
+                                [-1, 399, 98, 498, 0.4],    # confusion with other class 'c'
+                                [799, 799, 849, 849, 0.3]], dtype=np.float32)  # background
+    all_boxes[1][1] = np.array([[0, 0, 50, 50, 0.2]], dtype=np.float32)
+
+    aps, fp_errors = evaluate_detections(all_boxes, all_gt_infos, classes, apply_mms=False, confusions=confusions)
+    assert aps == {'a': 0.5, 'b': 0.0, 'c': 0.0}
+    assert list(fp_errors.keys()) == ['a']
+    assert fp_errors['a'].tolist() == [1, 1, 1, 2, 1, 1]
+    print("Verified evaluate_detections")
+
+def test_evaluate_detections_coco():
+    from utils.map.map_helpers import evaluate_detections, evaluate_detections_coco
+
+    classes = ['__background__', 'a']
+    # a large (100 x 100) and a small (20 x 20) object
+    gt_boxes = np.array([[0, 0, 99, 99, 1], [200, 200, 219, 219, 1]], dtype=np.float32)
+    all_gt_infos = {'a': [{'bbox': gt_boxes, 'difficult': [False, False], 'det': [False, False]}]}
+    # detections are shifted by one pixel during evaluation, the second one overlaps the small object by 0.739
+    all_boxes = [[[]], [np.array([[-1, -1, 98, 98, 0.9], [202, 199, 221, 218, 0.8]], dtype=np.float32)]]
+
+    report = evaluate_detections_coco(all_boxes, all_gt_infos, classes, apply_mms=False)
+    high = report['iou_thresholds'] > 0.739
+    assert len(report['iou_thresholds']) == 10 and np.sum(high) == 5
+    assert np.allclose(report['ap']['a'], np.where(high, 0.5, 1.0))
+    assert np.allclose(report['ap_by_size']['large']['a'], 1.0)
+    assert np.allclose(report['ap_by_size']['small']['a'], np.where(high, 0.0, 1.0))
+    assert np.all(np.isnan(report['ap_by_size']['medium']['a']))
+    assert np.allclose(report['recall'][1]['a'], 0.5)
+    assert np.allclose(report['recall'][10]['a'], np.where(high, 0.5, 1.0))
+    assert np.isclose(report['summary']['mAP@[0.50:0.95]'], 0.75) and np.isclose(report['summary']['mAP@0.50'], 1.0)
+    assert np.isnan(report['summary']['mAP_medium'])
+
+    # the AP at IoU 0.5 is the one of evaluate_detections
+    num_images = 30
+    all_gt_infos = {'a': []}
+    all_boxes = [[[] for _ in range(num_images)] for _ in classes]
+    for img_index in range(num_images):
+        x1y1 = np.random.random_sample((3, 2)) * 300
+        gt_boxes = np.hstack((x1y1, x1y1 + np.random.random_sample((3, 2)) * 100 + 10, np.ones((3, 1)))).astype(np.float32)
+        all_gt_infos['a'].append({'bbox': gt_boxes, 'difficult': [False] * 3, 'det': [False] * 3})
+        dets = gt_boxes[np.random.randint(0, 3, 20), :4] + np.random.randn(20, 4) * 10
+        all_boxes[1][img_index] = np.hstack((dets, np.random.random_sample((20, 1)))).astype(np.float32)
+    aps, _ = evaluate_detections(all_boxes, all_gt_infos, classes, apply_mms=False)
+    report = evaluate_detections_coco(all_boxes, all_gt_infos, classes, apply_mms=False)
+    assert report['ap']['a'][0] == aps['a']
+    print("Verified evaluate_detections_coco")
+
+def test_ground_truth_store():
+    from utils.map.map_helpers import evaluate_detections
+    from utils.map.ground_truth_store import GroundTruthStore
+
+    classes = ['__background__', 'a', 'b']
+    gt_boxes_per_image = [np.array([[10, 10, 50, 50, 2], [0, 0, 20, 20, 1], [60, 60, 90, 90, 2]], dtype=np.float32),
+                          np.zeros((0, 5), dtype=np.float32),
+                          np.array([[5, 5, 40, 40, 2]], dtype=np.float32)]
+    store = GroundTruthStore.from_image_boxes(classes, gt_boxes_per_image)
+
+    # the boxes of a class are ordered by image and keep their order within an image
+    boxes, difficult, det, offsets = store.class_gt('b')
+    assert np.array_equal(boxes, [[10, 10, 50, 50], [60, 60, 90, 90], [5, 5, 40, 40]])
+    assert np.array_equal(offsets, [0, 2, 2, 3])
+    assert store.num_boxes('a') == 1 and not difficult.any() and not det.any()
+    assert np.array_equal(store.image_boxes(['a', 'b'], 0), [[0, 0, 20, 20], [10, 10, 50, 50], [60, 60, 90, 90]])
+
+    # the store gives the same results as the dictionaries and can be evaluated again after the reset
+    all_gt_infos = {cls: [{'bbox': gt[gt[:, -1] == i], 'difficult': [False] * int(np.sum(gt[:, -1] == i)),
+                           'det': [False] * int(np.sum(gt[:, -1] == i))} for gt in gt_boxes_per_image]
+                    for i, cls in enumerate(classes)}
+    all_boxes = [[[] for _ in range(3)] for _ in classes]
+    all_boxes[2][0] = np.array([[10, 10, 50, 50, 0.9], [11, 11, 50, 50, 0.8]], dtype=np.float32)
+    all_boxes[2][2] = np.array([[100, 100, 140, 140, 0.7]], dtype=np.float32)
+    all_boxes[1][0] = np.array([[0, 0, 20, 20, 0.6]], dtype=np.float32)
+    expected_aps, _ = evaluate_detections(all_boxes, all_gt_infos, classes, apply_mms=False)
+    assert evaluate_detections(all_boxes, store, classes, apply_mms=False)[0] == expected_aps
+    assert np.array_equal(store.class_gt('b')[2], [True, False, False])
+    assert evaluate_detections(all_boxes, store, classes, apply_mms=False)[0] == expected_aps
+    print("Verified GroundTruthStore")
+
+def test_detection_evaluator():
+    import copy
+    from utils.map.map_helpers import evaluate_detections, evaluate_detections_coco
+    from utils.map.detection_evaluator import DetectionEvaluator
+
+    classes = ['__background__', 'a', 'b']
+    num_images = 40
+    all_gt_rows = []
+    all_gt_infos = {cls: [] for cls in classes[1:]}
+    all_boxes = [[[] for _ in range(num_images)] for _ in classes]
+    for img_index in range(num_images):
+        x1y1 = np.random.random_sample((4, 2)) * 300
+        gt_rows = np.hstack((x1y1, x1y1 + np.random.random_sample((4, 2)) * 100 + 10,
+                             np.random.randint(1, len(classes), (4, 1)))).astype(np.float32)
+        all_gt_rows.append(gt_rows)
+        for cls_index, cls in enumerate(classes[1:], 1):
+            cls_gt_rows = gt_rows[gt_rows[:, -1] == cls_index]
+            all_gt_infos[cls].append({'bbox': cls_gt_rows, 'difficult': [False] * len(cls_gt_rows), 'det': [False] * len(cls_gt_rows)})
+            if img_index % 5 != 0:
+                dets = gt_rows[np.random.randint(0, 4, 30), :4] + np.random.randn(30, 4) * 10
+                all_boxes[cls_index][img_index] = np.hstack((dets, np.random.random_sample((30, 1)))).astype(np.float32)
+    confusions = {'a': [set(['b']), []], 'b': [set(), ['a']]}
+
+    evaluator = DetectionEvaluator(classes, nms_threshold=0.3, conf_threshold=0.2, confusions=confusions, compact_interval=3,
+                                   keep_detections=True)
+    for img_index in range(num_images):
+        evaluator.add(img_index, [all_boxes[cls_index][img_index] for cls_index in range(len(classes))], all_gt_rows[img_index])
+        if img_index == num_images // 2 - 1:
+            partial_aps, _ = evaluator.summarize()
+    aps, fp_errors = evaluator.summarize()
+
+    # nms in a pool of workers gives the same results
+    parallel_evaluator = DetectionEvaluator(classes, nms_threshold=0.3, conf_threshold=0.2, nms_num_workers=2)
+    for img_index in range(num_images):
+        parallel_evaluator.add(img_index, [all_boxes[cls_index][img_index] for cls_index in range(len(classes))],
+                               all_gt_rows[img_index])
+    parallel_evaluator.close()
+    assert parallel_evaluator.summarize()[0] == aps
+
+    expected_aps, expected_fp_errors = evaluate_detections(all_boxes, copy.deepcopy(all_gt_infos), classes, nms_threshold=0.3,
+                                                           conf_threshold=0.2, confusions=confusions)
+    assert aps == expected_aps
+    for cls in classes[1:]:
+        assert np.array_equal(fp_errors[cls], expected_fp_errors[cls])
+
+    half_boxes = [boxes[:num_images // 2] for boxes in all_boxes]
+    half_gt_infos = {cls: gt_infos[:num_images // 2] for cls, gt_infos in copy.deepcopy(all_gt_infos).items()}
+    assert partial_aps == evaluate_detections(half_boxes, half_gt_infos, classes, nms_threshold=0.3, conf_threshold=0.2)[0]
+
+    # the COCO-style metrics from the kept detections are the same as with nms over all results
+    report = evaluator.evaluate_coco()
+    expected_report = evaluate_detections_coco(all_boxes, copy.deepcopy(all_gt_infos), classes, nms_threshold=0.3,
+                                               conf_threshold=0.2)
+    for cls in classes[1:]:
+        assert np.array_equal(report['ap'][cls], expected_report['ap'][cls], equal_nan=True)
+    assert np.allclose(list(report['summary'].values()), list(expected_report['summary'].values()), rtol=0, atol=0,
+                       equal_nan=True)
+    print("Verified DetectionEvaluator")
+
+if __name__ == '__main__':
+    import tempfile, shutil
+
+    def run_in_tmpdir(test):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            test(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    test_anchor_grid()
+    test_bbox_transform()
+    test_regress_rois()
+    run_in_tmpdir(test_proposal_cache)
+    run_in_tmpdir(test_annotation_store)
+    run_in_tmpdir(test_reader_annotation_padding)
+    run_in_tmpdir(test_zip_archive_pool)
+    run_in_tmpdir(test_reader_worker_shards)
+    run_in_tmpdir(test_image_cache)
+    run_in_tmpdir(test_reader_prefetch)
+    run_in_tmpdir(test_data_set_index)
+    run_in_tmpdir(test_image_size_probe)
+    test_nms_backends()
+    test_soft_nms()
+    test_apply_nms_to_test_set_results()
+    test_evaluate_detections()
+    test_evaluate_detections_coco()
+    test_ground_truth_store()
+    test_detection_evaluator()